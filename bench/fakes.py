@@ -0,0 +1,189 @@
+# bench/fakes.py
+# ─────────────────────────────
+# ベンチ用のローカル代役サーバー
+#   - OpenAI 互換 /v1/chat/completions（遅延・usage・finish_reason=length を設定可能）
+#   - Supabase Storage（chat-logs など）をメモリ上で再現
+#   - Supabase Auth admin の delete_user
+# 1 つの FastAPI アプリにまとめ、OPENAI_BASE_URL / SUPABASE_URL をここへ向ける。
+import asyncio
+import random
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+FILLER = "雨は泥を打ち、泥はやがて蓮を咲かせます。焦らずに、その足元を見つめてごらんなさい。"
+
+
+class FakeConfig:
+    """代役サーバーの振る舞い。ベンチ実行中に書き換えても即座に反映される。"""
+
+    def __init__(self,
+                 latency_ms: float = 800.0,
+                 jitter_ms: float = 200.0,
+                 completion_tokens: int = 220,
+                 length_rate: float = 0.1,
+                 cached_ratio: float = 0.0,
+                 storage_latency_ms: float = 30.0,
+                 seed: Optional[int] = None):
+        self.latency_ms         = latency_ms
+        self.jitter_ms          = jitter_ms
+        self.completion_tokens  = completion_tokens
+        self.length_rate        = length_rate
+        self.cached_ratio       = cached_ratio
+        self.storage_latency_ms = storage_latency_ms
+        self.rnd                = random.Random(seed)
+        self.calls              = 0
+
+    def as_dict(self) -> Dict:
+        return {
+            "latency_ms":         self.latency_ms,
+            "jitter_ms":          self.jitter_ms,
+            "completion_tokens":  self.completion_tokens,
+            "length_rate":        self.length_rate,
+            "cached_ratio":       self.cached_ratio,
+            "storage_latency_ms": self.storage_latency_ms,
+        }
+
+
+def _rough_tokens(text: str) -> int:
+    # 日本語ざっくり：2.2文字 ≒ 1token（routers/chat.py と同じ仮定）
+    return max(1, int(len(text) / 2.2))
+
+
+def _filler_text(tokens: int) -> str:
+    chars = int(tokens * 2.2)
+    return (FILLER * (chars // len(FILLER) + 1))[:chars]
+
+
+def _storage_error(status: int, message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        content={"statusCode": str(status), "error": "not_found", "message": message},
+    )
+
+
+def create_fake_app(cfg: FakeConfig) -> FastAPI:
+    app = FastAPI()
+    objects: Dict[str, bytes] = {}
+
+    async def _storage_delay():
+        if cfg.storage_latency_ms:
+            await asyncio.sleep(cfg.storage_latency_ms / 1000)
+
+    # ──────────────────────────────
+    # OpenAI 互換
+    # ──────────────────────────────
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        cfg.calls += 1
+
+        prompt_text = "".join(str(m.get("content") or "") for m in body.get("messages", []))
+        prompt_tokens = _rough_tokens(prompt_text)
+        max_tokens = int(body.get("max_tokens") or 512)
+
+        truncated = cfg.rnd.random() < cfg.length_rate
+        completion_tokens = max_tokens if truncated else min(max_tokens, cfg.completion_tokens)
+        finish_reason = "length" if truncated else "stop"
+
+        delay = cfg.latency_ms + cfg.rnd.uniform(-cfg.jitter_ms, cfg.jitter_ms)
+        await asyncio.sleep(max(0.0, delay) / 1000)
+
+        cached = int(prompt_tokens * cfg.cached_ratio) // 128 * 128
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": _filler_text(completion_tokens)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            },
+        }
+
+    # ──────────────────────────────
+    # Supabase Storage
+    # ──────────────────────────────
+    @app.get("/storage/v1/object/info/{bucket}/{path:path}")
+    async def object_info(bucket: str, path: str):
+        await _storage_delay()
+        data = objects.get(f"{bucket}/{path}")
+        if data is None:
+            return _storage_error(404, "Object not found")
+        return {"name": path, "size": len(data), "etag": f'"{hash(data) & 0xffffffff:x}"'}
+
+    @app.get("/storage/v1/object/{bucket}/{path:path}")
+    async def download(bucket: str, path: str):
+        await _storage_delay()
+        data = objects.get(f"{bucket}/{path}")
+        if data is None:
+            return _storage_error(400, "Object not found")
+        return Response(content=data, media_type="application/json")
+
+    @app.post("/storage/v1/object/list/{bucket}")
+    async def list_objects(bucket: str, request: Request):
+        await _storage_delay()
+        body = await request.json()
+        prefix = f"{bucket}/{body.get('prefix') or ''}".rstrip("/") + "/"
+        search = body.get("search") or ""
+        names = [k[len(prefix):] for k in objects if k.startswith(prefix)]
+        return [
+            {"name": n, "metadata": {"size": len(objects[prefix + n]),
+                                     "eTag": f'"{hash(objects[prefix + n]) & 0xffffffff:x}"'}}
+            for n in sorted(names) if search in n
+        ][: int(body.get("limit") or 100)]
+
+    @app.post("/storage/v1/object/{bucket}/{path:path}")
+    @app.put("/storage/v1/object/{bucket}/{path:path}")
+    async def upload(bucket: str, path: str, request: Request):
+        await _storage_delay()
+        raw = await request.body()
+        ctype = request.headers.get("content-type", "")
+        data = raw
+        if ctype.startswith("multipart/"):
+            msg = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {ctype}\r\n\r\n".encode() + raw
+            )
+            for part in msg.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    data = part.get_payload(decode=True)
+        objects[f"{bucket}/{path}"] = data
+        return {"Key": f"{bucket}/{path}"}
+
+    @app.delete("/storage/v1/object/{bucket}")
+    async def remove(bucket: str, request: Request):
+        await _storage_delay()
+        body = await request.json()
+        removed = []
+        for p in body.get("prefixes", []):
+            if objects.pop(f"{bucket}/{p}", None) is not None:
+                removed.append({"name": p})
+        return removed
+
+    # ──────────────────────────────
+    # Supabase Auth admin
+    # ──────────────────────────────
+    @app.delete("/auth/v1/admin/users/{user_id}")
+    async def delete_auth_user(user_id: str):
+        await _storage_delay()
+        return {}
+
+    @app.get("/_fake/stats")
+    async def stats():
+        return {"openai_calls": cfg.calls, "objects": len(objects),
+                "object_bytes": sum(len(v) for v in objects.values())}
+
+    app.state.objects = objects
+    return app
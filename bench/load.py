@@ -0,0 +1,409 @@
+# bench/load.py
+# ─────────────────────────────
+# エンドツーエンド負荷ベンチ
+#   ローカル Postgres + 代役 OpenAI / Supabase（bench/fakes.py）に向けて main:app を起動し、
+#   /new_chat /chat /daily/today /shared_words/all /token_status を混ぜて叩く。
+#   エンドポイントごとに p50/p95/p99・スループット・DB 往復回数を出し、JSON で保存する。
+#
+# 使い方:
+#   python -m bench.load --database-url postgresql://localhost/aibutsu_bench --setup \
+#       --concurrency 32 --duration 30 --mix new_chat=1,chat=4,daily=2,shared_all=2,token_status=3
+#   python -m bench.load --compare bench/results/A.json bench/results/B.json
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import asyncpg
+import httpx
+import uvicorn
+
+from bench.fakes import FakeConfig, create_fake_app
+
+ROOT         = Path(__file__).resolve().parent.parent
+SCHEMA_FILE  = ROOT / "bench" / "schema.sql"
+MIGRATIONS   = ROOT / "sql"
+RESULTS_DIR  = ROOT / "bench" / "results"
+
+DEFAULT_MIX  = "new_chat=1,chat=4,daily=2,shared_all=2,token_status=3"
+
+QUESTIONS = [
+    "仕事がうまくいきません。",
+    "最近よく眠れず、朝になると不安が消えない感じがします。どうしたらいいでしょうか？",
+    "友人との関係がぎくしゃくしていて、謝るべきか距離を置くべきか迷っています。"
+    "自分が悪かったのか相手が悪かったのか、考えるほど分からなくなります。",
+    "お守りを持っていても怖い夢ばかり見ます。",
+    "転職するか今の会社に残るか決められません。給料は上がるけれど、"
+    "新しい環境に馴染めるか心配で、家族にも相談しづらいです。"
+    "毎晩同じことを考えてしまい、心がざわつくばかりです。何を手がかりに決めればよいのでしょう？",
+]
+
+
+# ──────────────────────────────
+# DB 往復回数のカウント
+#   asyncpg.Connection の公開クエリメソッドを包み、
+#   リクエストごとの contextvar にカウントを積む（Pool 経由の呼び出しも最終的にここを通る）
+# ──────────────────────────────
+_round_trips: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "bench_round_trips", default=None
+)
+_QUERY_METHODS = ("execute", "executemany", "fetch", "fetchrow", "fetchval")
+
+
+def install_round_trip_counter():
+    from asyncpg.connection import Connection
+
+    for name in _QUERY_METHODS:
+        original = getattr(Connection, name)
+        if getattr(original, "_bench_wrapped", False):
+            continue
+
+        def make(orig):
+            async def wrapper(self, *args, **kwargs):
+                ctr = _round_trips.get()
+                if ctr is not None:
+                    ctr[0] += 1
+                return await orig(self, *args, **kwargs)
+            wrapper._bench_wrapped = True
+            return wrapper
+
+        setattr(Connection, name, make(original))
+
+
+class RoundTripMiddleware:
+    """X-Bench-Endpoint ヘッダー単位で DB 往復回数を集計する ASGI ミドルウェア"""
+
+    def __init__(self, app, sink: Dict[str, List[int]]):
+        self.app = app
+        self.sink = sink
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        label = dict(scope.get("headers") or []).get(b"x-bench-endpoint", b"").decode() or scope["path"]
+        ctr = [0]
+        token = _round_trips.set(ctr)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _round_trips.reset(token)
+            self.sink.setdefault(label, []).append(ctr[0])
+
+
+# ──────────────────────────────
+# サーバー起動（別スレッド・別イベントループ）
+# ──────────────────────────────
+class ThreadedServer:
+    def __init__(self, app, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, loop="asyncio",
+            log_level="warning", lifespan="on",
+        ))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 30.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("サーバーの起動に失敗しました")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=30)
+
+
+# ──────────────────────────────
+# DB 準備
+# ──────────────────────────────
+def _assert_local(database_url: str, allow_remote: bool):
+    host = urlparse(database_url).hostname or "localhost"
+    if host not in ("localhost", "127.0.0.1", "::1") and not allow_remote:
+        sys.exit(f"❌ {host} はローカルではありません。スキーマを DROP するので --allow-remote を明示してください。")
+
+
+async def setup_database(database_url: str, users: List[str], shared: int):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(SCHEMA_FILE.read_text(encoding="utf-8"))
+        if MIGRATIONS.is_dir():
+            for path in sorted(MIGRATIONS.glob("*.sql")):
+                await conn.execute(path.read_text(encoding="utf-8"))
+
+        rnd = random.Random(0)
+        await conn.executemany(
+            "INSERT INTO daily_words (title, body, action_hint, rarity) VALUES ($1, $2, $3, $4)",
+            [(f"言葉{i}", QUESTIONS[i % len(QUESTIONS)], "深呼吸を三回", rnd.randint(1, 5)) for i in range(60)],
+        )
+        await conn.executemany(
+            "INSERT INTO omikuji (grade, headline, guidance, action_hint, rarity) VALUES ($1, $2, $3, $4, $5)",
+            [(g, f"{g}の兆し", "流れに身をまかせよ", "白湯を飲む", rnd.randint(1, 5))
+             for g in ("大吉", "吉", "中吉", "小吉", "末吉", "凶") for _ in range(5)],
+        )
+        await conn.executemany(
+            "INSERT INTO user_tokens (user_id, tokens_remaining) VALUES ($1, $2)",
+            [(u, 1_000_000_000) for u in users],
+        )
+
+        sharers = [str(uuid.uuid4()) for _ in range(50)]
+        shared_ids = await conn.fetch(
+            """INSERT INTO shared_words (user_id, chat_id, content, comment, share_slug, created_at)
+               SELECT ($1::uuid[])[1 + (g % 50)], gen_random_uuid(),
+                      'あなたの心の雨も、いつか蓮を咲かせる泥となるでしょう。' || g,
+                      CASE WHEN g % 3 = 0 THEN 'しみました' END,
+                      'b' || lpad(g::text, 5, '0'),
+                      now() - (g || ' minutes')::interval
+               FROM generate_series(1, $2) g
+               RETURNING id""",
+            sharers, shared,
+        )
+        ids = [r["id"] for r in shared_ids]
+        await conn.executemany(
+            "INSERT INTO favorites (user_id, shared_id) VALUES ($1, $2)",
+            [(rnd.choice(sharers), rnd.choice(ids)) for _ in range(shared * 5)] if ids else [],
+        )
+    finally:
+        await conn.close()
+
+
+# ──────────────────────────────
+# 負荷ドライバー
+# ──────────────────────────────
+def _parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, w = part.partition("=")
+        mix[name.strip()] = float(w or 1)
+    unknown = set(mix) - {"new_chat", "chat", "daily", "shared_all", "token_status"}
+    if unknown:
+        sys.exit(f"❌ 不明なエンドポイント: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class VirtualUser:
+    def __init__(self, user_id: str, rnd: random.Random):
+        self.user_id = user_id
+        self.chat_ids: List[str] = []
+        self.rnd = rnd
+
+    def request_for(self, name: str):
+        q = self.rnd.choice(QUESTIONS)
+        if name == "chat" and not self.chat_ids:
+            name = "new_chat"   # まだチャットが無ければ作るところから
+        if name == "new_chat":
+            return name, "POST", "/new_chat", {"json": {"user_id": self.user_id, "question": q}}
+        if name == "chat":
+            chat_id = self.rnd.choice(self.chat_ids[-3:])
+            return name, "POST", "/chat", {"json": {"chat_id": chat_id, "user_id": self.user_id, "question": q}}
+        if name == "daily":
+            kind = self.rnd.choice(("word", "omikuji"))
+            return name, "GET", "/daily/today", {"params": {"type": kind, "user_id": self.user_id}}
+        if name == "shared_all":
+            return name, "GET", "/shared_words/all", {}
+        return name, "GET", "/token_status", {"params": {"user_id": self.user_id}}
+
+
+async def run_load(base_url: str, users: List[str], mix: Dict[str, float],
+                   concurrency: int, duration: float, seed: int) -> Dict[str, Dict]:
+    names, weights = zip(*mix.items())
+    samples: Dict[str, List[float]] = {n: [] for n in ("new_chat", "chat", "daily", "shared_all", "token_status")}
+    errors: Dict[str, int] = {n: 0 for n in samples}
+    deadline = time.monotonic() + duration
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+
+        async def worker(i: int):
+            rnd = random.Random(seed + i)
+            vu = VirtualUser(users[i % len(users)], rnd)
+            while time.monotonic() < deadline:
+                name, method, path, kw = vu.request_for(rnd.choices(names, weights)[0])
+                t0 = time.perf_counter()
+                try:
+                    resp = await client.request(method, path, headers={"X-Bench-Endpoint": name}, **kw)
+                    ok = resp.status_code < 400
+                except httpx.HTTPError:
+                    resp, ok = None, False
+                samples[name].append(time.perf_counter() - t0)
+                if not ok:
+                    errors[name] += 1
+                elif name == "new_chat":
+                    chat_id = resp.json().get("chat_id")
+                    if chat_id:
+                        vu.chat_ids.append(chat_id)
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    return {"samples": samples, "errors": errors, "elapsed": elapsed}
+
+
+def _percentile(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    # nearest-rank 法
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+
+def summarize(raw: Dict, round_trips: Dict[str, List[int]]) -> Dict[str, Dict]:
+    out, elapsed, total = {}, raw["elapsed"], 0
+    for name, vals in raw["samples"].items():
+        if not vals:
+            continue
+        vals = sorted(vals)
+        trips = round_trips.get(name, [])
+        total += len(vals)
+        out[name] = {
+            "count":          len(vals),
+            "errors":         raw["errors"][name],
+            "throughput_rps": round(len(vals) / elapsed, 2),
+            "p50_ms":         round(_percentile(vals, 50) * 1000, 2),
+            "p95_ms":         round(_percentile(vals, 95) * 1000, 2),
+            "p99_ms":         round(_percentile(vals, 99) * 1000, 2),
+            "mean_ms":        round(sum(vals) / len(vals) * 1000, 2),
+            "db_round_trips": round(sum(trips) / len(trips), 2) if trips else None,
+        }
+    out["_total"] = {"count": total, "throughput_rps": round(total / elapsed, 2), "elapsed_s": round(elapsed, 2)}
+    return out
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_table(endpoints: Dict[str, Dict]):
+    print(f"{'endpoint':<14}{'count':>8}{'err':>6}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'db rt':>8}")
+    for name, s in endpoints.items():
+        if name.startswith("_"):
+            continue
+        print(f"{name:<14}{s['count']:>8}{s['errors']:>6}{s['throughput_rps']:>9}"
+              f"{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{str(s['db_round_trips']):>8}")
+    t = endpoints["_total"]
+    print(f"{'total':<14}{t['count']:>8}{'':>6}{t['throughput_rps']:>9}   ({t['elapsed_s']}s)")
+
+
+def compare(a_path: str, b_path: str):
+    a = json.loads(Path(a_path).read_text(encoding="utf-8"))
+    b = json.loads(Path(b_path).read_text(encoding="utf-8"))
+    print(f"A: {a_path} ({a['meta'].get('git_rev')})\nB: {b_path} ({b['meta'].get('git_rev')})")
+    print(f"{'endpoint':<14}{'metric':<16}{'A':>10}{'B':>10}{'Δ%':>9}")
+    for name in sorted(set(a["endpoints"]) & set(b["endpoints"])):
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "db_round_trips"):
+            va, vb = a["endpoints"][name].get(metric), b["endpoints"][name].get(metric)
+            if va is None or vb is None:
+                continue
+            delta = f"{(vb - va) / va * 100:+.1f}" if va else "-"
+            print(f"{name:<14}{metric:<16}{va:>10}{vb:>10}{delta:>9}")
+
+
+# ──────────────────────────────
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="AI仏 API のエンドツーエンド負荷ベンチ")
+    ap.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    ap.add_argument("--setup", action="store_true", help="スキーマを作り直してシードを投入する")
+    ap.add_argument("--allow-remote", action="store_true")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--duration", type=float, default=30.0, help="計測秒数")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--shared", type=int, default=500, help="シードする shared_words 件数")
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--app-port", type=int, default=18000)
+    ap.add_argument("--fake-port", type=int, default=18001)
+    ap.add_argument("--openai-latency-ms", type=float, default=800.0)
+    ap.add_argument("--openai-jitter-ms", type=float, default=200.0)
+    ap.add_argument("--completion-tokens", type=int, default=220)
+    ap.add_argument("--length-rate", type=float, default=0.1, help="finish_reason=length を返す割合")
+    ap.add_argument("--cached-ratio", type=float, default=0.0, help="usage.prompt_tokens_details.cached_tokens の割合")
+    ap.add_argument("--storage-latency-ms", type=float, default=30.0)
+    ap.add_argument("--rate-limit", action="store_true", help="アプリのレートリミットを有効にしたまま計測する")
+    ap.add_argument("--label", default="", help="結果ファイル名に付けるラベル")
+    ap.add_argument("--out", default=str(RESULTS_DIR))
+    ap.add_argument("--compare", nargs=2, metavar=("A", "B"))
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+    if not args.database_url:
+        sys.exit("❌ --database-url（または BENCH_DATABASE_URL）を指定してください。")
+    _assert_local(args.database_url, args.allow_remote)
+
+    rnd = random.Random(args.seed)
+    users = [str(uuid.UUID(int=rnd.getrandbits(128), version=4)) for _ in range(args.users)]
+    if args.setup:
+        asyncio.run(setup_database(args.database_url, users, args.shared))
+        print("🗄  スキーマ & シード投入完了")
+
+    fake_cfg = FakeConfig(
+        latency_ms=args.openai_latency_ms, jitter_ms=args.openai_jitter_ms,
+        completion_tokens=args.completion_tokens, length_rate=args.length_rate,
+        cached_ratio=args.cached_ratio, storage_latency_ms=args.storage_latency_ms, seed=args.seed,
+    )
+    fake = ThreadedServer(create_fake_app(fake_cfg), args.fake_port)
+    fake.start()
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    os.environ.update({
+        "DATABASE_URL":    args.database_url,
+        "SUPABASE_URL":    fake_url,
+        "SUPABASE_KEY":    "bench.bench.bench",
+        "OPENAI_API_KEY":  "bench",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        # 仮想ユーザーは連打するので、明示しない限りレートリミットは切る
+        "RATE_LIMIT_ENABLED": "1" if args.rate_limit else "0",
+    })
+
+    install_round_trip_counter()
+    sys.path.insert(0, str(ROOT))
+    import main as app_module  # 環境変数を差し替えてから読み込む
+
+    round_trips: Dict[str, List[int]] = {}
+    app_server = ThreadedServer(RoundTripMiddleware(app_module.app, round_trips), args.app_port)
+    app_server.start()
+    try:
+        raw = asyncio.run(run_load(f"http://127.0.0.1:{args.app_port}", users,
+                                   _parse_mix(args.mix), args.concurrency, args.duration, args.seed))
+    finally:
+        app_server.stop()
+        fake.stop()
+
+    endpoints = summarize(raw, round_trips)
+    print_table(endpoints)
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    result = {
+        "meta": {
+            "timestamp": stamp, "git_rev": _git_rev(), "python": sys.version.split()[0],
+            "concurrency": args.concurrency, "duration": args.duration, "mix": args.mix,
+            "users": args.users, "seed": args.seed, "fake": fake_cfg.as_dict(),
+            "openai_calls": fake_cfg.calls,
+        },
+        "endpoints": endpoints,
+    }
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / f"{stamp}{'-' + args.label if args.label else ''}.json"
+    out_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"💾 {out_path}")
+
+
+if __name__ == "__main__":
+    main()
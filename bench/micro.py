@@ -0,0 +1,191 @@
+# bench/micro.py
+# ─────────────────────────────
+# 毎リクエスト通る純粋関数のマイクロベンチ & 退行チェック
+#   対象: _limit_questions / _build_messages / _tok_len / detect_bless / _postprocess /
+#         empty_embedding_vector / generate_slug / get_today の重み付きプール構築 /
+#         一覧系レスポンスの JSON 化（FastAPI 既定経路 vs utils.fast_json）
+#
+# 使い方:
+#   python -m bench.micro                      # 計測して表示
+#   python -m bench.micro --save-baseline      # bench/baselines/micro.json を更新
+#   python -m bench.micro --check              # ベースライン比 +25% 超で exit 1
+#   python -m bench.micro --check --threshold 1.5 -k limit_questions
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+ROOT          = Path(__file__).resolve().parent.parent
+BASELINE_FILE = ROOT / "bench" / "baselines" / "micro.json"
+
+# import 時に外部クライアントを作るモジュールがあるので、未設定ならダミー値を入れておく
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "bench.bench.bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, str(ROOT))
+
+from fastapi.encoders import jsonable_encoder             # noqa: E402
+from fastapi.responses import JSONResponse                 # noqa: E402
+
+from routers.omikuji import _build_weighted_pool          # noqa: E402
+from utils import ai_response, fast_json                   # noqa: E402
+from utils.init import empty_embedding_vector, generate_slug  # noqa: E402
+
+# ──────────────────────────────
+# 入力データ（日本語の実際の相談・回答に近い文面）
+# ──────────────────────────────
+_Q = ("最近、仕事でミスが続いて自信をなくしています。上司にも迷惑をかけてしまい、"
+      "このまま続けていいのか分かりません？ 家に帰っても眠れず、心がざわつくばかりです。")
+_A = ("雨の日に傘を責める人はいません。あなたのミスもまた、降っては止む雨のようなもの。"
+      "泥の中から蓮が咲くように、つまずいた場所にこそ次の一歩の芽があります。"
+      "今夜は、ただ湯を沸かし、その音に耳を澄ませてごらんなさい？ 答えは急がずともよいのです。")
+
+
+def _text(base: str, chars: int) -> str:
+    return (base * (chars // len(base) + 1))[:chars]
+
+
+SIZES = {"s": 60, "m": 600, "l": 6000}
+
+
+def _pairs(n: int) -> List[Dict]:
+    out = []
+    for _ in range(n):
+        out.extend([{"role": "user", "content": _Q}, {"role": "assistant", "content": _A}])
+    return out
+
+
+def _candidates(n: int) -> List[Dict]:
+    rnd = random.Random(n)
+    return [{"id": uuid.UUID(int=rnd.getrandbits(128)), "rarity": rnd.choice((1, 1, 1, 2, 2, 3, 4, 5, None))}
+            for _ in range(n)]
+
+
+def _shared_rows(n: int) -> List[Dict]:
+    """/shared_words/all の 1 行と同じ型構成（UUID / datetime / int / None）"""
+    rnd = random.Random(n)
+    base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    return [{"id": uuid.UUID(int=rnd.getrandbits(128)), "content": _text(_A, 80),
+             "share_slug": generate_slug(), "created_at": base + timedelta(seconds=rnd.randint(0, 10**7),
+                                                                           microseconds=rnd.randint(0, 999999)),
+             "comment": "しみました" if i % 3 == 0 else None, "like_count": rnd.randint(0, 50)}
+            for i in range(n)]
+
+
+def build_cases() -> Dict[str, Callable[[], object]]:
+    cases: Dict[str, Callable[[], object]] = {}
+    random.seed(0)
+
+    for label, n in SIZES.items():
+        answer = _text(_A, n)
+        question = _text(_Q, n)
+        cases[f"limit_questions[{label}]"] = lambda t=answer: ai_response._limit_questions(t)
+        cases[f"tok_len[{label}]"]         = lambda t=answer: ai_response._tok_len(t)
+        cases[f"detect_bless[{label}]"]    = lambda t=question: ai_response.detect_bless(t)
+        cases[f"postprocess[{label}]"]     = lambda t=answer: ai_response._postprocess(t, False)
+    cases["detect_bless[hit]"] = lambda: ai_response.detect_bless(_Q + "お守りが欲しい")
+
+    summaries = [_text(_A, 50)] * ai_response.SUMMARY_PAIR_MAX
+    for label, (n_pairs, n_sum) in {"new": (0, 0), "mid": (2, 3), "full": (2, len(summaries))}.items():
+        pairs = _pairs(n_pairs)
+        sums = summaries[:n_sum]
+        cases[f"build_messages[{label}]"] = lambda p=pairs, s=sums: ai_response._build_messages(p, s, _Q, False)
+    cases["build_messages[overflow]"] = lambda p=_pairs(12): ai_response._build_messages(p, summaries, _Q, True)
+
+    cases["empty_embedding_vector"] = lambda: empty_embedding_vector()
+    cases["generate_slug"]          = lambda: generate_slug()
+
+    for n in (30, 300, 3000):
+        cands = _candidates(n)
+        cases[f"weighted_pool[{n}]"] = lambda c=cands: _build_weighted_pool(c)
+
+    for n in (100, 1000):
+        rows = _shared_rows(n)
+        assert JSONResponse(jsonable_encoder(rows)).body == fast_json.dumps(rows)
+        cases[f"list_json[encoder,{n}]"] = lambda r=rows: JSONResponse(jsonable_encoder(r)).body
+        cases[f"list_json[fast,{n}]"]    = lambda r=rows: fast_json.dumps(r)
+    return cases
+
+
+# ──────────────────────────────
+def measure(fn: Callable[[], object], repeat: int, min_time: float) -> float:
+    """1 回あたりの最小時間（µs）。ウォームアップ後、number を autorange で決める"""
+    fn()
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(number, int(number * min_time / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def _machine() -> Dict[str, str]:
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "processor": platform.processor() or platform.platform()}
+
+
+def load_baseline() -> Dict:
+    if not BASELINE_FILE.exists():
+        return {}
+    return json.loads(BASELINE_FILE.read_text(encoding="utf-8"))
+
+
+def compare(results: Dict[str, float], baseline: Dict, threshold: float) -> List[Tuple[str, float, float]]:
+    regressions = []
+    base = baseline.get("cases", {})
+    print(f"{'case':<30}{'µs/call':>12}{'baseline':>12}{'ratio':>8}")
+    for name, us in results.items():
+        ref = base.get(name)
+        ratio = us / ref if ref else None
+        flag = "  ❌" if ratio and ratio > threshold else ""
+        print(f"{name:<30}{us:>12.2f}{(f'{ref:.2f}' if ref else '-'):>12}"
+              f"{(f'{ratio:.2f}' if ratio else '-'):>8}{flag}")
+        if ratio and ratio > threshold:
+            regressions.append((name, us, ref))
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="ホットパス純粋関数のマイクロベンチ")
+    ap.add_argument("-k", dest="pattern", default="", help="名前に含む文字列で絞り込み")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="1 repeat あたりの最低秒数")
+    ap.add_argument("--threshold", type=float, default=1.25, help="ベースライン比でこれを超えたら退行")
+    ap.add_argument("--check", action="store_true", help="退行があれば exit 1")
+    ap.add_argument("--save-baseline", action="store_true")
+    args = ap.parse_args(argv)
+
+    results = {}
+    for name, fn in build_cases().items():
+        if args.pattern in name:
+            results[name] = measure(fn, args.repeat, args.min_time)
+
+    baseline = load_baseline()
+    if baseline and baseline.get("machine") != _machine():
+        print(f"⚠️  ベースラインは別環境で採取されています: {baseline.get('machine')}")
+    regressions = compare(results, baseline, args.threshold)
+    missing = [name for name in results if name not in baseline.get("cases", {})]
+    if missing and not args.save_baseline:
+        print(f"⚠️  ベースラインに無いケース（--save-baseline で追加）: {', '.join(missing)}")
+
+    if args.save_baseline:
+        merged = {**baseline.get("cases", {}), **{k: round(v, 3) for k, v in results.items()}}
+        BASELINE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE_FILE.write_text(json.dumps({"machine": _machine(), "cases": merged},
+                                            ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"💾 {BASELINE_FILE}")
+
+    if args.check and (regressions or missing):
+        print(f"❌ {len(regressions)} 件の退行（閾値 x{args.threshold}）、ベースライン未採取 {len(missing)} 件")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
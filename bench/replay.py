@@ -0,0 +1,315 @@
+# bench/replay.py
+# ─────────────────────────────
+# 履歴まわりの設定（FULL_PAIR_LIMIT / TOKEN_BUDGET_HISTORY / SUMMARY_PAIR_MAX /
+# CHUNK_MAX_TOKENS / CONTINUE_MAX_CHUNKS）をオフラインで比べるリプレイ
+#   書き出した会話サンプルを 1 ターンずつ流し、本番と同じ _prepare_history → _build_messages →
+#   _call_openai を通す。DB と OpenAI は代役で、モデルは記録済みの回答の長さどおりに
+#   usage（プロンプトキャッシュ込み）と finish_reason=length を返す。
+#   遅延は実際には待たず、トークン数から見積もった値を積み上げる。
+#
+# サンプルの書き出し（1 行 1 発言の JSONL）:
+#   \copy (SELECT row_to_json(c) FROM (SELECT chat_id, question, answer, created_at, is_root
+#          FROM conversations WHERE created_at > now() - interval '7 days') c) TO 'sample.jsonl'
+#
+# 使い方:
+#   python -m bench.replay sample.jsonl
+#   python -m bench.replay sample.jsonl --grid FULL_PAIR_LIMIT=1,2,3 TOKEN_BUDGET_HISTORY=800,1200
+#   python -m bench.replay --synthetic 200 --grid SUMMARY_PAIR_MAX=0,4,8 --save
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+ROOT         = Path(__file__).resolve().parent.parent
+RESULTS_DIR  = ROOT / "bench" / "results"
+
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "bench.bench.bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, str(ROOT))
+
+from utils import ai_response, history_cache      # noqa: E402
+
+KNOBS = ("FULL_PAIR_LIMIT", "TOKEN_BUDGET_HISTORY", "SUMMARY_PAIR_MAX",
+         "CHUNK_MAX_TOKENS", "CONTINUE_MAX_CHUNKS")
+
+# プロバイダのプロンプトキャッシュ（先頭一致 1024 トークン以上、128 刻み）
+CACHE_MIN_TOKENS  = 1024
+CACHE_BLOCK       = 128
+MESSAGE_OVERHEAD  = 4       # 1 メッセージあたりの role・区切りのトークン
+
+
+# ──────────────────────────────
+# 入力
+# ──────────────────────────────
+def load_sample(path: Path) -> List[List[Dict]]:
+    """JSONL（1 行 1 発言）をチャットごとの発言リスト（古い順）にまとめる"""
+    chats: Dict[str, List[Dict]] = defaultdict(list)
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            chats[str(row["chat_id"])].append(row)
+    out = []
+    for rows in chats.values():
+        rows.sort(key=lambda r: (not r.get("is_root", False), r.get("created_at") or ""))
+        out.append(rows)
+    return out
+
+
+def synthetic_sample(n_chats: int, seed: int = 0) -> List[List[Dict]]:
+    """サンプルが手元に無いとき用。ターン数・文の長さを実データに近い分布でばらつかせる"""
+    rnd = random.Random(seed)
+    q = "最近、仕事でミスが続いて自信をなくしています。このまま続けていいのか分かりません。"
+    a = ("雨の日に傘を責める人はいません。泥の中から蓮が咲くように、つまずいた場所にこそ"
+         "次の一歩の芽があります。今夜は、ただ湯を沸かし、その音に耳を澄ませてごらんなさい。")
+    chats = []
+    for c in range(n_chats):
+        turns = max(1, int(rnd.expovariate(1 / 4)) + 1)
+        chats.append([{"chat_id": f"synthetic-{c}", "is_root": t == 0,
+                       "question": q[:rnd.randint(15, len(q))],
+                       "answer": (a * 4)[:rnd.randint(80, len(a) * 4)]}
+                      for t in range(turns)])
+    return chats
+
+
+# ──────────────────────────────
+# 代役 DB / モデル
+# ──────────────────────────────
+class ReplayDB:
+    """_prepare_history が読む conversations を、記録済みの「このターンより前」の発言で返す
+    （履歴キャッシュに外れたときだけ呼ばれる。窓で切るのは呼び出し側に任せて全部返す）"""
+
+    def __init__(self):
+        self.rows: List[Dict] = []
+
+    async def fetch(self, sql: str, *args):
+        return [_turn_row(r, i) for i, r in enumerate(self.rows)]
+
+
+def _turn_row(r: Dict, i: int) -> Dict:
+    return {"id": r.get("id") or f"{r['chat_id']}:{i}", "chat_id": r["chat_id"],
+            "question": r["question"], "answer": r["answer"], "is_root": r.get("is_root", i == 0)}
+
+
+class LatencyModel:
+    def __init__(self, base_ms: float, prompt_ms_per_tok: float, cached_ms_per_tok: float,
+                 output_ms_per_tok: float):
+        self.base_ms           = base_ms
+        self.prompt_ms_per_tok = prompt_ms_per_tok
+        self.cached_ms_per_tok = cached_ms_per_tok
+        self.output_ms_per_tok = output_ms_per_tok
+
+    def __call__(self, prompt: int, cached: int, completion: int) -> float:
+        return (self.base_ms + (prompt - cached) * self.prompt_ms_per_tok
+                + cached * self.cached_ms_per_tok + completion * self.output_ms_per_tok)
+
+
+class FakeModel:
+    """chat.completions.create だけを持つ AsyncOpenAI の代役"""
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self._prefixes = set()      # 送ったプロンプトの先頭部分（メッセージ単位）のハッシュ
+        self.answer = ""            # 今のターンで返す回答（記録済みのもの）
+        self.emitted = 0            # そのうち返したトークン数（続き呼び用）
+        self.turn = defaultdict(float)
+
+    def start_turn(self, answer: str) -> None:
+        self.answer, self.emitted = answer, 0
+        self.turn = defaultdict(float)
+
+    def _cached_tokens(self, messages: List[Dict], sizes: List[int]) -> int:
+        h, matched, total = hashlib.sha1(), 0, 0
+        hit = True
+        for m, size in zip(messages, sizes):
+            h.update(json.dumps(m, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            key = h.hexdigest()
+            total += size
+            if hit and key in self._prefixes:
+                matched = total
+            else:
+                hit = False
+            self._prefixes.add(key)
+        return matched // CACHE_BLOCK * CACHE_BLOCK if matched >= CACHE_MIN_TOKENS else 0
+
+    async def create(self, model: str, messages: List[Dict], max_tokens: int, **kwargs):
+        sizes = [ai_response._tok_len(str(m.get("content") or "")) + MESSAGE_OVERHEAD for m in messages]
+        prompt = sum(sizes)
+        summary = model == ai_response.OPENAI_SUMMARY_MODEL and model != ai_response.OPENAI_MODEL
+
+        if summary:
+            cached = 0
+            completion = min(max_tokens, 40)
+            content, finish = "（要約）" + messages[-1]["content"][-50:], "stop"
+        else:
+            cached = self._cached_tokens(messages, sizes)
+            remaining = max(1, ai_response._tok_len(self.answer) - self.emitted)
+            completion = min(max_tokens, remaining)
+            finish = "length" if remaining > max_tokens else "stop"
+            content = self.answer
+            self.emitted += completion
+
+        kind = "summary" if summary else "main"
+        self.turn[f"{kind}_calls"] += 1
+        self.turn[f"{kind}_prompt_tokens"] += prompt
+        self.turn[f"{kind}_completion_tokens"] += completion
+        self.turn["cached_tokens"] += cached
+        self.turn["latency_ms"] += self.latency(prompt, cached, completion)
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish)],
+            usage=SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion,
+                                  total_tokens=prompt + completion,
+                                  prompt_tokens_details=SimpleNamespace(cached_tokens=cached)),
+        )
+
+
+# ──────────────────────────────
+# リプレイ本体
+# ──────────────────────────────
+async def replay(chats: List[List[Dict]], config: Dict[str, int], latency: LatencyModel) -> Dict:
+    saved = {k: getattr(ai_response, k) for k in KNOBS}
+    saved_client = ai_response.get_openai_client
+    model = FakeModel(latency)
+    db = ReplayDB()
+    turns: List[Dict] = []
+    try:
+        for k, v in config.items():
+            setattr(ai_response, k, v)
+        ai_response.get_openai_client = lambda: model
+        history_cache.clear()
+
+        for rows in chats:
+            for i, row in enumerate(rows):
+                db.rows = rows[:i]
+                model.start_turn(row["answer"])
+                if i == 0:
+                    _, billed, _ = await ai_response.generate_answer(row["question"])
+                else:
+                    _, billed, _ = await ai_response.generate_answer_with_context(
+                        str(row["chat_id"]), row["question"], db)
+                turns.append({**model.turn, "billable_tokens": billed})
+                history_cache.record_turn(_turn_row(row, i))     # 本番の保存時と同じく追記
+    finally:
+        for k, v in saved.items():
+            setattr(ai_response, k, v)
+        ai_response.get_openai_client = saved_client
+        history_cache.clear()
+    return summarize(config, turns)
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(config: Dict[str, int], turns: List[Dict]) -> Dict:
+    n = len(turns) or 1
+
+    def col(name):
+        return [t.get(name, 0) for t in turns]
+
+    prompt = [t.get("main_prompt_tokens", 0) + t.get("summary_prompt_tokens", 0) for t in turns]
+    calls = [t.get("main_calls", 0) + t.get("summary_calls", 0) for t in turns]
+    latency = col("latency_ms")
+    return {
+        "config":              config,
+        "turns":               len(turns),
+        "prompt_tokens_mean":  sum(prompt) / n,
+        "prompt_tokens_p95":   _pct(prompt, 95),
+        "main_prompt_mean":    sum(col("main_prompt_tokens")) / n,
+        "summary_prompt_mean": sum(col("summary_prompt_tokens")) / n,
+        "cached_tokens_mean":  sum(col("cached_tokens")) / n,
+        "completion_mean":     sum(col("main_completion_tokens")) / n,
+        "calls_mean":          sum(calls) / n,
+        "summary_calls_mean":  sum(col("summary_calls")) / n,
+        "billable_mean":       sum(col("billable_tokens")) / n,
+        "latency_ms_p50":      _pct(latency, 50),
+        "latency_ms_p95":      _pct(latency, 95),
+    }
+
+
+def parse_grid(items: List[str]) -> List[Dict[str, int]]:
+    axes = {}
+    for item in items:
+        name, _, values = item.partition("=")
+        if name not in KNOBS or not values:
+            raise SystemExit(f"❌ --grid は {'/'.join(KNOBS)} のいずれか=値,値 の形式です: {item}")
+        axes[name] = [int(v) for v in values.split(",")]
+    if not axes:
+        return [{k: getattr(ai_response, k) for k in KNOBS}]
+    names = list(axes)
+    base = {k: getattr(ai_response, k) for k in KNOBS}
+    return [{**base, **dict(zip(names, combo))} for combo in itertools.product(*axes.values())]
+
+
+def print_table(results: List[Dict]) -> None:
+    changed = [k for k in KNOBS if len({r["config"][k] for r in results}) > 1] or list(KNOBS)
+    head = "".join(f"{k:>22}" for k in changed)
+    print(f"{head}{'prompt':>9}{'p95':>8}{'cached':>8}{'calls':>7}{'sum':>6}{'billed':>8}"
+          f"{'lat p50':>9}{'lat p95':>9}")
+    for r in results:
+        knobs = "".join(f"{r['config'][k]:>22}" for k in changed)
+        print(f"{knobs}{r['prompt_tokens_mean']:>9.0f}{r['prompt_tokens_p95']:>8.0f}"
+              f"{r['cached_tokens_mean']:>8.0f}{r['calls_mean']:>7.2f}{r['summary_calls_mean']:>6.2f}"
+              f"{r['billable_mean']:>8.0f}{r['latency_ms_p50']:>9.0f}{r['latency_ms_p95']:>9.0f}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="履歴設定ごとのトークン・呼び出し回数・遅延をオフラインで比較")
+    ap.add_argument("sample", nargs="?", type=Path, help="会話サンプル（1 行 1 発言の JSONL）")
+    ap.add_argument("--synthetic", type=int, default=0, help="サンプルの代わりに合成チャットを N 件使う")
+    ap.add_argument("--max-chats", type=int, default=0, help="先頭から N チャットだけ使う")
+    ap.add_argument("--grid", nargs="*", default=[], metavar="KNOB=v1,v2")
+    ap.add_argument("--base-ms", type=float, default=350.0, help="1 呼び出しの固定遅延")
+    ap.add_argument("--prompt-ms", type=float, default=0.08, help="未キャッシュ入力 1 トークンあたり")
+    ap.add_argument("--cached-ms", type=float, default=0.02, help="キャッシュ済み入力 1 トークンあたり")
+    ap.add_argument("--output-ms", type=float, default=18.0, help="出力 1 トークンあたり")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--save", action="store_true", help="bench/results/replay-*.json に保存")
+    args = ap.parse_args(argv)
+
+    if args.sample:
+        chats = load_sample(args.sample)
+    elif args.synthetic:
+        chats = synthetic_sample(args.synthetic, args.seed)
+    else:
+        ap.error("サンプルファイルか --synthetic N を指定してください。")
+    if args.max_chats:
+        chats = chats[:args.max_chats]
+    if ai_response._get_encoder() is False:
+        print("⚠️  tiktoken の encoding が読めないので、トークン数は文字数から概算しています。")
+
+    random.seed(args.seed)      # BLESS の「合掌」付与など、本番コード側の乱数も固定する
+    latency = LatencyModel(args.base_ms, args.prompt_ms, args.cached_ms, args.output_ms)
+    results = [asyncio.run(replay(chats, config, latency)) for config in parse_grid(args.grid)]
+    print(f"📼 {len(chats)} チャット / {results[0]['turns']} ターン（値は 1 ターンあたり）")
+    print_table(results)
+
+    if args.save:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        out = RESULTS_DIR / f"replay-{stamp}.json"
+        out.write_text(json.dumps({"latency": vars(latency), "results": results},
+                                  ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"💾 {out}")
+
+
+if __name__ == "__main__":
+    main()
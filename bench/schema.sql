@@ -0,0 +1,103 @@
+-- bench/schema.sql
+-- ─────────────────────────────
+-- ベンチ用：アプリが実際に触るテーブルだけを再現したスキーマ。
+-- ⚠️ 既存テーブルを DROP するので、ベンチ専用のローカル DB にだけ流すこと。
+
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS vector;
+EXCEPTION WHEN OTHERS THEN
+    -- pgvector が無い環境では text のドメインで代用（$6::vector のキャストが通れば十分）
+    IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'vector') THEN
+        CREATE DOMAIN vector AS text;
+    END IF;
+END $$;
+
+DROP TABLE IF EXISTS favorites, shared_words, conversations, user_tokens,
+                     user_streaks, daily_draws, daily_words, omikuji CASCADE;
+DROP TYPE IF EXISTS draw_type;
+
+CREATE TYPE draw_type AS ENUM ('word', 'omikuji');
+
+CREATE TABLE conversations (
+    id          uuid PRIMARY KEY,
+    chat_id     uuid NOT NULL,
+    user_id     uuid NOT NULL,
+    question    text NOT NULL,
+    answer      text NOT NULL,
+    embedding   vector,
+    created_at  timestamptz NOT NULL DEFAULT now(),
+    is_root     boolean NOT NULL DEFAULT false
+);
+CREATE INDEX conversations_chat_id_idx ON conversations (chat_id, created_at);
+CREATE INDEX conversations_user_root_idx ON conversations (user_id, created_at DESC) WHERE is_root;
+
+CREATE TABLE shared_words (
+    id          uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id     uuid NOT NULL,
+    chat_id     uuid NOT NULL,
+    content     text NOT NULL,
+    comment     text,
+    share_slug  text NOT NULL,
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX shared_words_slug_idx ON shared_words (share_slug);
+CREATE INDEX shared_words_user_idx ON shared_words (user_id);
+CREATE INDEX shared_words_created_idx ON shared_words (created_at DESC);
+
+CREATE TABLE favorites (
+    id          bigserial PRIMARY KEY,
+    user_id     uuid NOT NULL,
+    shared_id   uuid NOT NULL REFERENCES shared_words (id) ON DELETE CASCADE,
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX favorites_shared_idx ON favorites (shared_id);
+CREATE INDEX favorites_user_idx ON favorites (user_id, created_at DESC);
+
+CREATE TABLE user_tokens (
+    user_id          uuid PRIMARY KEY,
+    tokens_remaining integer NOT NULL DEFAULT 8000,
+    total_used       integer NOT NULL DEFAULT 0,
+    daily_used       integer NOT NULL DEFAULT 0,
+    total_rewarded   integer NOT NULL DEFAULT 0,
+    daily_rewarded   integer NOT NULL DEFAULT 0,
+    plan             text    NOT NULL DEFAULT 'free',
+    last_reset_date  date    DEFAULT current_date
+);
+
+CREATE TABLE user_streaks (
+    user_id      uuid PRIMARY KEY,
+    last_active  date,
+    streak       integer,
+    best_streak  integer
+);
+
+CREATE TABLE daily_words (
+    id           uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    title        text,
+    body         text,
+    action_hint  text,
+    rarity       integer,
+    is_active    boolean NOT NULL DEFAULT true
+);
+
+CREATE TABLE omikuji (
+    id           uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    grade        text,
+    headline     text,
+    guidance     text,
+    action_hint  text,
+    rarity       integer,
+    is_active    boolean NOT NULL DEFAULT true
+);
+
+CREATE TABLE daily_draws (
+    id        uuid PRIMARY KEY,
+    user_id   uuid NOT NULL,
+    date      date NOT NULL,
+    type      draw_type NOT NULL,
+    ref_id    uuid NOT NULL,
+    seed      text,
+    drawn_at  timestamptz,
+    UNIQUE (user_id, date, type)
+);
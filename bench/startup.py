@@ -0,0 +1,164 @@
+# bench/startup.py
+# ─────────────────────────────
+# コールドスタート計測
+#   1) python -X importtime で main を読み込み、モジュールごとの import 時間を集計
+#   2) uvicorn main:app を子プロセスで起動し、/health が ok を返すまでの時間を測る
+# 結果は bench/results/startup-*.json に保存し、--baseline で前回と比べられる。
+#
+# 使い方:
+#   python -m bench.startup --database-url postgresql://localhost/aibutsu_bench
+#   python -m bench.startup --skip-health --baseline bench/results/startup-XXXX.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT         = Path(__file__).resolve().parent.parent
+RESULTS_DIR  = ROOT / "bench" / "results"
+PROJECT_PREFIXES = ("main", "models", "routers", "utils")
+
+
+def _env(database_url: Optional[str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+    env.setdefault("SUPABASE_KEY", "bench.bench.bench")
+    env.setdefault("OPENAI_API_KEY", "bench")
+    if database_url:
+        env["DATABASE_URL"] = database_url
+    return env
+
+
+# ──────────────────────────────
+# 1) import 時間
+# ──────────────────────────────
+def measure_imports(env: Dict[str, str]) -> Dict:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        sys.exit(f"❌ import main に失敗しました:\n{proc.stderr[-2000:]}")
+
+    modules: List[Dict] = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append({"module": name.strip(), "self_ms": int(self_us) / 1000,
+                        "cumulative_ms": int(cumulative_us) / 1000, "depth": depth})
+
+    main_total = next((m["cumulative_ms"] for m in modules if m["module"] == "main"), None)
+    top_level = sorted((m for m in modules if m["depth"] <= 1), key=lambda m: -m["cumulative_ms"])
+    project = [m for m in modules if m["module"].split(".")[0] in PROJECT_PREFIXES]
+    return {
+        "main_ms": main_total,
+        "top": [{k: m[k] for k in ("module", "cumulative_ms")} for m in top_level[:20]],
+        "project": [{k: m[k] for k in ("module", "self_ms", "cumulative_ms")}
+                    for m in sorted(project, key=lambda m: -m["cumulative_ms"])],
+    }
+
+
+# ──────────────────────────────
+# 2) 起動 → /health が ok になるまで
+# ──────────────────────────────
+def measure_first_healthy(env: Dict[str, str], port: int, timeout: float) -> Dict:
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    first_response = None
+    try:
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                return {"error": f"プロセスが終了しました (code={proc.returncode})",
+                        "log": proc.stdout.read()[-2000:]}
+            try:
+                r = httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+                if first_response is None:
+                    first_response = time.perf_counter() - started
+                if r.status_code == 200 and r.json().get("status") == "ok":
+                    return {"first_response_ms": round(first_response * 1000, 1),
+                            "first_healthy_ms": round((time.perf_counter() - started) * 1000, 1)}
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.02)
+        return {"error": f"{timeout}s 以内に healthy になりませんでした"}
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def _print_report(result: Dict, baseline: Optional[Dict]):
+    imports = result["imports"]
+    base_imports = (baseline or {}).get("imports", {})
+    base_project = {m["module"]: m["cumulative_ms"] for m in base_imports.get("project", [])}
+
+    print(f"📦 import main: {imports['main_ms']:.1f} ms"
+          + (f"  (baseline {base_imports['main_ms']:.1f} ms)" if base_imports.get("main_ms") else ""))
+    print(f"{'module':<40}{'cumulative ms':>15}")
+    for m in imports["top"][:10]:
+        print(f"{m['module']:<40}{m['cumulative_ms']:>15.1f}")
+    print(f"\n{'project module':<40}{'self ms':>10}{'cum ms':>10}{'baseline':>10}")
+    for m in imports["project"]:
+        ref = base_project.get(m["module"])
+        print(f"{m['module']:<40}{m['self_ms']:>10.1f}{m['cumulative_ms']:>10.1f}"
+              f"{(f'{ref:.1f}' if ref is not None else '-'):>10}")
+
+    health = result.get("health")
+    if health:
+        if "error" in health:
+            print(f"\n❌ /health: {health['error']}")
+        else:
+            base_health = (baseline or {}).get("health") or {}
+            print(f"\n🩺 first response: {health['first_response_ms']} ms, "
+                  f"first healthy: {health['first_healthy_ms']} ms"
+                  + (f"  (baseline {base_health['first_healthy_ms']} ms)"
+                     if base_health.get("first_healthy_ms") else ""))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="コールドスタート計測")
+    ap.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    ap.add_argument("--port", type=int, default=18010)
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--runs", type=int, default=3, help="import 計測の回数（最小値を採用）")
+    ap.add_argument("--skip-health", action="store_true", help="/health 計測を省く（DB 不要）")
+    ap.add_argument("--baseline", help="比較対象の startup-*.json")
+    ap.add_argument("--out", default=str(RESULTS_DIR))
+    args = ap.parse_args(argv)
+
+    env = _env(args.database_url)
+    runs = [measure_imports(env) for _ in range(max(1, args.runs))]
+    result = {"imports": min(runs, key=lambda r: r["main_ms"] or float("inf"))}
+
+    if not args.skip_health:
+        if not args.database_url:
+            sys.exit("❌ /health 計測には --database-url が必要です（--skip-health で省略可）。")
+        result["health"] = measure_first_healthy(env, args.port, args.timeout)
+
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8")) if args.baseline else None
+    _print_report(result, baseline)
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    result["meta"] = {"timestamp": stamp, "python": sys.version.split()[0]}
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / f"startup-{stamp}.json"
+    out_path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"💾 {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,23 @@ import os
 import asyncpg
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client
 from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager 
-from routers import chat, omikuji, user, share, favorites, token, health
+from routers import chat, omikuji, user, share, favorites, token, health, search, diagnostics
+from utils import ai_response
+from utils.init import SERVICE_TZ, get_supabase
+from utils.purge import purge_worker
+from utils.usage_rollup import flush_usage, usage_rollup_worker
+from utils.idempotency import idempotency_sweeper
+from utils.trending import trending_worker
+from utils import loop_monitor
+from utils.loop_monitor import LoopMonitorMiddleware
+from utils import conversation_writer
+from utils.rate_limit import RateLimitMiddleware
 import asyncio                    
+import logging
+import time
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
 import httpx                    
 
 # ===================================================
@@ -23,8 +33,12 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
-# Supabase クライアント
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# アプリ側のログ（routers.* / utils.*）は INFO 以上を標準出力へ
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+for _name in ("routers", "utils"):
+    logging.getLogger(_name).addHandler(_log_handler)
+    logging.getLogger(_name).setLevel(logging.INFO)
 
 # --- 🔻 Nightly Reset 用 定数 ---
 ADMIN_TOKEN = "super_secret_token"
@@ -34,13 +48,14 @@ BASE_URL = "https://web-production-0080.up.railway.app"
 # 🔻 追加：毎日0時にトークンをリセット
 async def nightly_reset_task():
     while True:
-        # 現在時刻（JST）
-        now = datetime.now(ZoneInfo("Asia/Tokyo"))
+        # 現在時刻（SERVICE_TZ。/admin/reset_all_tokens が書く日付と同じ境界）
+        now = datetime.now(SERVICE_TZ)
         # 次の0時
         next_midnight = (now + timedelta(days=1)).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
-        wait_sec = (next_midnight - now).total_seconds()
+        # 少し過ぎてから呼ぶ（0 時ちょうど手前で起きると、前日の日付でリセットしてしまう）
+        wait_sec = (next_midnight - now).total_seconds() + 1
         await asyncio.sleep(wait_sec)
 
         try:
@@ -58,14 +73,61 @@ async def nightly_reset_task():
 
 
 
+# 🔻 Supabase / OpenAI クライアントと tokenizer を裏で温める（import 時には作らない）
+def _warm_up_clients():
+    started = time.perf_counter()
+    try:
+        get_supabase()
+        ai_response.get_openai_client()
+        ai_response._get_encoder()
+        print(f"🔥 クライアント初期化完了 ({time.perf_counter() - started:.2f}s)")
+    except Exception as e:
+        print("❌ クライアント初期化失敗:", e)
+
+
 # 👇 ここにデコレーターを追加
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.db_pool = await asyncpg.create_pool(DATABASE_URL, statement_cache_size=0)
     print("✅ データベース接続成功")
 
+    app.state.warm_up_task = asyncio.create_task(asyncio.to_thread(_warm_up_clients))
+    # ユーザー削除ジョブ（途中で落ちたジョブもここで再開される）
+    app.state.purge_task = asyncio.create_task(purge_worker(app.state.db_pool))
+    # 利用量の日次ロールアップ（usage_daily）を定期的に書き出す
+    app.state.usage_task = asyncio.create_task(usage_rollup_worker(app.state.db_pool))
+    app.state.idempotency_task = asyncio.create_task(idempotency_sweeper(app.state.db_pool))
+    # イベントループの遅延監視（/diagnostics/loop_lag）
+    app.state.loop_monitor_task = loop_monitor.ensure_started()
+    # 急上昇フィード（shared_words.trend_score の rebase と上位 K 件の読み直し）
+    app.state.trending_task = asyncio.create_task(trending_worker(app.state.db_pool))
+    # conversations の write-behind（CONVERSATION_WRITE_BEHIND=1 のときだけ）
+    app.state.writer_task = None
+    if conversation_writer.WRITE_BEHIND_ENABLED:
+        app.state.writer_task = asyncio.create_task(
+            conversation_writer.conversation_writer_worker(app.state.db_pool))
+
     yield
 
+    app.state.purge_task.cancel()
+    app.state.usage_task.cancel()
+    app.state.idempotency_task.cancel()
+    app.state.trending_task.cancel()
+    if app.state.loop_monitor_task:
+        app.state.loop_monitor_task.cancel()
+    if app.state.writer_task:
+        # 書き込みの途中で止めない。今のまとめ書きが終わるのを待ってから残りを書き切る
+        conversation_writer.stop()
+        try:
+            await asyncio.wait_for(app.state.writer_task, timeout=10)
+        except asyncio.TimeoutError:
+            pass    # 待ちきれずにキャンセルした分はバッファに戻っている
+        await conversation_writer.drain(app.state.db_pool)
+    try:
+        await flush_usage(app.state.db_pool)
+    except Exception as e:
+        print("❌ 終了時の利用量 flush 失敗:", e)
+
     await app.state.db_pool.close()
     print("👋 DB接続終了")
 
@@ -78,6 +140,9 @@ async def _start_nightly_scheduler():
     asyncio.create_task(nightly_reset_task())
 
 
+# レートリミット（チャット系の手前で 429 を返す。CORS より内側に置く）
+app.add_middleware(RateLimitMiddleware)
+
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -87,6 +152,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# イベントループの遅延監視（一番外側に置き、止めたルートを特定できるようにする）
+app.add_middleware(LoopMonitorMiddleware)
+
 
 
 # ルーター登録
@@ -97,3 +165,5 @@ app.include_router(favorites.router)
 app.include_router(token.router)
 app.include_router(omikuji.router)
 app.include_router(health.router)
+app.include_router(search.router)
+app.include_router(diagnostics.router)
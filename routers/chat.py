@@ -1,55 +1,69 @@
-import json
 import uuid
-from fastapi import Depends, HTTPException
-from fastapi.responses import JSONResponse
-import supabase
+from typing import Optional
+from fastapi import Depends, Header, HTTPException, Query, Request, Response
 from fastapi import APIRouter
 from models import ChatRequest, NewChatRequest
 from utils.ai_response import generate_answer, generate_answer_with_context
-from utils.init import check_token_limit_and_log, empty_embedding_vector, save_chat_pair_to_storage, save_message_pair_to_storage
-from utils.init import get_db 
+from utils.init import check_token_limit_and_log, refund_tokens, save_chat_pair_to_storage, save_message_pair_to_storage
+from utils import chat_log, token_estimator
+from utils.cache import etag_matches
+from utils.fast_json import dumps, json_response
+from utils.init import get_db
+from utils.archive import needs_rehydrate, rehydrate_chat
+from utils.usage_rollup import record_chat
+from utils.idempotency import fingerprint, run_idempotent
+from utils.conversation_writer import make_row, merge_pending, write_conversation
 router = APIRouter()
 
 
+# Idempotency-Key 付きの再送・二度押しは、保存済みの結果を返すか処理中の 1 回目を待つ（utils/idempotency.py）
 @router.post("/new_chat")
-async def new_chat(request: NewChatRequest, db=Depends(get_db)):
+async def new_chat(request: NewChatRequest, response: Response, db=Depends(get_db),
+                   idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
     user_id = str(uuid.UUID(request.user_id))
+    result, replayed = await run_idempotent(db, "new_chat", user_id, idempotency_key,
+                                            fingerprint(request.model_dump()),
+                                            lambda: _new_chat(request, user_id, db))
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+@router.post("/chat")
+async def add_message(request: ChatRequest, response: Response, db=Depends(get_db),
+                      idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    user_id = str(uuid.UUID(request.user_id))
+    result, replayed = await run_idempotent(db, "chat", user_id, idempotency_key,
+                                            fingerprint(request.model_dump()),
+                                            lambda: _add_message(request, user_id, db))
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _new_chat(request: NewChatRequest, user_id: str, db):
     question = request.question.strip()
     if not question:
         raise HTTPException(status_code=400, detail="質問が空です。")
 
-    # 仮のトークン数でチェック（長さ + 平均回答分）
-    estimated_tokens = _rough_token_estimate(question)
-    is_allowed = await check_token_limit_and_log(user_id, estimated_tokens, db)
+    # 見積もったトークン数を先に予約（utils/token_estimator.py が実績から学習する）
+    estimate = token_estimator.estimate("new", question)
+    is_allowed = await check_token_limit_and_log(user_id, estimate.tokens, db)
     if not is_allowed:
-        return JSONResponse(
-            status_code=200,
-            content={
-                "answer": "今日はここまでにしましょう。また明日、静かにお話しましょう。",
-                "limited": True
-            }
-        )
-
-    # 実回答生成と実トークン数取得
-    answer, tokens_used = await generate_answer(question)
-
-    # 差分を加算（上限超過しても回答は返すが、フラグを立てる）
-    token_diff = tokens_used - estimated_tokens
-    limited = False
-    if token_diff > 0:
-        success = await check_token_limit_and_log(user_id, token_diff, db)
-        if not success:
-            limited = True
+        return {
+            "answer": "今日はここまでにしましょう。また明日、静かにお話しましょう。",
+            "limited": True
+        }
+
+    # 実回答生成と実トークン数取得（キャッシュ済み入力は割引後の課金トークン数）
+    answer, tokens_used, usage = await generate_answer(question)
 
-    # DBに保存
+    # 予約との差を精算（上限超過しても回答は返すが、フラグを立てる）
     chat_id = str(uuid.uuid4())
-    embedding_str = "[" + ", ".join(["0.0"] * 1536) + "]"
-    async with db.acquire() as db:
-        await db.execute("""
-            INSERT INTO conversations
-            (id, chat_id, user_id, question, answer, embedding, is_root)
-            VALUES ($1, $2, $3, $4, $5, $6::vector, true)
-        """, chat_id, chat_id, user_id, question, answer, embedding_str)
+    limited = await _settle(user_id, chat_id, estimate, tokens_used, usage, db, new_chat=True)
+
+    # DBに保存（write-behind 有効時はバッファに積んで先に応答する）
+    await write_conversation(db, make_row(chat_id, chat_id, user_id, question, answer, True, usage))
 
     save_chat_pair_to_storage(chat_id, question, answer)
 
@@ -63,16 +77,14 @@ async def new_chat(request: NewChatRequest, db=Depends(get_db)):
 
 
 
-@router.post("/chat")
-async def add_message(request: ChatRequest, db=Depends(get_db)):
+async def _add_message(request: ChatRequest, user_id: str, db):
     chat_id = request.chat_id
-    user_id = request.user_id
     question = (request.question or "").strip()
     if not question:
         raise HTTPException(status_code=400, detail="質問が空です。")
 
-    estimated_tokens = _rough_token_estimate(question)
-    is_allowed = await check_token_limit_and_log(user_id, estimated_tokens, db)
+    estimate = token_estimator.estimate("chat", question, chat_id)
+    is_allowed = await check_token_limit_and_log(user_id, estimate.tokens, db)
     if not is_allowed:
         return {
             "chat_id": chat_id,
@@ -80,22 +92,11 @@ async def add_message(request: ChatRequest, db=Depends(get_db)):
             "limited": True
         }
 
-    answer, tokens_used = await generate_answer_with_context(chat_id, question, db)
+    answer, tokens_used, usage = await generate_answer_with_context(chat_id, question, db)
 
-    token_diff = tokens_used - estimated_tokens
-    limited = False
-    if token_diff > 0:
-        success = await check_token_limit_and_log(user_id, token_diff, db)
-        if not success:
-            limited = True
+    limited = await _settle(user_id, chat_id, estimate, tokens_used, usage, db)
 
-    embedding_str = empty_embedding_vector()
-    async with db.acquire() as db:
-        await db.execute("""
-            INSERT INTO conversations
-            (id, chat_id, user_id, question, answer, embedding, created_at, is_root)
-            VALUES ($1, $2, $3, $4, $5, $6::vector, NOW(), false)
-        """, str(uuid.uuid4()), chat_id, user_id, question, answer, embedding_str)
+    await write_conversation(db, make_row(str(uuid.uuid4()), chat_id, user_id, question, answer, False, usage))
 
     save_message_pair_to_storage(chat_id, question, answer)
 
@@ -107,35 +108,72 @@ async def add_message(request: ChatRequest, db=Depends(get_db)):
     }
 
 
-def _rough_token_estimate(text: str) -> int:
-    # 日本語ざっくり想定：2.2文字 ≒ 1token。回答分バッファを足す
-    base = max(1, int(len(text) / 2.2))
-    return base + 300   # 応答バッファ（自動つづき込みでも余裕め）
+async def _settle(user_id: str, chat_id: str, estimate, tokens_used: int, usage, db,
+                  new_chat: bool = False) -> bool:
+    """予約（estimate.tokens）と実際の課金トークン数の差を精算し、上限に達したかを返す。
+    足りなければ追加で引き、TOKEN_REFUND_MIN を超えて余れば返す
+    （返金は UPDATE がもう 1 本増えるので、小さな余りはそのまま。閾値の考え方は token_estimator を参照）"""
+    token_estimator.observe(estimate, tokens_used, chat_id, usage.get("history_turns"))
+    token_diff = tokens_used - estimate.tokens
+    limited = False
+    charged = estimate.tokens
+    if token_diff > 0:
+        if await check_token_limit_and_log(user_id, token_diff, db):
+            charged += token_diff
+        else:
+            limited = True
+    elif -token_diff > token_estimator.TOKEN_REFUND_MIN:
+        await refund_tokens(user_id, -token_diff, db)
+        charged = tokens_used
+    record_chat(user_id, usage, charged, new_chat=new_chat)
+    return limited
 
 @router.get("/chat/{chat_id}")
 async def get_chat(chat_id: str,db=Depends(get_db)):
     try:
         chat_id = str(uuid.UUID(chat_id))
-        async with db.acquire() as db:
-            messages = await db.fetch("""
-                SELECT *
-                FROM conversations
-                WHERE chat_id = $1
-                ORDER BY created_at ASC
-            """, chat_id)
+        messages = await _fetch_chat_rows(db, chat_id)
+        # 退避済みのチャットはその場で書き戻してから返す
+        if needs_rehydrate(messages) and await rehydrate_chat(db, chat_id):
+            messages = await _fetch_chat_rows(db, chat_id)
         if not messages:
             raise HTTPException(status_code=404, detail="チャットが見つかりません。")
-        return messages
+        return json_response(messages)
     except ValueError:
         raise HTTPException(status_code=400, detail="無効なUUID形式のchat_idです。")
 
+async def _fetch_chat_rows(db, chat_id: str):
+    async with db.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT *
+            FROM conversations
+            WHERE chat_id = $1
+            ORDER BY created_at ASC
+        """, chat_id)
+    return merge_pending(rows, chat_id)
+
+# ストレージのチャットログ（version が同じなら 304 / キャッシュ。?last=N で末尾 N 件だけ）
 @router.get("/storage_chat/{chat_id}")
-async def get_chat_from_storage(chat_id: str):
-    bucket_name = "chat-logs"
-    file_name = f"chat_{chat_id}.json"
+async def get_chat_from_storage(chat_id: str, request: Request,
+                                last: Optional[int] = Query(None, ge=1, le=1000)):
     try:
-        res = supabase.storage.from_(bucket_name).download(file_name)
-        data = json.loads(res.decode("utf-8"))
-        return {"chat_id": chat_id, "messages": data}
+        chat_id = str(uuid.UUID(chat_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なUUID形式のchat_idです。")
+
+    try:
+        version = await chat_log.chat_log_version(chat_id)
+        etag = chat_log.make_etag(chat_id, f"{version}:{last or ''}") if version else None
+        if etag and etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        raw, version = await chat_log.load_chat_log(chat_id, version)
+    except chat_log.ChatLogNotFound:
+        raise HTTPException(status_code=404, detail="チャットログが見つかりません。")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"ストレージから取得失敗: {e}")
+        raise HTTPException(status_code=502, detail=f"ストレージから取得失敗: {e}")
+
+    etag = etag or chat_log.make_etag(chat_id, f"{version}:{last or ''}")
+    messages = chat_log.last_messages(raw, last) if last else raw
+    body = b'{"chat_id":' + dumps(chat_id) + b',"messages":' + messages + b"}"
+    return Response(body, media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "private, no-cache"})
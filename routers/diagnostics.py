@@ -0,0 +1,37 @@
+# diagnostics.py
+# -----------------------------------------------
+# 運用向けの内部メトリクス（プロセスごとの値。レプリカ間では集計しない）
+#   スタックやファイルパスを含むので、/admin/* と同じく X-ADMIN-TOKEN が必要
+import os
+
+from fastapi import APIRouter, Request
+
+from utils import history_cache, loop_monitor, token_estimator
+
+router = APIRouter()
+
+_ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "super_secret_token")
+
+
+# トークン予約の見積もり：バケットごとのサンプル数・誤差・追加課金率・返金率
+@router.get("/diagnostics/token_estimator")
+async def token_estimator_stats(request: Request):
+    if request.headers.get("X-ADMIN-TOKEN") != _ADMIN_TOKEN:
+        return {"status": "unauthorized"}
+    return token_estimator.stats()
+
+
+# 履歴キャッシュ（_prepare_history）：チャット単位の直近ターンとターン要約のヒット率
+@router.get("/diagnostics/history_cache")
+async def history_cache_stats(request: Request):
+    if request.headers.get("X-ADMIN-TOKEN") != _ADMIN_TOKEN:
+        return {"status": "unauthorized"}
+    return history_cache.stats()
+
+
+# イベントループの遅延：全体とルートごとのヒストグラム、直近の停止（ルート・コード位置・スタック）
+@router.get("/diagnostics/loop_lag")
+async def loop_lag_stats(request: Request):
+    if request.headers.get("X-ADMIN-TOKEN") != _ADMIN_TOKEN:
+        return {"status": "unauthorized"}
+    return loop_monitor.stats()
@@ -1,6 +1,7 @@
 
 import uuid
 from fastapi import APIRouter, Depends
+from utils.fast_json import json_response
 from utils.init import get_db
 router = APIRouter()
 
@@ -19,5 +20,5 @@ async def get_liked_shared_words(user_id: str,db=Depends(get_db)):
             WHERE f.user_id = $1
             ORDER BY f.created_at DESC
         """, user_id)
-    return [dict(row) for row in rows]
+    return json_response(rows)
 
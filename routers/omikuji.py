@@ -43,6 +43,17 @@ async def _render_draw(db, draw_type: Literal["word","omikuji"], ref_id: uuid.UU
             "action_hint": row["action_hint"],
         }
 
+# ─────────────────────────────────────────────────────
+# レア度 → 抽選重み（rarity が大きいほど出にくい）
+# ─────────────────────────────────────────────────────
+RARITY_WEIGHTS = {1:80, 2:20, 3:6, 4:2, 5:1}
+
+def _build_weighted_pool(candidates) -> list:
+    pool = []
+    for c in candidates:
+        pool.extend([c["id"]] * RARITY_WEIGHTS.get(int(c["rarity"] or 1), 1))
+    return pool
+
 # ─────────────────────────────────────────────────────
 # GET /daily/today?type=word|omikuji&user_id=...
 # 決定論抽選（user_id+date+type）＋ 30日再出防止
@@ -99,12 +110,7 @@ async def get_today(
     seed = int(hashlib.sha256(seed_str.encode()).hexdigest(), 16)
     rnd = random.Random(seed)
 
-    def weight(r: int) -> int:
-        return {1:80, 2:20, 3:6, 4:2, 5:1}.get(int(r or 1), 1)
-
-    pool = []
-    for c in candidates:
-        pool.extend([c["id"]] * weight(c["rarity"]))
+    pool = _build_weighted_pool(candidates)
 
     ref_id: uuid.UUID = rnd.choice(pool)
 
@@ -0,0 +1,101 @@
+# ai-butsu-api/routers/search.py
+# ─────────────────────────────
+# ユーザー自身の会話（question / answer）の検索
+#   pg_trgm の GIN 索引（sql/002_conversations_search.sql）に ILIKE を当てるので、
+#   履歴が増えてもスキャン量は一致行の分だけで済む。
+#   トライグラムは 3 文字単位なので、2 文字以下の語（「縁」「供養」など）では索引が引けない。
+#   そういう語は 3 文字以上の語で絞った行に対する追加条件としてだけ使い、短い語だけの検索は受け付けない
+#   （受け付けるとユーザーの全行を読むことになり、履歴に比例して遅くなる）。
+import uuid
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from utils.init import get_db
+
+router = APIRouter()
+
+SEARCH_EXPR       = "(question || E'\\n' || answer)"   # 索引の式と同じにする
+MAX_TERMS         = 5
+MAX_TERM_CHARS    = 50
+MIN_INDEXED_CHARS = 3       # pg_trgm が ILIKE に索引を使える最短の語
+SNIPPET_CHARS     = 60
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _snippet(text: str, terms: List[str]) -> str:
+    lower = text.lower()
+    hits = [i for i in (lower.find(t.lower()) for t in terms) if i >= 0]
+    if not hits:
+        return text[:SNIPPET_CHARS] + ("…" if len(text) > SNIPPET_CHARS else "")
+    start = max(0, min(hits) - SNIPPET_CHARS // 3)
+    end = start + SNIPPET_CHARS
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
+
+
+# ──────────────────────────────
+# GET /search?user_id=...&q=...&limit=20&offset=0
+# ──────────────────────────────
+@router.get("/search")
+async def search_conversations(
+    user_id: str = Query(...),
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=50),
+    offset: int = Query(0, ge=0),
+    db=Depends(get_db),
+):
+    try:
+        user_id = str(uuid.UUID(user_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なUUID形式のuser_idです。")
+
+    terms = [t[:MAX_TERM_CHARS] for t in q.split()][:MAX_TERMS]   # 全角スペースでも区切る
+    if not terms:
+        raise HTTPException(status_code=400, detail="検索語が空です。")
+
+    if all(len(t) < MIN_INDEXED_CHARS for t in terms):
+        raise HTTPException(
+            status_code=400,
+            detail=f"{MIN_INDEXED_CHARS}文字以上の検索語を1つ以上含めてください（例:「縁」→「ご縁が」）。")
+
+    patterns = [_like_pattern(t) for t in terms]
+    # すべての語を含む行だけ。質問側に出てくる語が多いほど上位、同点は新しい順。
+    # 短い語は索引の式に当てない（トライグラムが取れず、索引全体を読むことになる）。長い語で絞った行を見るだけ
+    where = " AND ".join(
+        f"{SEARCH_EXPR} ILIKE ${i + 2}" if len(t) >= MIN_INDEXED_CHARS
+        else f"(question ILIKE ${i + 2} OR answer ILIKE ${i + 2})"
+        for i, t in enumerate(terms))
+    score = " + ".join(f"(question ILIKE ${i + 2})::int" for i in range(len(patterns)))
+    n = len(patterns) + 2
+
+    async with db.acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT id, chat_id, created_at, question, answer, {score} AS score
+            FROM conversations
+            WHERE user_id = $1 AND {where}
+            ORDER BY score DESC, created_at DESC
+            LIMIT ${n} OFFSET ${n + 1}
+        """, user_id, *patterns, limit + 1, offset)
+
+    results = []
+    for r in rows[:limit]:
+        in_question = r["score"] > 0
+        results.append({
+            "id":         r["id"],
+            "chat_id":    r["chat_id"],
+            "created_at": r["created_at"],
+            "matched_in": "question" if in_question else "answer",
+            "snippet":    _snippet(r["question"] if in_question else r["answer"], terms),
+            "score":      r["score"],
+        })
+
+    return {
+        "user_id": user_id,
+        "query": q,
+        "results": results,
+        "next_offset": offset + limit if len(rows) > limit else None,
+    }
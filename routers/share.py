@@ -1,12 +1,19 @@
 import uuid
-from fastapi import Depends, HTTPException
-import supabase
+import asyncpg
+from fastapi import Depends, HTTPException, Query, Request
 from fastapi import APIRouter
+from fastapi.responses import Response
 
+from utils import shared_word_cache, trending
+from utils.cache import etag_matches
+from utils.fast_json import dumps, json_response
 from utils.init import generate_slug, get_db
 from models import ChatRequest, LikeRequest, ShareWordRequest
 router = APIRouter()
 
+SLUG_LENGTH        = 6
+SLUG_MAX_ATTEMPTS  = 6
+
 
 
 # ===================================================
@@ -24,37 +31,57 @@ async def share_word(request: ShareWordRequest,db=Depends(get_db)):
     if not content:
         raise HTTPException(status_code=400, detail="共有内容が空です")
 
-    slug = generate_slug()
-
     async with db.acquire() as db:
-        # すでに同じ内容が共有済みか確認（ユーザー＋チャット＋内容で重複チェック）
-        existing = await db.fetchval("""
-            SELECT 1 FROM shared_words
-            WHERE user_id = $1 AND chat_id = $2 AND content = $3
-        """, user_id, chat_id, content)
-
-        if existing:
-            raise HTTPException(status_code=409, detail="すでに共有されています")
+        # 重複（ユーザー＋チャット＋content_hash）は一意索引で弾き、slug の衝突は引き直す
+        for attempt in range(SLUG_MAX_ATTEMPTS):
+            slug = generate_slug(SLUG_LENGTH + attempt // 2)   # 衝突が続くなら少し長くする
+            try:
+                inserted = await db.fetchval("""
+                    INSERT INTO shared_words (user_id, chat_id, content, comment, share_slug, created_at)
+                    VALUES ($1, $2, $3, $4, $5, NOW())
+                    ON CONFLICT (user_id, chat_id, content_hash) DO NOTHING
+                    RETURNING share_slug
+                """, user_id, chat_id, content, comment, slug)
+            except asyncpg.UniqueViolationError as e:
+                if e.constraint_name != "shared_words_share_slug_key":
+                    raise
+                continue
+            if inserted is None:
+                raise HTTPException(status_code=409, detail="すでに共有されています")
+            shared_word_cache.invalidate_shared_word(slug)   # ネガティブキャッシュを消す
+            return {"slug": slug, "url": f"/words/{slug}"}
+
+    raise HTTPException(status_code=503, detail="共有URLの発行に失敗しました。もう一度お試しください")
+
+# - /words/{slug}: スラッグで1つ取得（プロセス内 LRU → DB、ETag / Cache-Control 付き）
+@router.get("/words/{slug}")
+async def get_shared_word(slug: str, request: Request, db=Depends(get_db)):
+    cached = shared_word_cache.get_cached(slug)
+    if cached is None:
+        async with db.acquire() as db:
+            row = await db.fetchrow("""
+                SELECT content, user_id, created_at FROM shared_words
+                WHERE share_slug = $1
+            """, slug)
+        if not row:
+            shared_word_cache.store_not_found(slug)
+            cached = shared_word_cache.NOT_FOUND
+        else:
+            cached = shared_word_cache.store(slug, dumps(
+                {"content": row["content"], "user_id": row["user_id"], "created_at": row["created_at"]}
+            ))
 
-        # 共有データを保存（comment カラム含むように変更）
-        await db.execute("""
-            INSERT INTO shared_words (user_id, chat_id, content, comment, share_slug, created_at)
-            VALUES ($1, $2, $3, $4, $5, NOW())
-        """, user_id, chat_id, content, comment, slug)
+    if cached == shared_word_cache.NOT_FOUND:
+        raise HTTPException(
+            status_code=404, detail="共有された言葉が見つかりません",
+            headers={"Cache-Control": f"public, max-age={shared_word_cache.SHARED_WORD_NEGATIVE_TTL}"},
+        )
 
-    return {"slug": slug, "url": f"/words/{slug}"}
-
-# - /words/{slug}: スラッグで1つ取得
-@router.get("/words/{slug}")
-async def get_shared_word(slug: str,db=Depends(get_db)):
-    async with db.acquire() as db:
-        row = await db.fetchrow("""
-            SELECT content, user_id, created_at FROM shared_words
-            WHERE share_slug = $1
-        """, slug)
-    if not row:
-        raise HTTPException(status_code=404, detail="共有された言葉が見つかりません")
-    return {"content": row["content"], "user_id": row["user_id"], "created_at": row["created_at"]}
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={shared_word_cache.SHARED_WORD_MAX_AGE}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # 🔽 /shared_words/all（コメント・いいね数付き）
@@ -70,7 +97,14 @@ async def get_all_shared_words(db=Depends(get_db)):
             ORDER BY s.created_at DESC
             LIMIT 100
         """)
-    return [dict(row) for row in rows]
+    return json_response(rows)
+
+# 🔽 /shared_words/trending（急上昇順。メモリの上位 K 件から切り出す）
+@router.get("/shared_words/trending")
+async def get_trending_shared_words(offset: int = Query(0, ge=0),
+                                    limit: int = Query(20, ge=1, le=trending.TRENDING_PAGE_MAX),
+                                    db=Depends(get_db)):
+    return json_response(await trending.trending_page(db, offset, limit))
 
 # 🔽 /shared_words/user/{user_id}（コメント・いいね数付き）
 @router.get("/shared_words/user/{user_id}")
@@ -85,7 +119,7 @@ async def get_user_shared_words(user_id: str,db=Depends(get_db)):
             GROUP BY s.id
             ORDER BY s.created_at DESC
         """, user_id)
-    return [dict(row) for row in rows]
+    return json_response(rows)
 
 
 
@@ -99,26 +133,30 @@ async def toggle_like(slug: str, request: LikeRequest,db=Depends(get_db)):
     user_id = str(uuid.UUID(request.user_id))
 
     async with db.acquire() as db:
-        shared_word = await db.fetchrow("""
-            SELECT id FROM shared_words WHERE share_slug = $1
-        """, slug)
-        if not shared_word:
-            raise HTTPException(status_code=404, detail="共有された言葉が見つかりません")
-
-        shared_id = shared_word["id"]
+        async with db.transaction():
+            shared_word = await db.fetchrow("""
+                SELECT id FROM shared_words WHERE share_slug = $1
+            """, slug)
+            if not shared_word:
+                raise HTTPException(status_code=404, detail="共有された言葉が見つかりません")
 
-        exists = await db.fetchval("""
-            SELECT 1 FROM favorites WHERE user_id = $1 AND shared_id = $2
-        """, user_id, shared_id)
+            shared_id = shared_word["id"]
 
-        if exists:
-            await db.execute("""
+            # 取り消すいいねの時刻で、急上昇スコアからその分だけを引く
+            unliked_at = await db.fetchval("""
                 DELETE FROM favorites WHERE user_id = $1 AND shared_id = $2
+                RETURNING created_at
             """, user_id, shared_id)
-            return {"liked": False}
-        else:
-            await db.execute("""
-                INSERT INTO favorites (user_id, shared_id, created_at)
-                VALUES ($1, $2, NOW())
-            """, user_id, shared_id)
-            return {"liked": True}
\ No newline at end of file
+
+            if unliked_at is not None:
+                updated = await trending.record_like(db, shared_id, unliked_at, -1)
+            else:
+                liked_at = await db.fetchval("""
+                    INSERT INTO favorites (user_id, shared_id, created_at)
+                    VALUES ($1, $2, NOW())
+                    RETURNING created_at
+                """, user_id, shared_id)
+                updated = await trending.record_like(db, shared_id, liked_at, +1)
+
+    trending.apply(updated)
+    return {"liked": unliked_at is None}
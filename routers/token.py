@@ -1,20 +1,30 @@
 # token.py
 # -----------------------------------------------
-from datetime import date
+from datetime import date, timedelta
+import json
+import logging
 import os
+import uuid
 
 from fastapi import APIRouter, Depends, Query, Request
 from fastapi.responses import JSONResponse
 
-from utils.init import get_db, reset_daily_if_needed, reward_tokens_for_ad
+from utils import admob
+from utils.fast_json import json_response
+from utils.init import credit_ad_reward, get_db, reset_daily_if_needed, service_today
+from utils.usage_rollup import flush_usage, record_reward, usage_today
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # ─────── 設定値（必要なら .env に移動） ───────
 MAX_FREE_TOKENS_PER_DAY     = 8000      # 無料ユーザー 1 日上限
 MAX_PREMIUM_TOKENS_PER_DAY  = None      # None = 無制限
 TOKENS_ON_AD_WATCH          = 1000       # 広告報酬
+TOKENS_PER_REWARD           = 50         # AdMob の reward_amount 1 あたり
+ADMOB_MAX_REWARD_AMOUNT     = int(os.getenv("ADMOB_MAX_REWARD_AMOUNT", "20"))  # 1 コールバックの上限
 _ADMIN_TOKEN                = os.getenv("ADMIN_TOKEN", "super_secret_token")
+USAGE_HISTORY_MAX_DAYS      = 366        # /usage_history・/admin/usage_summary で遡れる日数
 # -----------------------------------------------
 
 
@@ -82,23 +92,58 @@ async def get_token_status(user_id: str = Query(...), db=Depends(get_db)):
 
 # ────────────────────────────────
 # 2. 広告報酬コールバック（AdMob SSV）
+#    署名検証 → transaction_id で重複排除（メモリ → 台帳）→ 1 文で付与
 # ────────────────────────────────
+def _log_reward(event: str, **fields):
+    logger.info(json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+
 @router.get("/admob/reward")
 async def handle_admob_reward(request: Request, db=Depends(get_db)):
-    params = dict(request.query_params)
-    print("✅ SSV callback:", params)
+    params         = request.query_params
+    transaction_id = params.get("transaction_id")
+    user_id        = params.get("user_id")
+    try:
+        reward_amount = int(params.get("reward_amount", 0))
+        user_id = str(uuid.UUID(user_id)) if user_id else None
+    except ValueError:
+        reward_amount, user_id = 0, None
+
+    if not transaction_id or not user_id or reward_amount <= 0:
+        _log_reward("admob_reward_invalid", transaction_id=transaction_id, user_id=user_id)
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "msg": "Invalid reward"}
+        )
+
+    if admob.seen_recently(transaction_id):
+        _log_reward("admob_reward_duplicate", transaction_id=transaction_id, user_id=user_id, source="memory")
+        return {"status": "ok", "duplicate": True}
+
+    if not await admob.verify_ssv(request.url.query):
+        _log_reward("admob_reward_bad_signature", transaction_id=transaction_id,
+                    user_id=user_id, key_id=params.get("key_id"))
+        return JSONResponse(
+            status_code=403,
+            content={"status": "error", "msg": "Invalid signature"}
+        )
 
-    user_id       = params.get("user_id")
-    reward_amount = int(params.get("reward_amount", 0))
+    if reward_amount > ADMOB_MAX_REWARD_AMOUNT:
+        _log_reward("admob_reward_clamped", transaction_id=transaction_id,
+                    user_id=user_id, reward_amount=reward_amount)
+        reward_amount = ADMOB_MAX_REWARD_AMOUNT
 
-    if not user_id or reward_amount <= 0:
-     return JSONResponse(
-        status_code=400,
-        content={"status": "error", "msg": "Invalid reward"}
-     )
     # 例: 1 reward → 50 トークン * 倍率
-    await reward_tokens_for_ad(user_id, reward_amount * 50, db)
-    return {"status": "ok"}
+    tokens = reward_amount * TOKENS_PER_REWARD
+    result = await credit_ad_reward(db, transaction_id, user_id, reward_amount, tokens)
+    if result == "credited":
+        record_reward(user_id, tokens)
+    admob.remember(transaction_id)
+
+    _log_reward("admob_reward", transaction_id=transaction_id, user_id=user_id,
+                reward_amount=reward_amount, tokens=tokens, result=result,
+                ad_unit=params.get("ad_unit"))
+    return {"status": "ok", "duplicate": result == "duplicate"}
 
 
 # ────────────────────────────────
@@ -112,8 +157,80 @@ async def admin_reset_all(request: Request, db=Depends(get_db)):
     if request.headers.get("X-ADMIN-TOKEN") != _ADMIN_TOKEN:
         return {"status": "unauthorized"}
 
-    today = date.today()
+    # 日次カウンタを消す前に、プロセス内に溜まっている利用量をロールアップへ書き出す
+    try:
+        await flush_usage(db)
+    except Exception as e:
+        print("⚠️ リセット前の利用量 flush 失敗（次回に持ち越し）:", e)
+
+    today = service_today()
     async with db.acquire() as conn:
         await _reset_all_tokens(conn, today)
 
     return {"status": "ok", "date": today.isoformat()}
+
+
+# ────────────────────────────────
+# 4. ユーザー用: 日ごとの利用履歴（usage_daily のみ参照）
+#    直近 USAGE_FLUSH_SEC 秒の利用はまだ反映されていないことがある
+# ────────────────────────────────
+@router.get("/usage_history")
+async def get_usage_history(user_id: str = Query(...),
+                            days: int = Query(30, ge=1, le=USAGE_HISTORY_MAX_DAYS),
+                            db=Depends(get_db)):
+    try:
+        user_id = str(uuid.UUID(user_id))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"detail": "無効なUUID形式のuser_idです。"})
+
+    since = usage_today() - timedelta(days=days - 1)
+    rows = await db.fetch("""
+        SELECT day,
+               sum(tokens_used)     AS tokens_used,
+               sum(tokens_rewarded) AS tokens_rewarded,
+               sum(chat_count)      AS chat_count,
+               sum(message_count)   AS message_count
+        FROM usage_daily
+        WHERE user_id = $1 AND day >= $2
+        GROUP BY day
+        ORDER BY day DESC
+    """, user_id, since)
+    return json_response({"user_id": user_id, "since": since, "days": rows})
+
+
+# ────────────────────────────────
+# 5. 管理者: 期間の利用量集計（容量計画用、usage_daily のみ参照）
+# ────────────────────────────────
+@router.get("/admin/usage_summary")
+async def admin_usage_summary(request: Request,
+                              days: int = Query(30, ge=1, le=USAGE_HISTORY_MAX_DAYS),
+                              db=Depends(get_db)):
+    if request.headers.get("X-ADMIN-TOKEN") != _ADMIN_TOKEN:
+        return {"status": "unauthorized"}
+
+    since = usage_today() - timedelta(days=days - 1)
+    async with db.acquire() as conn:
+        daily = await conn.fetch("""
+            SELECT day,
+                   count(DISTINCT user_id) FILTER (WHERE message_count > 0) AS active_users,
+                   sum(tokens_used)       AS tokens_used,
+                   sum(tokens_rewarded)   AS tokens_rewarded,
+                   sum(chat_count)        AS chat_count,
+                   sum(message_count)     AS message_count
+            FROM usage_daily
+            WHERE day >= $1
+            GROUP BY day
+            ORDER BY day DESC
+        """, since)
+        by_model = await conn.fetch("""
+            SELECT model,
+                   sum(message_count)     AS message_count,
+                   sum(prompt_tokens)     AS prompt_tokens,
+                   sum(cached_tokens)     AS cached_tokens,
+                   sum(completion_tokens) AS completion_tokens
+            FROM usage_daily
+            WHERE day >= $1 AND model <> ''
+            GROUP BY model
+            ORDER BY model
+        """, since)
+    return json_response({"status": "ok", "since": since, "daily": daily, "models": by_model})
@@ -1,9 +1,10 @@
 import uuid
 from fastapi import Depends, HTTPException
-import supabase
 from models import DeleteUserRequest
 from fastapi import APIRouter
-from utils.init import get_db 
+from utils.fast_json import json_response
+from utils.init import get_db
+from utils.purge import enqueue_purge, get_purge_job
 router = APIRouter()
 
 
@@ -12,13 +13,18 @@ async def get_user_chats(user_id: str,db=Depends(get_db)):
     try:
         user_id = str(uuid.UUID(user_id))
         async with db.acquire() as db:
+            # 退避済みのチャットも一覧には出す（開けば utils/archive.py が書き戻す）
             chats = await db.fetch("""
                 SELECT id, created_at, question
                 FROM conversations
                 WHERE user_id = $1 AND is_root = true
+                UNION ALL
+                SELECT chat_id, root_created_at, root_question
+                FROM conversation_archives
+                WHERE user_id = $1
                 ORDER BY created_at DESC
             """, user_id)
-        return {"user_id": user_id, "chats": chats}
+        return json_response({"user_id": user_id, "chats": chats})
     except ValueError:
         raise HTTPException(status_code=400, detail="無効なUUID形式のuser_idです。")
 
@@ -28,11 +34,28 @@ async def get_user_chats(user_id: str,db=Depends(get_db)):
 
 
 
+# 削除はジョブを積むだけ（Auth・DB・ストレージの実削除は utils/purge.py のワーカー）
 @router.post("/api/delete_user")
-async def delete_user(req: DeleteUserRequest):
+async def delete_user(req: DeleteUserRequest, db=Depends(get_db)):
     try:
-        supabase.auth.admin.delete_user(req.user_id)
-        return {"status": "success", "message": "User deleted"}
+        user_id = str(uuid.UUID(req.user_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なUUID形式のuser_idです。")
+    try:
+        job_id = await enqueue_purge(db, user_id)
+        return {"status": "success", "message": "User deletion scheduled", "job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete user: {str(e)}")
 
+
+@router.get("/api/delete_user/{job_id}")
+async def get_delete_user_status(job_id: str, db=Depends(get_db)):
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無効なUUID形式のjob_idです。")
+    job = await get_purge_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="削除ジョブが見つかりません。")
+    return job
+
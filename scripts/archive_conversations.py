@@ -0,0 +1,95 @@
+# scripts/archive_conversations.py
+# ─────────────────────────────
+# conversations のメンテナンス（cron / 手動で回す）
+#   1) --null-vectors : ゼロ埋めの埋め込みを主キー順にバッチで NULL にする
+#   2) --archive      : 最終発言から --inactive-days 日たったチャットを chat-archives へ退避
+#   3) --vacuum       : 最後に VACUUM (ANALYZE) conversations（領域を再利用可能にする）
+#   退避したチャットは /chat/{chat_id} や次の /chat で自動的に書き戻される（utils/archive.py）。
+#   このスクリプトはサーバーとは別プロセスなので、サーバーの履歴キャッシュ（utils/history_cache.py）は消せない。
+#   そのため最終発言から HISTORY_CACHE_IDLE_SEC 以内のチャットは --inactive-days に関係なく見送る。
+#
+# 使い方:
+#   python -m scripts.archive_conversations --null-vectors
+#   python -m scripts.archive_conversations --archive --inactive-days 90 --max-chats 5000
+#   python -m scripts.archive_conversations --archive --dry-run
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import asyncpg
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.archive import ArchiveConflict, archive_chat, find_inactive_chats, null_placeholder_vectors  # noqa: E402
+
+ARCHIVE_SCAN_BATCH = 200     # 1 回の集計で拾う退避候補チャット数
+
+
+async def _archive(pool, inactive_days: int, max_chats: int, dry_run: bool) -> None:
+    chats = rows = skipped = 0
+    seen = set()     # 見送り・失敗したチャットは次の集計から外す
+    while chats + skipped < max_chats:
+        candidates = await find_inactive_chats(pool, inactive_days, ARCHIVE_SCAN_BATCH, exclude=seen)
+        if not candidates:
+            break
+        for c in candidates[:max_chats - chats - skipped]:
+            if dry_run:
+                print(f"  {c['chat_id']} (user {c['user_id']}, 最終 {c['last_message_at']:%Y-%m-%d})")
+                chats += 1
+                continue
+            try:
+                rows += await archive_chat(pool, c["chat_id"], c["user_id"])
+                chats += 1
+            except ArchiveConflict:
+                seen.add(c["chat_id"])
+                skipped += 1
+            except Exception as e:
+                print(f"❌ 退避失敗 {c['chat_id']}: {e}")
+                seen.add(c["chat_id"])
+                skipped += 1
+        if dry_run:
+            break
+    label = "退避候補" if dry_run else "退避"
+    print(f"📦 {label} {chats} チャット / {rows} 行（スキップ {skipped}）")
+
+
+async def main_async(args) -> None:
+    pool = await asyncpg.create_pool(args.database_url, statement_cache_size=0, max_size=2)
+    try:
+        if args.null_vectors:
+            started = time.perf_counter()
+            n = await null_placeholder_vectors(pool, args.batch)
+            print(f"🧹 埋め込み NULL 化 {n} 行（{time.perf_counter() - started:.1f}s）")
+        if args.archive:
+            await _archive(pool, args.inactive_days, args.max_chats, args.dry_run)
+        if args.vacuum and not args.dry_run:
+            await pool.execute("VACUUM (ANALYZE) conversations")
+            print("🧹 VACUUM (ANALYZE) conversations 完了")
+    finally:
+        await pool.close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="conversations の圧縮・コールド退避")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    ap.add_argument("--null-vectors", action="store_true", help="ゼロ埋めの埋め込みを NULL にする")
+    ap.add_argument("--batch", type=int, default=2000, help="NULL 化の 1 UPDATE あたりの行数")
+    ap.add_argument("--archive", action="store_true", help="非アクティブなチャットを退避する")
+    ap.add_argument("--inactive-days", type=int, default=90)
+    ap.add_argument("--max-chats", type=int, default=1000, help="1 回の実行で退避する最大チャット数")
+    ap.add_argument("--dry-run", action="store_true", help="退避候補を表示するだけ")
+    ap.add_argument("--vacuum", action="store_true")
+    args = ap.parse_args(argv)
+
+    if not args.database_url:
+        sys.exit("❌ --database-url（または DATABASE_URL）を指定してください。")
+    if not (args.null_vectors or args.archive or args.vacuum):
+        ap.error("--null-vectors / --archive / --vacuum のいずれかを指定してください。")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+-- sql/001_user_purge_jobs.sql
+-- ─────────────────────────────
+-- /api/delete_user のバックグラウンド削除ジョブ（進捗・再開用）
+
+CREATE TABLE IF NOT EXISTS user_purge_jobs (
+    id           uuid PRIMARY KEY,
+    user_id      uuid NOT NULL,
+    status       text NOT NULL DEFAULT 'pending',   -- pending / running / done / failed
+    step         text,                              -- 処理中（再開位置）のステップ名
+    deleted      jsonb NOT NULL DEFAULT '{}'::jsonb, -- ステップごとの削除件数
+    attempts     integer NOT NULL DEFAULT 0,
+    last_error   text,
+    created_at   timestamptz NOT NULL DEFAULT now(),
+    updated_at   timestamptz NOT NULL DEFAULT now(),
+    finished_at  timestamptz
+);
+
+-- 1 ユーザーにつき未完了ジョブは 1 つだけ
+CREATE UNIQUE INDEX IF NOT EXISTS user_purge_jobs_active_idx
+    ON user_purge_jobs (user_id) WHERE status IN ('pending', 'running');
+CREATE INDEX IF NOT EXISTS user_purge_jobs_queue_idx
+    ON user_purge_jobs (created_at) WHERE status IN ('pending', 'running');
+
+-- バッチ削除で user_id から引けるように
+CREATE INDEX IF NOT EXISTS conversations_user_id_idx ON conversations (user_id);
+CREATE INDEX IF NOT EXISTS favorites_user_id_idx     ON favorites (user_id);
+CREATE INDEX IF NOT EXISTS shared_words_user_id_idx  ON shared_words (user_id);
+CREATE INDEX IF NOT EXISTS daily_draws_user_id_idx   ON daily_draws (user_id);
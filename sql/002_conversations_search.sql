@@ -0,0 +1,11 @@
+-- sql/002_conversations_search.sql
+-- ─────────────────────────────
+-- /search 用：会話本文のトライグラム索引
+--   日本語は単語区切りが無いので、全文検索ではなく pg_trgm の ILIKE 索引を使う。
+--   式は routers/search.py の SEARCH_EXPR と完全に一致させること（一致しないと索引が効かない）。
+--   ※ DB の LC_CTYPE が C だとマルチバイト文字がトライグラム化されないので UTF-8 ロケールが前提。
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS conversations_search_trgm_idx
+    ON conversations USING gin ((question || E'\n' || answer) gin_trgm_ops);
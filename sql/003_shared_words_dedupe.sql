@@ -0,0 +1,19 @@
+-- sql/003_shared_words_dedupe.sql
+-- ─────────────────────────────
+-- /share_word を 1 往復にするための索引
+--   content_hash: 本文の md5（生成列なのでアプリ側で計算しなくてよい）
+--   (user_id, chat_id, content_hash) の一意索引で重複共有を ON CONFLICT で弾く
+--   share_slug の一意索引で slug の衝突を検出して引き直す
+--
+-- ※ 既存データに重複があると索引作成に失敗する。事前に確認:
+--   SELECT user_id, chat_id, md5(content), count(*) FROM shared_words GROUP BY 1, 2, 3 HAVING count(*) > 1;
+--   SELECT share_slug, count(*) FROM shared_words GROUP BY 1 HAVING count(*) > 1;
+
+ALTER TABLE shared_words
+    ADD COLUMN IF NOT EXISTS content_hash text GENERATED ALWAYS AS (md5(content)) STORED;
+
+CREATE UNIQUE INDEX IF NOT EXISTS shared_words_dedupe_idx
+    ON shared_words (user_id, chat_id, content_hash);
+
+CREATE UNIQUE INDEX IF NOT EXISTS shared_words_share_slug_key
+    ON shared_words (share_slug);
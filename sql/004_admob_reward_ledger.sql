@@ -0,0 +1,14 @@
+-- sql/004_admob_reward_ledger.sql
+-- ─────────────────────────────
+-- AdMob SSV コールバックの台帳（transaction_id で冪等化）
+--   AdMob は同じコールバックを再送するので、主キー衝突 = 付与済みとして扱う。
+
+CREATE TABLE IF NOT EXISTS admob_reward_ledger (
+    transaction_id  text PRIMARY KEY,
+    user_id         uuid NOT NULL,
+    reward_amount   integer NOT NULL,
+    tokens          integer NOT NULL,
+    created_at      timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS admob_reward_ledger_user_id_idx ON admob_reward_ledger (user_id);
@@ -0,0 +1,10 @@
+-- sql/005_conversations_usage.sql
+-- ─────────────────────────────
+-- 1 ターンごとのトークン内訳（プロンプトキャッシュの効き具合を追うため）
+--   prompt_tokens のうち cached_tokens がプロバイダ側キャッシュに載った分。
+
+ALTER TABLE conversations
+    ADD COLUMN IF NOT EXISTS prompt_tokens      integer,
+    ADD COLUMN IF NOT EXISTS cached_tokens      integer,
+    ADD COLUMN IF NOT EXISTS completion_tokens  integer,
+    ADD COLUMN IF NOT EXISTS prompt_version     text;
@@ -0,0 +1,21 @@
+-- sql/006_conversation_archives.sql
+-- ─────────────────────────────
+-- しばらく動きのないチャットを conversations から外してストレージ（chat-archives）へ退避する。
+--   退避・復元は scripts/archive_conversations.py と utils/archive.py。
+--   一覧（/user_chats）に出し続けるため、ルートの質問と作成日時だけはこちらに残す。
+
+CREATE TABLE IF NOT EXISTS conversation_archives (
+    chat_id          uuid PRIMARY KEY,
+    user_id          uuid NOT NULL,
+    object_path      text NOT NULL,            -- chat-archives 内のパス（gzip 済み JSON）
+    row_count        integer NOT NULL,
+    root_question    text,
+    root_created_at  timestamptz,
+    last_message_at  timestamptz NOT NULL,
+    archived_at      timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS conversation_archives_user_idx
+    ON conversation_archives (user_id, root_created_at DESC);
+
+-- 埋め込みはまだ使っていない（全部ゼロ）ので、プレースホルダは NULL にして持たない
+ALTER TABLE conversations ALTER COLUMN embedding DROP NOT NULL;
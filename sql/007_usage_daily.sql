@@ -0,0 +1,22 @@
+-- sql/007_usage_daily.sql
+-- ─────────────────────────────
+-- ユーザー × 日 × モデルの利用量ロールアップ
+--   user_tokens の日次カウンタはリセットで消えるので、こちらに日ごとに積み上げて残す。
+--   書き込みは utils/usage_rollup.py がまとめて加算する（生の conversations は読まない）。
+
+CREATE TABLE IF NOT EXISTS usage_daily (
+    user_id            uuid    NOT NULL,
+    day                date    NOT NULL,
+    model              text    NOT NULL DEFAULT '',   -- 広告報酬など、モデルに紐づかない分は ''
+    tokens_used        bigint  NOT NULL DEFAULT 0,    -- user_tokens から差し引いた分
+    tokens_rewarded    bigint  NOT NULL DEFAULT 0,
+    chat_count         integer NOT NULL DEFAULT 0,    -- 新規チャット数
+    message_count      integer NOT NULL DEFAULT 0,    -- 回答したターン数
+    prompt_tokens      bigint  NOT NULL DEFAULT 0,
+    cached_tokens      bigint  NOT NULL DEFAULT 0,
+    completion_tokens  bigint  NOT NULL DEFAULT 0,
+    updated_at         timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, day, model)
+);
+-- 管理画面の期間集計用
+CREATE INDEX IF NOT EXISTS usage_daily_day_idx ON usage_daily (day);
@@ -0,0 +1,18 @@
+-- sql/008_idempotency_keys.sql
+-- ─────────────────────────────
+-- /chat /new_chat の Idempotency-Key（再送・二度押しで同じ回答を返すため）
+--   running の間は expires_at を短いリースにしておき、プロセスが落ちても固まらないようにする。
+--   done になったら IDEMPOTENCY_TTL_SEC だけ結果を保持する。
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id      text        NOT NULL,
+    route        text        NOT NULL,
+    key          text        NOT NULL,
+    fingerprint  text        NOT NULL,              -- リクエスト本文のハッシュ（別内容での使い回し検出）
+    status       text        NOT NULL DEFAULT 'running',   -- running / done
+    response     jsonb,
+    created_at   timestamptz NOT NULL DEFAULT now(),
+    expires_at   timestamptz NOT NULL,
+    PRIMARY KEY (user_id, route, key)
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_idx ON idempotency_keys (expires_at);
@@ -0,0 +1,32 @@
+-- sql/009_shared_words_trending.sql
+-- ─────────────────────────────
+-- 共有された言葉の「急上昇」スコア（utils/trending.py）
+--   trend_score = Σ exp((いいねした時刻 - trending_state.epoch) / τ)   τ = 半減期 / ln2
+--   いいね・取り消しのたびに 1 項だけ足し引きする。epoch は定期的に進めて全体を縮める（rebase）。
+
+CREATE TABLE IF NOT EXISTS trending_state (
+    id     boolean PRIMARY KEY DEFAULT true CHECK (id),   -- 1 行だけ
+    epoch  timestamptz NOT NULL DEFAULT now()
+);
+INSERT INTO trending_state (id) VALUES (true) ON CONFLICT (id) DO NOTHING;
+
+ALTER TABLE shared_words
+    ADD COLUMN IF NOT EXISTS trend_score double precision NOT NULL DEFAULT 0;
+
+-- 上位 K 件の読み直し用（スコアが 0 の大半の行は索引に入れない）
+CREATE INDEX IF NOT EXISTS shared_words_trend_score_idx
+    ON shared_words (trend_score DESC) WHERE trend_score > 0;
+
+-- favorites.shared_id の索引が無ければ、取り消し・再計算のたびに全件走査になる
+CREATE INDEX IF NOT EXISTS favorites_shared_id_idx ON favorites (shared_id);
+
+-- 既存のいいねから初期値を入れる。124648.85 = 24 時間（TRENDING_HALF_LIFE_HOURS の既定値）/ ln2
+-- exp は桁あふれ・アンダーフローでエラーになるので指数を ±700 に収める
+UPDATE shared_words s SET trend_score = t.score
+FROM (
+    SELECT f.shared_id,
+           SUM(exp(GREATEST(LEAST(extract(epoch FROM f.created_at - st.epoch) / 124648.85, 700), -700))) AS score
+    FROM favorites f CROSS JOIN trending_state st
+    GROUP BY f.shared_id
+) t
+WHERE s.id = t.shared_id;
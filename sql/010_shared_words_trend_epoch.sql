@@ -0,0 +1,20 @@
+-- sql/010_shared_words_trend_epoch.sql
+-- ─────────────────────────────
+-- 急上昇スコアの基準時刻を行ごとに持つ（utils/trending.py）
+--   trend_score = Σ exp((いいねした時刻 - trend_epoch) / τ)
+--   いいねは trending_state.epoch をロックせずに読み、行を自分の trend_epoch から換算して足し引きする。
+--   rebase は trending_state.epoch を進めたあと、古い trend_epoch の行を小さなバッチで換算していく
+--   （途中の行は古い基準のままでも値として正しい）。
+
+-- now() は stable なので既存行の書き換えは起きない。スコア 0 の行の基準時刻は何でもよい
+ALTER TABLE shared_words
+    ADD COLUMN IF NOT EXISTS trend_epoch timestamptz NOT NULL DEFAULT now();
+
+-- これまでのスコアはすべて trending_state.epoch 基準
+UPDATE shared_words s SET trend_epoch = st.epoch
+FROM trending_state st
+WHERE s.trend_score > 0 AND s.trend_epoch <> st.epoch;
+
+-- rebase の「まだ換算していない行」と、読み直し時の取り残し分を引く用
+CREATE INDEX IF NOT EXISTS shared_words_trend_epoch_idx
+    ON shared_words (trend_epoch) WHERE trend_score > 0;
@@ -0,0 +1,6 @@
+# tests/conftest.py
+# リポジトリ直下を import パスに入れる（bench/ と同じく、パッケージ化していないため）
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
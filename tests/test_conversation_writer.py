@@ -0,0 +1,103 @@
+# tests/test_conversation_writer.py
+# conversations の write-behind（utils/conversation_writer.py）
+#   書き込みの途中で止められた・接続が切れたときに、バッファの行を失わないこと。
+import asyncio
+
+import asyncpg
+import pytest
+
+from utils import conversation_writer as writer
+
+USAGE = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "prefix_version": "v1"}
+
+
+def _row(n):
+    return writer.make_row(f"00000000-0000-0000-0000-{n:012d}", "chat-1", "user-1", f"q{n}", f"a{n}",
+                           n == 0, USAGE)
+
+
+class FakeConn:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def executemany(self, sql, args):
+        await self.db.on_write(len(args))
+        self.db.written.extend(a[0] for a in args)
+
+    async def execute(self, sql, *args):
+        await self.db.on_write(1)
+        self.db.written.append(args[0])
+
+
+class FakeDB:
+    def __init__(self, on_write):
+        self.on_write, self.written = on_write, []
+
+    def acquire(self):
+        return FakeConn(self)
+
+
+@pytest.fixture(autouse=True)
+def _clean():
+    writer._pending.clear()
+    writer._pending_by_chat.clear()
+    yield
+    writer._pending.clear()
+    writer._pending_by_chat.clear()
+
+
+def _fill(n):
+    for i in range(n):
+        row = _row(i)
+        writer._pending.append(row)
+        writer._pending_by_chat.setdefault(writer._key(row["chat_id"]), []).append(row)
+
+
+def test_cancel_during_batch_write_keeps_rows():
+    _fill(3)
+
+    async def hang(n):
+        await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(writer.flush_conversations(FakeDB(hang)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert [r["question"] for r in writer._pending] == ["q0", "q1", "q2"]
+
+
+def test_connection_error_keeps_rows():
+    _fill(2)
+
+    async def broken(n):
+        raise asyncpg.ConnectionDoesNotExistError("connection was closed")
+
+    assert asyncio.run(writer.flush_conversations(FakeDB(broken))) == 0
+    assert len(writer._pending) == 2
+
+
+def test_data_error_drops_only_the_bad_row():
+    _fill(3)
+    calls = []
+
+    async def one_bad(n):
+        calls.append(n)
+        if n > 1:
+            raise asyncpg.DataError("invalid input")
+        if len(calls) == 3:     # 1 行ずつの 2 行目
+            raise asyncpg.DataError("invalid input")
+
+    db = FakeDB(one_bad)
+    assert asyncio.run(writer.flush_conversations(db)) == 3
+    assert writer._pending == []
+    assert len(db.written) == 2
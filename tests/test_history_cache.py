@@ -0,0 +1,86 @@
+# tests/test_history_cache.py
+# _prepare_history 用の履歴キャッシュ（utils/history_cache.py）
+#   DB 読み込み（_fetch_history_rows）と保存（record_turn）の入れ違いを、フェイクの DB で再現する。
+import asyncio
+import uuid
+
+import pytest
+
+from utils import ai_response, history_cache
+
+WINDOW = 4
+
+
+def _row(chat_id, n, is_root=False):
+    return {"id": str(uuid.uuid4()), "chat_id": chat_id, "question": f"q{n}", "answer": f"a{n}",
+            "is_root": is_root}
+
+
+class SlowHistoryDB:
+    """_HISTORY_SQL の結果を返す。返す直前に during() を呼んで、読み込み中の書き込みを差し込む"""
+
+    def __init__(self, rows, during=None):
+        self.rows, self.during = rows, during
+
+    async def fetch(self, sql, chat_id, window):
+        snapshot = list(self.rows[-window:])
+        await asyncio.sleep(0)
+        if self.during:
+            self.during()
+        return snapshot
+
+
+@pytest.fixture(autouse=True)
+def _clean():
+    history_cache.clear()
+    yield
+    history_cache.clear()
+
+
+def test_write_during_fetch_is_not_overwritten_by_stale_rows():
+    chat_id = str(uuid.uuid4())
+    rows = [_row(chat_id, 0, is_root=True), _row(chat_id, 1)]
+    newer = _row(chat_id, 2)
+    db = SlowHistoryDB(rows, during=lambda: history_cache.record_turn(newer))
+
+    got = asyncio.run(ai_response._fetch_history_rows(db, chat_id, WINDOW))
+
+    assert [r["id"] for r in got] == [r["id"] for r in rows]
+    # 古い読み込み結果はキャッシュされず、次回は DB から読み直す
+    assert history_cache.get_turns(chat_id, WINDOW) is None
+
+
+def test_fetch_without_concurrent_write_is_cached():
+    chat_id = str(uuid.uuid4())
+    rows = [_row(chat_id, 0, is_root=True), _row(chat_id, 1)]
+
+    asyncio.run(ai_response._fetch_history_rows(SlowHistoryDB(rows), chat_id, WINDOW))
+
+    assert [r["id"] for r in history_cache.get_turns(chat_id, WINDOW)] == [r["id"] for r in rows]
+
+
+def test_new_chat_is_capped_at_the_configured_turns(monkeypatch):
+    monkeypatch.setattr(history_cache, "HISTORY_CACHE_MAX_TURNS", WINDOW)
+    chat_id = str(uuid.uuid4())
+    history_cache.record_turn(_row(chat_id, 0, is_root=True))
+    for n in range(1, WINDOW + 3):
+        history_cache.record_turn(_row(chat_id, n))
+
+    turns = history_cache.get_turns(chat_id, WINDOW)
+    assert [t["question"] for t in turns] == [f"q{n}" for n in range(3, WINDOW + 3)]
+    # ルートを落としたので、窓より長い履歴は DB から読む
+    assert history_cache.get_turns(chat_id, WINDOW + 1) is None
+
+
+def test_small_window_read_does_not_shrink_other_chats(monkeypatch):
+    monkeypatch.setattr(history_cache, "HISTORY_CACHE_MAX_TURNS", 2)
+    wide = str(uuid.uuid4())
+    rows = [_row(wide, 0, is_root=True)] + [_row(wide, n) for n in range(1, WINDOW)]
+    history_cache.store_turns(wide, rows, complete=True, window=WINDOW)
+
+    history_cache.get_turns(str(uuid.uuid4()), 1)
+    history_cache.record_turn(_row(wide, WINDOW))
+
+    # 窓の分（WINDOW）を持ち続けるので、広い窓の読み出しもキャッシュから返る
+    turns = history_cache.get_turns(wide, WINDOW)
+    assert [t["question"] for t in turns] == [f"q{n}" for n in range(1, WINDOW + 1)]
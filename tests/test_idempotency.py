@@ -0,0 +1,139 @@
+# tests/test_idempotency.py
+# Idempotency-Key の重複排除（utils/idempotency.py）
+#   Postgres を使わず、idempotency_keys の振る舞いだけを真似たフェイクの上で動かす。
+#   モデル呼び出しはスタブで、呼ばれた回数だけを数える。
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from utils import idempotency
+from utils.cache import LRUCache
+
+USER = "00000000-0000-0000-0000-000000000001"
+
+
+class FakeKeysDB:
+    """idempotency.py が投げる SQL を、キーワードで見分けて辞書に対して実行する"""
+
+    def __init__(self):
+        self.rows = {}
+
+    async def fetchval(self, sql, user_id, route, key, fp, lease):
+        await asyncio.sleep(0)      # 他のコルーチンに割り込ませる
+        assert "INSERT INTO idempotency_keys" in sql
+        row = self.rows.get((user_id, route, key))
+        if row is not None and row["expires_at"] >= time.monotonic():
+            return None
+        self.rows[(user_id, route, key)] = {"fingerprint": fp, "status": "running", "response": None,
+                                            "expires_at": time.monotonic() + lease}
+        return 1
+
+    async def fetchrow(self, sql, user_id, route, key):
+        await asyncio.sleep(0)
+        row = self.rows.get((user_id, route, key))
+        return dict(row) if row else None
+
+    async def execute(self, sql, user_id, route, key, *args):
+        await asyncio.sleep(0)
+        row = self.rows.get((user_id, route, key))
+        if sql.lstrip().startswith("DELETE"):
+            self.rows.pop((user_id, route, key), None)
+        elif "status = 'done'" in sql and row:
+            row.update(status="done", response=args[0], expires_at=time.monotonic() + args[1])
+        elif row and row["status"] == "running":
+            row["expires_at"] = time.monotonic() + args[0]
+
+
+class StubModel:
+    def __init__(self, delay=0.05, fail=False):
+        self.calls = 0
+        self.delay = delay
+        self.fail = fail
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("model error")
+        return {"chat_id": "c1", "answer": f"answer {self.calls}"}
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(idempotency, "_done", LRUCache(100))
+    monkeypatch.setattr(idempotency, "_inflight", {})
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_POLL_SEC", 0.01)
+
+
+def test_concurrent_duplicates_make_one_model_call():
+    db, model = FakeKeysDB(), StubModel()
+    fp = idempotency.fingerprint({"question": "q"})
+
+    async def run():
+        return await asyncio.gather(*[
+            idempotency.run_idempotent(db, "chat", USER, "key-1", fp, model) for _ in range(20)
+        ])
+
+    results = asyncio.run(run())
+    assert model.calls == 1
+    assert all(result == results[0][0] for result, _ in results)
+    assert sum(replayed for _, replayed in results) == 19
+
+
+def test_duplicates_on_another_replica_make_one_model_call():
+    # プロセス内の待ち合わせを通さず、DB の行だけで排他されることを確かめる
+    db, model = FakeKeysDB(), StubModel()
+    fp = idempotency.fingerprint({"question": "q"})
+
+    async def run():
+        return await asyncio.gather(*[
+            idempotency._run_owned(db, "chat", USER, "key-1", fp, model) for _ in range(5)
+        ])
+
+    results = asyncio.run(run())
+    assert model.calls == 1
+    assert sum(replayed for _, _, replayed in results) == 4
+
+
+def test_same_key_with_different_body_is_rejected():
+    db, model = FakeKeysDB(), StubModel(delay=0)
+
+    async def run():
+        await idempotency.run_idempotent(db, "chat", USER, "key-1", "fp-a", model)
+        await idempotency.run_idempotent(db, "chat", USER, "key-1", "fp-b", model)
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(run())
+    assert e.value.status_code == 422
+    assert model.calls == 1
+
+
+def test_failed_request_releases_the_key():
+    db, failing, ok = FakeKeysDB(), StubModel(delay=0, fail=True), StubModel(delay=0)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await idempotency.run_idempotent(db, "chat", USER, "key-1", "fp", failing)
+        return await idempotency.run_idempotent(db, "chat", USER, "key-1", "fp", ok)
+
+    result, replayed = asyncio.run(run())
+    assert (failing.calls, ok.calls, replayed) == (1, 1, False)
+
+
+def test_lease_is_renewed_while_the_model_runs(monkeypatch):
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_LEASE_SEC", 0.1)
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_RENEW_SEC", 0.02)
+    db, model = FakeKeysDB(), StubModel(delay=0.3)
+    fp = idempotency.fingerprint({"question": "q"})
+
+    async def run():
+        first = asyncio.create_task(idempotency._run_owned(db, "chat", USER, "key-1", fp, model))
+        await asyncio.sleep(0.2)    # リース（0.1 秒）を過ぎても、延長されていれば奪えない
+        second = await idempotency._run_owned(db, "chat", USER, "key-1", fp, model)
+        return await first, second
+
+    first, second = asyncio.run(run())
+    assert model.calls == 1
+    assert second[2] is True
@@ -0,0 +1,82 @@
+# tests/test_rate_limit.py
+# レートリミッタ（utils/rate_limit.py）
+#   後段はボディを全部読んでエコーするだけの ASGI アプリ。バケットはメモリ版。
+import asyncio
+import json
+import uuid
+
+from utils import rate_limit
+
+IP_A = "203.0.113.10"
+CHAT_BURST = 5      # ROUTE_LIMITS の /chat
+
+
+async def echo_app(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _call(mw, payload=None, chunks=None, ip=IP_A):
+    chunks = chunks if chunks is not None else [json.dumps(payload).encode()]
+    incoming = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+                for i, c in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/chat", "query_string": b"",
+             "headers": [(b"x-forwarded-for", ip.encode())], "client": ("10.0.0.1", 1234)}
+    asyncio.run(mw(scope, receive, send))
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:]), incoming
+
+
+def test_one_user_behind_a_shared_ip_gets_the_per_user_budget():
+    mw = rate_limit.RateLimitMiddleware(echo_app, rate_limit.MemoryBuckets())
+    heavy, other = str(uuid.uuid4()), str(uuid.uuid4())
+
+    statuses = [_call(mw, {"user_id": heavy})[0] for _ in range(CHAT_BURST + 1)]
+    assert statuses == [200] * CHAT_BURST + [429]
+    # 大文字にしても同じバケット
+    assert _call(mw, {"user_id": heavy.upper()})[0] == 429
+    # 同じ IP の別のユーザーはまだ通る
+    assert _call(mw, {"user_id": other})[0] == 200
+
+
+def test_rotating_user_id_does_not_escape_the_ip_bucket():
+    mw = rate_limit.RateLimitMiddleware(echo_app, rate_limit.MemoryBuckets())
+    ip_burst = CHAT_BURST * rate_limit.RATE_LIMIT_IP_FACTOR
+    statuses = [_call(mw, {"user_id": str(uuid.uuid4())})[0] for _ in range(ip_burst + 1)]
+    assert statuses[-1] == 429
+    assert statuses.count(200) == ip_burst
+
+
+def test_large_body_is_passed_through_without_being_buffered():
+    mw = rate_limit.RateLimitMiddleware(echo_app, rate_limit.MemoryBuckets())
+    chunk = b"x" * (rate_limit.MAX_BODY_PEEK // 2)
+    chunks = [chunk] * 6
+    status, body, _ = _call(mw, chunks=chunks)
+    assert status == 200
+    assert body == b"".join(chunks)
+
+
+def test_peek_stops_reading_past_the_limit():
+    chunk = b"x" * (rate_limit.MAX_BODY_PEEK // 2)
+    incoming = [{"type": "http.request", "body": chunk, "more_body": True} for _ in range(6)]
+
+    async def receive():
+        return incoming.pop(0)
+
+    messages, body = asyncio.run(rate_limit._peek_body(receive))
+    assert body is None
+    assert len(messages) == 3       # 上限を超えた時点で止め、残りは後段が読む
+    assert len(incoming) == 3
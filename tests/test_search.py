@@ -0,0 +1,63 @@
+# tests/test_search.py
+# /search（routers/search.py）
+#   Postgres の代わりに、投げられた SQL と引数を記録するだけのフェイクを使う。
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routers import search
+from utils.init import get_db
+
+USER = "00000000-0000-0000-0000-000000000001"
+
+
+class RecordingConn:
+    def __init__(self):
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def fetch(self, sql, *args):
+        self.calls.append((sql, args))
+        return []
+
+
+class RecordingDB:
+    def __init__(self):
+        self.conn = RecordingConn()
+
+    def acquire(self):
+        return self.conn
+
+
+@pytest.fixture
+def client_and_db():
+    db = RecordingDB()
+    app = FastAPI()
+    app.include_router(search.router)
+    app.dependency_overrides[get_db] = lambda: db
+    return TestClient(app), db
+
+
+def test_short_terms_only_are_rejected_without_querying(client_and_db):
+    client, db = client_and_db
+    resp = client.get("/search", params={"user_id": USER, "q": "縁　供養"})
+    assert resp.status_code == 400
+    assert db.conn.calls == []
+
+
+def test_short_term_is_not_matched_against_the_trigram_expression(client_and_db):
+    client, db = client_and_db
+    resp = client.get("/search", params={"user_id": USER, "q": "縁 お守りの意味"})
+    assert resp.status_code == 200
+
+    sql, args = db.conn.calls[0]
+    assert args[1:3] == ("%縁%", "%お守りの意味%")
+    # 長い語だけが索引の式（SEARCH_EXPR）に当たり、短い語は絞った行への追加条件になる
+    assert f"{search.SEARCH_EXPR} ILIKE $3" in sql
+    assert f"{search.SEARCH_EXPR} ILIKE $2" not in sql
+    assert "(question ILIKE $2 OR answer ILIKE $2)" in sql
@@ -0,0 +1,98 @@
+# utils/admob.py
+# ─────────────────────────────
+# AdMob サーバーサイド検証（SSV）
+#   - 署名検証：Google の公開鍵（verifier-keys.json）を TTL 付きでキャッシュ
+#   - 重複排除：直近の transaction_id をメモリで覚え、DB の台帳より手前で弾く
+# 署名対象は「&signature= より前のクエリ文字列（デコードしない生の値）」。
+import asyncio
+import base64
+import os
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+import httpx
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from utils.cache import LRUCache
+
+ADMOB_KEYS_URL          = "https://www.gstatic.com/admob/reward/verifier-keys.json"
+ADMOB_KEYS_TTL_SEC      = 24 * 3600     # 鍵は滅多に変わらない
+ADMOB_KEYS_MIN_REFRESH  = 60            # 未知の key_id で取り直すときの最短間隔
+ADMOB_VERIFY_SIGNATURE  = os.getenv("ADMOB_VERIFY_SIGNATURE", "1") == "1"
+ADMOB_RECENT_TX_SIZE    = 50000
+ADMOB_RECENT_TX_TTL_SEC = 24 * 3600
+
+_keys: Dict[str, object] = {}
+_keys_fetched_at = 0.0
+_keys_lock = asyncio.Lock()     # TTL 切れ直後にコールバックが重なっても取りに行くのは 1 回だけ
+
+_recent_tx = LRUCache(ADMOB_RECENT_TX_SIZE, ttl=ADMOB_RECENT_TX_TTL_SEC)
+
+
+# ──────────────────────────────
+# 公開鍵
+# ──────────────────────────────
+async def _refresh_keys() -> None:
+    global _keys, _keys_fetched_at
+    _keys_fetched_at = time.monotonic()
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(ADMOB_KEYS_URL, timeout=10)
+        resp.raise_for_status()
+    _keys = {str(k["keyId"]): load_pem_public_key(k["pem"].encode()) for k in resp.json()["keys"]}
+
+
+def _needs_refresh(key_id: str) -> bool:
+    age = time.monotonic() - _keys_fetched_at
+    return age > ADMOB_KEYS_TTL_SEC or (key_id not in _keys and age > ADMOB_KEYS_MIN_REFRESH)
+
+
+async def _get_public_key(key_id: str):
+    if _needs_refresh(key_id):
+        async with _keys_lock:
+            # 待っている間に先行のリクエストが取り直していれば、それを使う
+            if _needs_refresh(key_id):
+                await _refresh_keys()
+    return _keys.get(key_id)
+
+
+def _b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+async def verify_ssv(raw_query: str) -> bool:
+    """署名が正しければ True。ADMOB_VERIFY_SIGNATURE=0 なら常に True（ローカル検証用）"""
+    if not ADMOB_VERIFY_SIGNATURE:
+        return True
+    idx = raw_query.find("&signature=")
+    if idx < 0:
+        return False
+    message = raw_query[:idx].encode()
+    tail = parse_qs(raw_query[idx + 1:])
+    signature, key_id = tail.get("signature", [None])[0], tail.get("key_id", [None])[0]
+    if not signature or not key_id:
+        return False
+
+    key = await _get_public_key(key_id)
+    if key is None:
+        return False
+    try:
+        key.verify(_b64url_decode(signature), message, ec.ECDSA(hashes.SHA256()))
+        return True
+    except (InvalidSignature, ValueError):
+        return False
+
+
+# ──────────────────────────────
+# 重複排除（DB の台帳の手前）
+# ──────────────────────────────
+def seen_recently(transaction_id: str) -> bool:
+    return _recent_tx.get(transaction_id) is not None
+
+
+def remember(transaction_id: Optional[str]) -> None:
+    if transaction_id:
+        _recent_tx.set(transaction_id, True)
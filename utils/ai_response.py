@@ -1,32 +1,69 @@
 # ai-butsu-api/utils/ai_response.py
 # ─────────────────────────────
-import os, asyncpg, random
+import os, asyncpg, math, random, threading
 from typing import List, Dict, Tuple
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
 import re
+from utils import history_cache
 from utils.init import trim_if_needed
+from utils.archive import needs_rehydrate, rehydrate_chat
+from utils.conversation_writer import merge_pending
 from utils.prompt_assets import SYSTEM_PROMPT, FEW_SHOTS
 
 load_dotenv()
 OPENAI_MODEL          = os.getenv("OPENAI_MODEL",          "gpt-4o")
 OPENAI_SUMMARY_MODEL  = os.getenv("OPENAI_SUMMARY_MODEL",  "gpt-3.5-turbo")
 OPENAI_API_KEY        = os.getenv("OPENAI_API_KEY")
-openai_client         = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# OpenAI クライアント・tokenizer は初回利用時に生成（lifespan から裏で温める）
+_openai_client        = None
+_enc35                = None
+_init_lock            = threading.Lock()
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _init_lock:
+            if _openai_client is None:
+                from openai import AsyncOpenAI
+                _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
 
 
 CHUNK_MAX_TOKENS       = 320     # 1チャンク出力量（日本語で十分長い）
 CONTINUE_MAX_CHUNKS    = 3       # 続き呼びの最大回数（合計で実質 ~1000tokens 出力可）
 STOP_SEQUENCES         = None    # 明示stop不要なら None のまま
 
+# ──────────────────────────────
+# 固定プレフィックス（SYSTEM_PROMPT + FEW_SHOTS）
+#   プロバイダのプロンプトキャッシュは先頭が 1 バイトでも違うと効かないので、
+#   どのリクエストでも先頭はこの並びのまま送り、可変部分（BLESS・要約・履歴）は必ずこの後ろに置く。
+#   SYSTEM_PROMPT / FEW_SHOTS を変えたら PROMPT_PREFIX_VERSION を上げる。
+# ──────────────────────────────
+PROMPT_PREFIX_VERSION  = "v1"
+PROMPT_PREFIX          = ({"role": "system", "content": SYSTEM_PROMPT}, *FEW_SHOTS)
+MAX_PROMPT_MESSAGES    = 25
+BLESS_MARKER           = {"role": "assistant", "content": "[BLESS]"}
+CACHED_TOKEN_WEIGHT    = float(os.getenv("CACHED_TOKEN_WEIGHT", "0.5"))   # キャッシュ済み入力の課金係数
+
 
 # ------------ tiktoken で概算 token 数 -------------
-try:
-    from tiktoken import encoding_for_model
-    _enc35 = encoding_for_model("gpt-3.5-turbo")
-    def _tok_len(text: str) -> int: return len(_enc35.encode(text))
-except Exception:
-    def _tok_len(text: str) -> int: return len(text) // 2
+def _get_encoder():
+    """tiktoken の encoding を一度だけ読み込む。使えなければ False（文字数で概算）"""
+    global _enc35
+    if _enc35 is None:
+        with _init_lock:
+            if _enc35 is None:
+                try:
+                    from tiktoken import encoding_for_model
+                    _enc35 = encoding_for_model("gpt-3.5-turbo")
+                except Exception:
+                    _enc35 = False
+    return _enc35
+
+def _tok_len(text: str) -> int:
+    enc = _enc35 if _enc35 is not None else _get_encoder()
+    return len(enc.encode(text)) if enc else len(text) // 2
 
 FULL_PAIR_LIMIT       = 2
 TOKEN_BUDGET_HISTORY  = 1200   # 900 → 1200 程度
@@ -52,44 +89,87 @@ def _limit_questions(text: str, max_q: int = 1) -> str:
     return "".join(out)
 
 # ──────────────────────────────
-async def _summarize_pair(q: str, a: str) -> str:
+async def _summarize_pair(q: str, a: str, usage: Dict = None) -> str:
+    """usage を渡すと要約モデルの消費を足す（利用量ロールアップ用）"""
     prompt = f"次の相談と回答を50字以内で要約してください。\n◆相談: {q}\n◆回答: {a}\n要約:"
     try:
-        r = await openai_client.chat.completions.create(
+        r = await get_openai_client().chat.completions.create(
             model=OPENAI_SUMMARY_MODEL,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=60,
             temperature=0.2,
         )
+        if usage is not None:
+            _add_usage(usage, getattr(r, "usage", None))
         return r.choices[0].message.content.strip()
     except Exception:
         return (q[:25] + " / " + a[:25])[:50]
 
 # ──────────────────────────────
+# 直近の窓だけを新しい順に読む。ルート行の有無（= 退避されていないか）も同じ往復で確かめる
+_HISTORY_SQL = """
+    (SELECT id, question, answer, is_root, created_at FROM conversations
+      WHERE chat_id = $1 ORDER BY created_at DESC LIMIT $2)
+    UNION
+    (SELECT id, question, answer, is_root, created_at FROM conversations
+      WHERE chat_id = $1 AND is_root LIMIT 1)
+    ORDER BY created_at ASC
+"""
+
+
+async def _fetch_history_rows(db: asyncpg.pool.Pool, chat_id: str, window: int) -> List[Dict]:
+    """直近 window ターン（古い順）。キャッシュに無ければ DB から読んでキャッシュする"""
+    rows = history_cache.get_turns(chat_id, window)
+    if rows is not None and history_cache.HISTORY_CACHE_VERIFY:
+        latest = merge_pending(await db.fetch(
+            "SELECT id FROM conversations WHERE chat_id = $1 ORDER BY created_at DESC LIMIT 1", chat_id), chat_id)
+        if not latest or str(latest[-1]["id"]) != history_cache.newest_id(chat_id):
+            rows = None
+    if rows is not None:
+        return rows
+
+    # 読んでいる間に保存されたターンがあれば、この結果はキャッシュしない（store_turns が捨てる）
+    generation = history_cache.begin_fetch(chat_id)
+    try:
+        # まだ書き出されていない直前のターン（write-behind）も履歴に含める
+        rows = merge_pending(await db.fetch(_HISTORY_SQL, chat_id, window), chat_id)
+        # 退避済みのチャットに続けて話しかけられたら、書き戻してから履歴を組む
+        if needs_rehydrate(rows) and await rehydrate_chat(db, chat_id):
+            rows = merge_pending(await db.fetch(_HISTORY_SQL, chat_id, window), chat_id)
+        rows = rows[-window:] if window > 0 else []
+        history_cache.store_turns(chat_id, rows, complete=any(r["is_root"] for r in rows),
+                                  window=window, generation=generation)
+    finally:
+        history_cache.end_fetch(chat_id)
+    return rows
+
+
 async def _prepare_history(db: asyncpg.pool.Pool,
                            chat_id: str,
-                           user_input: str) -> Tuple[List[Dict], List[str]]:
-    rows = await db.fetch(
-        """SELECT question, answer FROM conversations
-           WHERE chat_id = $1 ORDER BY created_at ASC""",
-        chat_id,
-    )
+                           user_input: str,
+                           summary_usage: Dict = None) -> Tuple[List[Dict], List[str]]:
+    rows = await _fetch_history_rows(db, chat_id, FULL_PAIR_LIMIT + SUMMARY_PAIR_MAX)
 
     full_pairs, summaries = [], []
     if rows:
         # 直近 FULL_PAIR_LIMIT
-        for r in rows[-FULL_PAIR_LIMIT:]:
+        split = max(0, len(rows) - FULL_PAIR_LIMIT)
+        for r in rows[split:]:
             full_pairs.extend([
                 {"role": "user", "content": r["question"]},
                 {"role": "assistant", "content": r["answer"]},
             ])
 
-        # それ以前は要約
-        earlier_rows = rows[:-FULL_PAIR_LIMIT]
+        # それ以前は要約（ターンごとに一度だけ作ってキャッシュ）
         total_tok = _tok_len(user_input) + sum(_tok_len(m["content"]) for m in full_pairs)
-        for r in reversed(earlier_rows):
-            summary = await _summarize_pair(r["question"], r["answer"])
-            if len(summaries) < SUMMARY_PAIR_MAX and (total_tok + _tok_len(summary)) <= TOKEN_BUDGET_HISTORY:
+        for r in reversed(rows[:split]):
+            if len(summaries) >= SUMMARY_PAIR_MAX:
+                break
+            summary = history_cache.get_summary(r["id"])
+            if summary is None:
+                summary = await _summarize_pair(r["question"], r["answer"], summary_usage)
+                history_cache.store_summary(r["id"], summary)
+            if (total_tok + _tok_len(summary)) <= TOKEN_BUDGET_HISTORY:
                 summaries.insert(0, summary)
                 total_tok += _tok_len(summary)
             else:
@@ -97,7 +177,7 @@ async def _prepare_history(db: asyncpg.pool.Pool,
     return full_pairs, summaries
 
 # ──────────────────────────────
-def _detect_bless(text: str) -> bool:
+def detect_bless(text: str) -> bool:
     return any(t in text for t in BLESS_TRIGGERS)
 
 # ──────────────────────────────
@@ -106,19 +186,19 @@ def _build_messages(full_pairs: List[Dict],
                     user_input: str,
                     is_bless: bool) -> List[Dict]:
 
-    msgs: List[Dict] = [{"role": "system", "content": SYSTEM_PROMPT}] + FEW_SHOTS
+    history: List[Dict] = [{"role": "assistant", "content": f"(要約ログ) {s}"} for s in summaries]
+    history.extend(full_pairs)
 
-    if is_bless:
-        msgs.append({"role": "assistant", "content": "[BLESS]"})
+    # 上限を超えたら履歴の古い側だけを落とす（プレフィックス・BLESS・今回の入力は残す）
+    room = MAX_PROMPT_MESSAGES - len(PROMPT_PREFIX) - 1 - (1 if is_bless else 0)
+    if len(history) > room:
+        history = history[-room:] if room > 0 else []
 
-    for s in summaries:
-        msgs.append({"role": "assistant", "content": f"(要約ログ) {s}"})
-
-    msgs.extend(full_pairs)
+    msgs: List[Dict] = list(PROMPT_PREFIX)
+    if is_bless:
+        msgs.append(BLESS_MARKER)
+    msgs.extend(history)
     msgs.append({"role": "user", "content": user_input})
-
-    if len(msgs) > 25:
-        msgs = msgs[:1] + FEW_SHOTS + msgs[-(25 - 1 - len(FEW_SHOTS)):]
     return msgs
 
 # ──────────────────────────────
@@ -130,14 +210,36 @@ def _postprocess(text: str, is_bless: bool) -> str:
     return text                              # ← 不要な文字数トリムはしな
 
 # ──────────────────────────────
-async def _call_openai(messages: List[Dict], is_bless: bool) -> Tuple[str, int]:
-    """長文でも finish_reason=length を検出して自動で続き取得する"""
+def _new_usage(model: str = None) -> Dict:
+    return {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+            "total_tokens": 0, "calls": 0, "prefix_version": PROMPT_PREFIX_VERSION,
+            "model": model or OPENAI_MODEL}
+
+def _add_usage(usage: Dict, u) -> None:
+    if u is None:
+        return
+    details = getattr(u, "prompt_tokens_details", None)
+    usage["prompt_tokens"]     += u.prompt_tokens or 0
+    usage["cached_tokens"]     += (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    usage["completion_tokens"] += u.completion_tokens or 0
+    usage["total_tokens"]      += u.total_tokens or 0
+    usage["calls"]             += 1
+
+def billable_tokens(usage: Dict) -> int:
+    """ユーザーに課金するトークン数（キャッシュ済み入力は CACHED_TOKEN_WEIGHT 倍）"""
+    uncached = usage["prompt_tokens"] - usage["cached_tokens"]
+    return math.ceil(uncached + usage["cached_tokens"] * CACHED_TOKEN_WEIGHT + usage["completion_tokens"])
+
+# ──────────────────────────────
+async def _call_openai(messages: List[Dict], is_bless: bool) -> Tuple[str, int, Dict]:
+    """長文でも finish_reason=length を検出して自動で続き取得する。
+    戻り値は (本文, 課金トークン数, usage 内訳)"""
     out_parts: List[str] = []
-    total_tokens_used = 0
+    usage = _new_usage()
     local_msgs = list(messages)
 
     for turn in range(CONTINUE_MAX_CHUNKS):
-        r = await openai_client.chat.completions.create(
+        r = await get_openai_client().chat.completions.create(
             model       = OPENAI_MODEL,
             messages    = local_msgs,
             max_tokens  = CHUNK_MAX_TOKENS,
@@ -147,7 +249,7 @@ async def _call_openai(messages: List[Dict], is_bless: bool) -> Tuple[str, int]:
         )
         part = (r.choices[0].message.content or "").strip()
         out_parts.append(part)
-        total_tokens_used += (r.usage.total_tokens or 0)
+        _add_usage(usage, r.usage)
 
         finish = getattr(r.choices[0], "finish_reason", None)
         # 途中切れ（length）のときは続きだけを取りにいく
@@ -162,25 +264,25 @@ async def _call_openai(messages: List[Dict], is_bless: bool) -> Tuple[str, int]:
         break
 
     full_text = _postprocess("".join(out_parts), is_bless)
-    return full_text, total_tokens_used
+    return full_text, billable_tokens(usage), usage
 
 # ──────────────────────────────
-async def generate_answer(question: str) -> Tuple[str, int]:
-    is_bless = _detect_bless(question)
-    msgs = (
-        [{"role": "system", "content": SYSTEM_PROMPT}]
-        + FEW_SHOTS
-        + ( [{"role": "assistant", "content": "[BLESS]"}] if is_bless else [] )
-        + [{"role": "user", "content": question}]
-    )
+async def generate_answer(question: str) -> Tuple[str, int, Dict]:
+    is_bless = detect_bless(question)
+    msgs = _build_messages([], [], question, is_bless)
     return await _call_openai(msgs, is_bless)
 
 # ──────────────────────────────
 async def generate_answer_with_context(chat_id: str,
                                        user_input: str,
-                                       db: asyncpg.pool.Pool) -> Tuple[str, int]:
+                                       db: asyncpg.pool.Pool) -> Tuple[str, int, Dict]:
 
-    is_bless                 = _detect_bless(user_input)
-    full_pairs, summaries    = await _prepare_history(db, chat_id, user_input)
+    is_bless                 = detect_bless(user_input)
+    summary_usage            = _new_usage(OPENAI_SUMMARY_MODEL)
+    full_pairs, summaries    = await _prepare_history(db, chat_id, user_input, summary_usage)
     messages                 = _build_messages(full_pairs, summaries, user_input, is_bless)
-    return await _call_openai(messages, is_bless)
+    text, billable, usage    = await _call_openai(messages, is_bless)
+    usage["history_turns"]   = len(full_pairs) // 2 + len(summaries)   # 予約の見積もり用
+    if summary_usage["calls"]:
+        usage["summary_usage"] = summary_usage                         # 利用量ロールアップ用（課金はしない）
+    return text, billable, usage
@@ -0,0 +1,178 @@
+# utils/archive.py
+# ─────────────────────────────
+# conversations のコールド退避と復元
+#   - 最終発言から一定日数たったチャットは、行を JSON（gzip）にして chat-archives バケットへ移し、
+#     conversations からは消す（一覧用にルートの質問だけ conversation_archives に残す）。
+#   - /chat/{chat_id} や _prepare_history が退避済みチャットに触れたら、その場で書き戻す。
+#   - 埋め込みは今のところ全行ゼロのプレースホルダなので、退避対象にも含めず NULL に寄せる。
+# 退避を回すのは scripts/archive_conversations.py（cron / 手動）。
+import asyncio
+import gzip
+import os
+from typing import Dict, Iterable, Optional
+
+from asyncpg import Pool
+
+from utils import history_cache
+from utils.init import empty_embedding_vector, get_supabase
+
+ARCHIVE_BUCKET       = os.getenv("ARCHIVE_BUCKET", "chat-archives")
+ARCHIVE_GZIP_LEVEL   = 6
+VECTOR_NULL_BATCH    = 2000      # 埋め込み NULL 化の 1 UPDATE あたりの行数
+
+_rehydrating: Dict[str, asyncio.Future] = {}
+
+
+class ArchiveConflict(Exception):
+    """退避中にチャットへ新しい発言が入った（今回は見送る）"""
+
+
+def _object_path(user_id: str, chat_id: str) -> str:
+    return f"{user_id}/{chat_id}.json.gz"
+
+
+def needs_rehydrate(rows: Iterable) -> bool:
+    """ルート行が見当たらなければ退避済みの可能性がある（行ゼロも含む）"""
+    return not any(r["is_root"] for r in rows)
+
+
+# ──────────────────────────────
+# 復元（リクエスト経路）
+# ──────────────────────────────
+async def rehydrate_chat(db: Pool, chat_id: str) -> bool:
+    """退避済みなら conversations に書き戻して True。退避されていなければ False"""
+    if not await db.fetchval("SELECT 1 FROM conversation_archives WHERE chat_id = $1", chat_id):
+        return False
+
+    # 同じチャットへの同時アクセスはダウンロードを 1 回にまとめる
+    task = _rehydrating.get(chat_id)
+    if task is None:
+        task = asyncio.ensure_future(_rehydrate(db, chat_id))
+        _rehydrating[chat_id] = task
+        task.add_done_callback(lambda _: _rehydrating.pop(chat_id, None))
+    return await asyncio.shield(task)
+
+
+async def _rehydrate(db: Pool, chat_id: str) -> bool:
+    path = await db.fetchval("SELECT object_path FROM conversation_archives WHERE chat_id = $1", chat_id)
+    if path is None:
+        return True     # 待っている間に別リクエストが戻した
+
+    storage = get_supabase().storage.from_(ARCHIVE_BUCKET)
+    payload = gzip.decompress(await asyncio.to_thread(storage.download, path)).decode("utf-8")
+
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            # 別プロセスとの競合は行ロックで直列化し、二重挿入は id の衝突で吸収する
+            locked = await conn.fetchval("""
+                SELECT 1 FROM conversation_archives WHERE chat_id = $1 FOR UPDATE
+            """, chat_id)
+            if not locked:
+                return True
+            await conn.execute("""
+                INSERT INTO conversations
+                SELECT * FROM jsonb_populate_recordset(NULL::conversations, $1::jsonb)
+                ON CONFLICT (id) DO NOTHING
+            """, payload)
+            await conn.execute("DELETE FROM conversation_archives WHERE chat_id = $1", chat_id)
+
+    try:
+        await asyncio.to_thread(storage.remove, [path])
+    except Exception as e:
+        print("⚠️ アーカイブ削除失敗（復元は完了）:", path, e)
+    print(f"📦 チャット復元 {chat_id}")
+    return True
+
+
+# ──────────────────────────────
+# 退避（メンテナンス経路）
+# ──────────────────────────────
+async def find_inactive_chats(db: Pool, inactive_days: int, limit: int, exclude=()):
+    """最終発言が inactive_days 日より前のチャット。exclude は今回すでに見送ったもの"""
+    return await db.fetch("""
+        SELECT chat_id, user_id, max(created_at) AS last_message_at
+        FROM conversations
+        WHERE NOT (chat_id = ANY($3::uuid[]))
+        GROUP BY chat_id, user_id
+        HAVING max(created_at) < now() - make_interval(days => $1)
+        LIMIT $2
+    """, inactive_days, limit, list(exclude))
+
+
+async def archive_chat(db: Pool, chat_id: str, user_id: str) -> int:
+    """1 チャットを退避して退避した行数を返す。途中で発言が増えたら ArchiveConflict"""
+    row = await db.fetchrow("""
+        SELECT jsonb_agg(to_jsonb(c) - 'embedding' ORDER BY c.created_at)::text AS payload,
+               count(*)                                                       AS row_count,
+               max(c.created_at)                                              AS last_message_at,
+               coalesce((array_agg(c.question ORDER BY c.created_at) FILTER (WHERE c.is_root))[1],
+                        (array_agg(c.question ORDER BY c.created_at))[1])     AS root_question,
+               coalesce(min(c.created_at) FILTER (WHERE c.is_root), min(c.created_at)) AS root_created_at,
+               max(c.created_at) > now() - make_interval(secs => $2)          AS maybe_cached
+        FROM conversations c WHERE c.chat_id = $1
+    """, chat_id, history_cache.HISTORY_CACHE_IDLE_SEC)
+    if not row["row_count"]:
+        return 0
+    # 退避は別プロセス（scripts/archive_conversations.py）で回すので、ここでの forget_chat は
+    # サーバーの履歴キャッシュには届かない。サーバー側のキャッシュが切れている（アイドル時間を過ぎた）
+    # チャットだけを退避する
+    if row["maybe_cached"]:
+        raise ArchiveConflict(chat_id)
+    payload = row["payload"]
+
+    path = _object_path(str(user_id), str(chat_id))
+    storage = get_supabase().storage.from_(ARCHIVE_BUCKET)
+    await asyncio.to_thread(
+        storage.upload,
+        path=path,
+        file=gzip.compress(payload.encode("utf-8"), ARCHIVE_GZIP_LEVEL),
+        file_options={"content-type": "application/gzip", "upsert": "true"},
+    )
+
+    try:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute("DELETE FROM conversations WHERE chat_id = $1", chat_id)
+                if int(status.split()[-1]) != row["row_count"]:
+                    raise ArchiveConflict(chat_id)
+                await conn.execute("""
+                    INSERT INTO conversation_archives
+                    (chat_id, user_id, object_path, row_count, root_question, root_created_at, last_message_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                """, chat_id, user_id, path, row["row_count"], row["root_question"],
+                    row["root_created_at"], row["last_message_at"])
+    except Exception:
+        try:
+            await asyncio.to_thread(storage.remove, [path])
+        except Exception:
+            pass
+        raise
+    history_cache.forget_chat(chat_id)     # 同じプロセスで退避したとき用
+    return row["row_count"]
+
+
+async def null_placeholder_vectors(db: Pool, batch: int = VECTOR_NULL_BATCH,
+                                   after: Optional[str] = None) -> int:
+    """ゼロ埋めの埋め込みを主キー順にバッチで NULL にする。本物のベクトルは触らない"""
+    zero = empty_embedding_vector()
+    last_id = after or "00000000-0000-0000-0000-000000000000"
+    total = 0
+    while True:
+        row = await db.fetchrow("""
+            WITH batch AS (
+                SELECT id FROM conversations WHERE id > $1::uuid ORDER BY id LIMIT $2
+            ), upd AS (
+                UPDATE conversations c SET embedding = NULL
+                FROM batch b
+                WHERE c.id = b.id AND c.embedding = $3::vector
+                RETURNING 1
+            )
+            SELECT (SELECT id FROM batch ORDER BY id DESC LIMIT 1) AS last_id,
+                   (SELECT count(*) FROM upd) AS updated
+        """, last_id, batch, zero)
+        if row["last_id"] is None:
+            return total
+        last_id = row["last_id"]
+        total += row["updated"]
+        await asyncio.sleep(0.05)
+
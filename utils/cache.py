@@ -0,0 +1,76 @@
+# utils/cache.py
+# ─────────────────────────────
+# プロセス内 LRU キャッシュ（件数上限 + 任意の TTL + 任意のバイト数上限）
+#   asyncio の単一スレッドから使う前提なのでロックは持たない。
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+_MISS = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()   # key → (value, expires, size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, _MISS)
+        if item is _MISS:
+            self.misses += 1
+            return default
+        value, expires, _ = item
+        if expires is not None and expires < time.monotonic():
+            self.delete(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, size: int = 0) -> None:
+        """size は max_bytes を指定したときの見積もりバイト数（上限を超える値は入れない）"""
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.delete(key)
+            return
+        ttl = self.ttl if ttl is None else ttl
+        self.delete(key)
+        self._data[key] = (value, time.monotonic() + ttl if ttl is not None else None, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, (_, _, old_size) = self._data.popitem(last=False)
+            self.bytes -= old_size
+
+    def delete(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        stats = {"size": len(self._data), "maxsize": self.maxsize,
+                 "hits": self.hits, "misses": self.misses}
+        if self.max_bytes is not None:
+            stats.update(bytes=self.bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match（カンマ区切り・弱い比較）に etag が含まれるか"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return etag in tags
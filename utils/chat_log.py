@@ -0,0 +1,103 @@
+# utils/chat_log.py
+# ─────────────────────────────
+# chat-logs バケットのチャットログ読み出し（/storage_chat/{chat_id}）
+#   - Supabase Storage のクライアントは同期なので、呼び出しはスレッドに逃がす
+#   - 毎回 info（メタデータだけ）でオブジェクトの version を確かめ、
+#     同じ version の本文はプロセス内 LRU（バイト数上限つき）から返す
+#   - 本文は JSON の bytes のまま持ち、デコードせずにレスポンスへ埋め込む
+import asyncio
+import hashlib
+import json
+import os
+from typing import Optional, Tuple
+
+from utils.cache import LRUCache
+from utils.init import get_supabase
+
+CHAT_LOG_BUCKET          = "chat-logs"
+STORAGE_CHAT_CACHE_SIZE  = int(os.getenv("STORAGE_CHAT_CACHE_SIZE", "2000"))
+STORAGE_CHAT_CACHE_BYTES = int(os.getenv("STORAGE_CHAT_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+_cache = LRUCache(STORAGE_CHAT_CACHE_SIZE, max_bytes=STORAGE_CHAT_CACHE_BYTES)   # chat_id → (version, raw)
+
+
+class ChatLogNotFound(Exception):
+    pass
+
+
+def _file_name(chat_id: str) -> str:
+    return f"chat_{chat_id}.json"
+
+
+def _is_not_found(e: Exception) -> bool:
+    status = str(getattr(e, "status", "") or "")
+    code = str(getattr(e, "code", "") or "").lower()
+    return status == "404" or code in ("not_found", "nosuchkey") or "not found" in str(e).lower()
+
+
+def _version_of(info: dict) -> Optional[str]:
+    for key in ("version", "etag", "last_modified", "updated_at"):
+        if info.get(key):
+            return f"{key}:{info[key]}:{info.get('size', '')}"
+    return None
+
+
+def make_etag(chat_id: str, version: str) -> str:
+    return '"' + hashlib.sha256(f"{chat_id}:{version}".encode("utf-8")).hexdigest()[:32] + '"'
+
+
+async def chat_log_version(chat_id: str) -> Optional[str]:
+    """オブジェクトの version（取れなければ None）。無ければ ChatLogNotFound"""
+    storage = get_supabase().storage.from_(CHAT_LOG_BUCKET)
+    try:
+        info = await asyncio.to_thread(storage.info, _file_name(chat_id))
+    except Exception as e:
+        if _is_not_found(e):
+            raise ChatLogNotFound(chat_id) from e
+        raise
+    return _version_of(info or {})
+
+
+async def load_chat_log(chat_id: str, version: Optional[str]) -> Tuple[bytes, str]:
+    """(本文の JSON bytes, version)。version が一致すればキャッシュから返す"""
+    cached = _cache.get(chat_id)
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1], version
+
+    storage = get_supabase().storage.from_(CHAT_LOG_BUCKET)
+    try:
+        raw = await asyncio.to_thread(storage.download, _file_name(chat_id))
+    except Exception as e:
+        if _is_not_found(e):
+            _cache.delete(chat_id)
+            raise ChatLogNotFound(chat_id) from e
+        raise
+
+    if version is None:
+        version = "sha256:" + hashlib.sha256(raw).hexdigest()
+    else:
+        _cache.set(chat_id, (version, raw), size=len(raw))
+    return raw, version
+
+
+def last_messages(raw: bytes, n: int) -> bytes:
+    """JSON 配列の末尾 n 件だけを、全体をデコードせずに切り出す。
+    ログは save_chat_pair_to_storage が json.dumps した {"role": ..., ...} の並びなので、
+    後ろから '{"role"' を探せば要素の先頭が分かる（文字列内の " は必ずエスケープされている）"""
+    pos, found = len(raw), 0
+    while found < n:
+        pos = raw.rfind(b'{"role"', 0, pos)
+        if pos < 0:
+            break
+        found += 1
+    if found == n:
+        return b"[" + raw[pos:]
+    if found == 0 and raw.strip() not in (b"", b"[]"):
+        # 想定外の形式は普通にデコードして切る
+        items = json.loads(raw)
+        return json.dumps(items[-n:], ensure_ascii=False).encode("utf-8")
+    return raw      # n 件に満たない
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
@@ -0,0 +1,204 @@
+# utils/conversation_writer.py
+# ─────────────────────────────
+# conversations への INSERT（/chat・/new_chat）
+#   既定では従来どおりリクエスト内で 1 行ずつ INSERT する。
+#   CONVERSATION_WRITE_BEHIND=1 のときはメモリのバッファに積んで即座に応答し、
+#   件数（WRITE_BEHIND_MAX_ROWS）か時間（WRITE_BEHIND_MAX_DELAY_MS）で executemany にまとめて書く。
+#   - 未 flush の行は pending_rows() で読めるので、get_chat / _prepare_history からも見える
+#   - シャットダウン時（lifespan）に残りを書き切る
+#   - プロセスが落ちると未 flush の行は失われる（その間の最大遅延ぶん）。それを許容できるときだけ有効にする
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import asyncpg
+from asyncpg import Pool
+
+from utils import history_cache
+
+WRITE_BEHIND_ENABLED       = os.getenv("CONVERSATION_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_MAX_ROWS      = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "200"))
+WRITE_BEHIND_MAX_DELAY_MS  = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "200"))
+WRITE_BEHIND_RETRY_SEC     = 1.0
+
+COLUMNS = ("id", "chat_id", "user_id", "question", "answer", "created_at", "is_root",
+           "prompt_tokens", "cached_tokens", "completion_tokens", "prompt_version")
+
+_INSERT_SQL = """
+    INSERT INTO conversations
+    (id, chat_id, user_id, question, answer, created_at, is_root,
+     prompt_tokens, cached_tokens, completion_tokens, prompt_version)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    ON CONFLICT (id) DO NOTHING
+"""
+
+# 行の中身が原因で失敗するもの（再試行しても通らない）。それ以外の失敗はバッファに残す
+_DATA_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+_pending: List[Dict] = []
+_pending_by_chat: Dict[str, List[Dict]] = {}
+_flush_lock = asyncio.Lock()
+_wakeup = asyncio.Event()
+_stopping = False
+
+
+def _key(chat_id) -> str:
+    return str(chat_id).lower()
+
+
+def make_row(row_id: str, chat_id: str, user_id: str, question: str, answer: str,
+             is_root: bool, usage: Dict) -> Dict:
+    return {
+        "id": row_id, "chat_id": chat_id, "user_id": user_id,
+        "question": question, "answer": answer,
+        "created_at": datetime.now(timezone.utc), "is_root": is_root,
+        "prompt_tokens": usage["prompt_tokens"], "cached_tokens": usage["cached_tokens"],
+        "completion_tokens": usage["completion_tokens"], "prompt_version": usage["prefix_version"],
+    }
+
+
+def _args(row: Dict) -> tuple:
+    # embedding は書かない（NULL）。ゼロ埋めの 1536 次元リテラルを毎行送らない（sql/006 で NULL 可）
+    return tuple(row[c] for c in COLUMNS)
+
+
+async def write_conversation(db: Pool, row: Dict) -> None:
+    """1 ターン分を保存する。write-behind 有効時はバッファに積むだけ"""
+    if not WRITE_BEHIND_ENABLED:
+        async with db.acquire() as conn:
+            await conn.execute(_INSERT_SQL, *_args(row))
+        history_cache.record_turn(row)
+        return
+    _pending.append(row)
+    _pending_by_chat.setdefault(_key(row["chat_id"]), []).append(row)
+    history_cache.record_turn(row)
+    if len(_pending) >= WRITE_BEHIND_MAX_ROWS:
+        _wakeup.set()
+
+
+def pending_rows(chat_id: str) -> List[Dict]:
+    """まだ DB に書かれていないこのチャットの行（古い順）"""
+    return list(_pending_by_chat.get(_key(chat_id), ()))
+
+
+def merge_pending(rows, chat_id: str) -> list:
+    """DB から読んだ行（created_at 昇順、id 列を含む）に未 flush の行を足す"""
+    pending = pending_rows(chat_id)
+    if not pending:
+        return rows
+    seen = {str(r["id"]) for r in rows}
+    return list(rows) + [r for r in pending if str(r["id"]) not in seen]
+
+
+def discard_user(user_id: str) -> None:
+    """削除されるユーザーの未 flush 分を捨てる"""
+    global _pending
+    _pending = [r for r in _pending if str(r["user_id"]) != str(user_id)]
+    for chat_id in [c for c, rows in _pending_by_chat.items() if str(rows[0]["user_id"]) == str(user_id)]:
+        del _pending_by_chat[chat_id]
+
+
+def _loggable(row: Dict) -> Dict:
+    return {c: (row[c][:200] if isinstance(row[c], str) else row[c]) for c in COLUMNS}
+
+
+def _forget(rows: List[Dict]) -> None:
+    for row in rows:
+        chat_rows = _pending_by_chat.get(_key(row["chat_id"]))
+        if chat_rows and row in chat_rows:
+            chat_rows.remove(row)
+            if not chat_rows:
+                del _pending_by_chat[_key(row["chat_id"])]
+
+
+async def flush_conversations(db: Pool) -> int:
+    """バッファを書き出して件数を返す。書けなかった行はバッファに残す"""
+    global _pending
+    async with _flush_lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending[:WRITE_BEHIND_MAX_ROWS], _pending[WRITE_BEHIND_MAX_ROWS:]
+        try:
+            async with db.acquire() as conn:
+                await conn.executemany(_INSERT_SQL, [_args(r) for r in batch])
+                _forget(batch)      # 接続を返す前に外す（読み側で二重に見えないように）
+            return len(batch)
+        except _DATA_ERRORS as e:
+            print(f"❌ conversations のまとめ書き失敗（{len(batch)} 行、1 行ずつ再試行）:", e)
+        except Exception as e:
+            # 接続断・フェイルオーバー・タイムアウトなど。全部残して後で再試行する
+            print(f"⚠️ conversations のまとめ書きを保留（{len(batch)} 行）: {e!r}")
+            _pending = batch + _pending
+            return 0
+        except BaseException:
+            # キャンセルされても行は失わない（書けていた分は ON CONFLICT で二重にならない）
+            _pending = batch + _pending
+            raise
+
+        # どの行が悪いのか分からないので 1 行ずつ
+        written, failed = [], []
+        i = 0
+        try:
+            for i, row in enumerate(batch):
+                try:
+                    async with db.acquire() as conn:
+                        await conn.execute(_INSERT_SQL, *_args(row))
+                        _forget([row])
+                    written.append(row)
+                except _DATA_ERRORS as e:
+                    # 何度書いても通らない行。中身をログに残して捨てる
+                    print(f"❌ conversations 行を破棄 {row['id']}: {e!r} row={_loggable(row)}")
+                    _forget([row])
+                    history_cache.forget_chat(row["chat_id"])   # キャッシュにだけ残った行を履歴に使わない
+                    written.append(row)
+                except Exception as e:
+                    print(f"⚠️ conversations 行の書き込みを保留（残り {len(batch) - i} 行）: {e!r}")
+                    failed.extend(batch[i:])
+                    break
+        except BaseException:
+            failed.extend(batch[i:])
+            raise
+        finally:
+            _pending = failed + _pending
+        return len(written)
+
+
+async def conversation_writer_worker(db: Pool):
+    """lifespan から起動する常駐タスク（write-behind 有効時のみ）。stop() で今の書き込みを終えてから抜ける"""
+    while not _stopping:
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WRITE_BEHIND_MAX_DELAY_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            started = time.monotonic()
+            while _pending and not _stopping and time.monotonic() - started < 5:
+                before = len(_pending)
+                await flush_conversations(db)
+                if len(_pending) >= before:
+                    await asyncio.sleep(WRITE_BEHIND_RETRY_SEC)
+                    break
+        except Exception as e:
+            print("❌ conversations 書き出しタスク:", e)
+
+
+def stop() -> None:
+    """ワーカーに終了を頼む（書き込みの途中でキャンセルしない）。残りは drain() で書き切る"""
+    global _stopping
+    _stopping = True
+    _wakeup.set()
+
+
+async def drain(db: Pool, timeout: float = 10.0) -> None:
+    """シャットダウン時に残りを書き切る"""
+    deadline = time.monotonic() + timeout
+    while _pending and time.monotonic() < deadline:
+        before = len(_pending)
+        await flush_conversations(db)
+        if len(_pending) >= before:
+            await asyncio.sleep(0.2)
+    if _pending:
+        print(f"❌ 終了時に conversations {len(_pending)} 行を書き出せませんでした")
@@ -0,0 +1,52 @@
+# utils/fast_json.py
+# ─────────────────────────────
+# 一覧系エンドポイント用の高速 JSON 応答
+#   FastAPI 既定では jsonable_encoder が asyncpg.Record / UUID / datetime を 1 値ずつ Python で変換する。
+#   FAST_JSON=1 のときは orjson で行を直接 bytes 化し、そのまま Response で返す。
+#   出力は既定の JSONResponse（ensure_ascii=False, separators=(",", ":")）とバイト単位で同じ形。
+import json
+import os
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+
+from asyncpg import Record
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:     # orjson が無ければ標準 json で同じ出力を作る
+    orjson = None
+
+FAST_JSON = os.getenv("FAST_JSON", "0") == "1"
+
+
+def _default(obj):
+    if isinstance(obj, Record):
+        return dict(obj)
+    if isinstance(obj, Decimal):
+        # jsonable_encoder と同じ：整数なら int、それ以外は float
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default, ensure_ascii=False,
+                      allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(obj, status_code: int = 200):
+    """FAST_JSON 有効時は bytes 化済みの Response、無効時は obj をそのまま返す（FastAPI 既定の経路）"""
+    if not FAST_JSON:
+        return obj
+    return Response(content=dumps(obj), status_code=status_code, media_type="application/json")
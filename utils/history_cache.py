@@ -0,0 +1,132 @@
+# utils/history_cache.py
+# ─────────────────────────────
+# _prepare_history 用のプロセス内キャッシュ
+#   - チャットごとの直近ターン（古い順、最大で HISTORY_CACHE_MAX_TURNS か、DB から読んだときの窓の大きい方）。保存時（conversation_writer）に追記し、
+#     しばらく書き込みの無いチャットは LRU / アイドル TTL で落とす（書き込みのたびに期限を延ばす）。
+#     外れたら DB から窓の分だけ読む。読んでいる間に書き込みがあったら、読んだ結果はキャッシュしない
+#   - ターンごとの要約（conversations.id → 要約文）。一度要約したターンは二度とモデルに投げない
+#   前提: 同じチャットへの書き込みはこのプロセスだけ（uvicorn 1 プロセス構成）。
+#   複数レプリカで動かすときは HISTORY_CACHE_VERIFY=1 で、使う前に最新ターンの id を DB と突き合わせる。
+import os
+from typing import Dict, Iterable, List, Optional
+
+from utils.cache import LRUCache
+
+HISTORY_CACHE_CHATS     = int(os.getenv("HISTORY_CACHE_CHATS", "5000"))
+HISTORY_CACHE_IDLE_SEC  = int(os.getenv("HISTORY_CACHE_IDLE_SEC", "1800"))
+HISTORY_CACHE_VERIFY    = os.getenv("HISTORY_CACHE_VERIFY", "0") == "1"
+SUMMARY_CACHE_SIZE      = int(os.getenv("SUMMARY_CACHE_SIZE", "50000"))
+# 1 チャットあたり持つ直近ターン数。_prepare_history の窓（FULL_PAIR_LIMIT + SUMMARY_PAIR_MAX）以上にしておく。
+# 窓のほうが大きければ、最初の取りこぼしで DB から読んだときにそのチャットだけ窓の分まで広げる
+HISTORY_CACHE_MAX_TURNS = int(os.getenv("HISTORY_CACHE_MAX_TURNS", "10"))
+
+_turns = LRUCache(HISTORY_CACHE_CHATS, ttl=HISTORY_CACHE_IDLE_SEC)       # chat_id → {"rows", "complete", "cap"}
+_summaries = LRUCache(SUMMARY_CACHE_SIZE, ttl=6 * 3600)                  # 行 id → 要約
+_fetching: Dict[str, List[int]] = {}    # DB から読んでいる最中のチャット → [読み込み数, 書き込み世代]
+
+
+def _key(chat_id) -> str:
+    return str(chat_id).lower()
+
+
+def _turn(row) -> Dict:
+    return {"id": str(row["id"]), "question": row["question"], "answer": row["answer"],
+            "is_root": row["is_root"]}
+
+
+def _entry(rows: List[Dict], complete: bool, cap: int) -> Dict:
+    entry = {"rows": rows, "complete": complete, "cap": cap}
+    _trim(entry)
+    return entry
+
+
+def _trim(entry: Dict) -> None:
+    cap = entry["cap"]
+    if len(entry["rows"]) > cap:
+        entry["rows"] = entry["rows"][-cap:] if cap > 0 else []
+        entry["complete"] = False
+
+
+def _written(key: str) -> None:
+    if key in _fetching:
+        _fetching[key][1] += 1
+
+
+def get_turns(chat_id: str, window: int) -> Optional[List[Dict]]:
+    """直近 window ターン（古い順）。キャッシュに無い・手持ちが窓に足りないときは None"""
+    entry = _turns.get(_key(chat_id))
+    if entry is None:
+        return None
+    rows = entry["rows"]
+    if not entry["complete"] and len(rows) < window:
+        return None
+    return rows[-window:] if window > 0 else []
+
+
+def begin_fetch(chat_id: str) -> int:
+    """DB から読む前に呼び、返った世代を store_turns に渡す（読み終えたら必ず end_fetch）"""
+    entry = _fetching.setdefault(_key(chat_id), [0, 0])
+    entry[0] += 1
+    return entry[1]
+
+
+def end_fetch(chat_id: str) -> None:
+    key = _key(chat_id)
+    entry = _fetching.get(key)
+    if entry is not None:
+        entry[0] -= 1
+        if entry[0] <= 0:
+            del _fetching[key]
+
+
+def store_turns(chat_id: str, rows: Iterable, complete: bool, window: int,
+                generation: Optional[int] = None) -> None:
+    """DB から読んだ直近ターン。complete はルートまで含んでいる（= チャット全体）か。
+    window は読んだ窓で、このチャットはそこまで（HISTORY_CACHE_MAX_TURNS 未満なら HISTORY_CACHE_MAX_TURNS まで）持つ。
+    generation（begin_fetch の戻り値）以降にこのチャットへの書き込みがあれば、読んだ結果は古いので捨てる"""
+    key = _key(chat_id)
+    if generation is not None and key in _fetching and _fetching[key][1] != generation:
+        return
+    _turns.set(key, _entry([_turn(r) for r in rows], complete, max(window, HISTORY_CACHE_MAX_TURNS)))
+
+
+def record_turn(row) -> None:
+    """保存したターンを追記する。新規チャットはここから始め、知らないチャットは次回 DB から読む"""
+    key = _key(row["chat_id"])
+    _written(key)
+    entry = _turns.get(key)
+    if entry is None:
+        if row["is_root"]:
+            _turns.set(key, _entry([_turn(row)], True, HISTORY_CACHE_MAX_TURNS))
+        return
+    entry["rows"].append(_turn(row))
+    _trim(entry)
+    _turns.set(key, entry)      # 期限を延ばす（アイドル TTL = 最後の書き込みから。archive の判定もこれに合わせている）
+
+
+def newest_id(chat_id: str) -> Optional[str]:
+    entry = _turns.get(_key(chat_id))
+    return entry["rows"][-1]["id"] if entry and entry["rows"] else None
+
+
+def forget_chat(chat_id: str) -> None:
+    key = _key(chat_id)
+    _written(key)
+    _turns.delete(key)
+
+
+def get_summary(turn_id: str) -> Optional[str]:
+    return _summaries.get(str(turn_id))
+
+
+def store_summary(turn_id: str, summary: str) -> None:
+    _summaries.set(str(turn_id), summary)
+
+
+def clear() -> None:
+    _turns.clear()
+    _summaries.clear()
+
+
+def stats() -> Dict:
+    return {"turns": _turns.stats(), "summaries": _summaries.stats()}
@@ -0,0 +1,158 @@
+# utils/idempotency.py
+# ─────────────────────────────
+# Idempotency-Key ヘッダ付きリクエストの重複排除（/chat・/new_chat）
+#   - 同じキーの 2 回目以降は保存済みの結果をそのまま返す（トークン消費・モデル呼び出し・INSERT なし）
+#   - 1 回目がまだ処理中なら、同じプロセス内ではその結果を待ち合わせる。
+#     別プロセスで処理中なら idempotency_keys の行が done になるまで待つ
+#   - キーは (user_id, route, key) 単位。同じキーで中身の違うリクエストは 422
+#   - 失敗したリクエストはキーを解放するので、クライアントはそのまま再送できる
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from asyncpg import Pool
+from fastapi import HTTPException
+
+from utils.cache import LRUCache
+
+IDEMPOTENCY_TTL_SEC    = int(os.getenv("IDEMPOTENCY_TTL_SEC", str(24 * 3600)))
+IDEMPOTENCY_LEASE_SEC  = 120     # 処理中の行がこれより古ければ、持ち主は落ちたとみなす
+IDEMPOTENCY_RENEW_SEC  = 30      # 処理中はこの間隔でリースを延ばす（モデル呼び出しが長引いても奪われない）
+IDEMPOTENCY_WAIT_SEC   = 90      # 別プロセスの処理完了を待つ上限
+IDEMPOTENCY_POLL_SEC   = 0.5
+IDEMPOTENCY_SWEEP_SEC  = 600
+MAX_KEY_LENGTH         = 255
+
+_done = LRUCache(int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")), ttl=IDEMPOTENCY_TTL_SEC)
+_inflight: Dict[Tuple[str, str, str], asyncio.Future] = {}
+
+
+def fingerprint(payload: Dict) -> str:
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _check(stored_fp: str, fp: str) -> None:
+    if stored_fp != fp:
+        raise HTTPException(status_code=422, detail="同じ Idempotency-Key が別の内容のリクエストに使われています。")
+
+
+async def run_idempotent(db: Pool, route: str, user_id: str, key: Optional[str], fp: str,
+                         fn: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, bool]:
+    """(結果, 再送かどうか) を返す。key が無ければ fn をそのまま実行する"""
+    if not key:
+        return await fn(), False
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key が長すぎます。")
+
+    ck = (route, user_id, key)
+    cached = _done.get(ck)
+    if cached is not None:
+        _check(cached[0], fp)
+        return cached[1], True
+
+    running = _inflight.get(ck)
+    if running is not None:
+        stored_fp, result = await asyncio.shield(running)
+        _check(stored_fp, fp)
+        return result, True
+
+    fut = asyncio.get_running_loop().create_future()
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())   # 待ち手がいなくても警告を出さない
+    _inflight[ck] = fut
+    try:
+        stored_fp, result, replayed = await _run_owned(db, route, user_id, key, fp, fn)
+        fut.set_result((stored_fp, result))
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        _inflight.pop(ck, None)
+
+    _done.set(ck, (stored_fp, result))
+    _check(stored_fp, fp)
+    return result, replayed
+
+
+async def _run_owned(db: Pool, route: str, user_id: str, key: str, fp: str, fn):
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SEC
+    while True:
+        # 期限切れ（処理中のまま放置された行を含む）なら取り直す
+        claimed = await db.fetchval("""
+            INSERT INTO idempotency_keys (user_id, route, key, fingerprint, expires_at)
+            VALUES ($1, $2, $3, $4, now() + make_interval(secs => $5))
+            ON CONFLICT (user_id, route, key) DO UPDATE
+            SET fingerprint = EXCLUDED.fingerprint, status = 'running', response = NULL,
+                created_at = now(), expires_at = EXCLUDED.expires_at
+            WHERE idempotency_keys.expires_at < now()
+            RETURNING 1
+        """, user_id, route, key, fp, float(IDEMPOTENCY_LEASE_SEC))
+        if claimed:
+            break
+        row = await db.fetchrow("""
+            SELECT fingerprint, status, response FROM idempotency_keys
+            WHERE user_id = $1 AND route = $2 AND key = $3
+        """, user_id, route, key)
+        if row:
+            _check(row["fingerprint"], fp)
+            if row["status"] == "done":
+                return row["fingerprint"], json.loads(row["response"]), True
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=409, detail="同じリクエストを処理中です。少し待ってからお試しください。")
+        await asyncio.sleep(IDEMPOTENCY_POLL_SEC)
+
+    renew = asyncio.create_task(_renew_lease(db, route, user_id, key))
+    try:
+        result = await fn()
+    except BaseException:
+        try:
+            await db.execute("""
+                DELETE FROM idempotency_keys WHERE user_id = $1 AND route = $2 AND key = $3
+            """, user_id, route, key)
+        except Exception as e:
+            print("⚠️ Idempotency-Key の解放失敗（リース切れで取り直される）:", e)
+        raise
+    finally:
+        renew.cancel()
+
+    await db.execute("""
+        UPDATE idempotency_keys
+        SET status = 'done', response = $4::jsonb, expires_at = now() + make_interval(secs => $5)
+        WHERE user_id = $1 AND route = $2 AND key = $3
+    """, user_id, route, key, json.dumps(result, ensure_ascii=False), float(IDEMPOTENCY_TTL_SEC))
+    return fp, result, False
+
+
+async def _renew_lease(db: Pool, route: str, user_id: str, key: str) -> None:
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_RENEW_SEC)
+        try:
+            await db.execute("""
+                UPDATE idempotency_keys SET expires_at = now() + make_interval(secs => $4)
+                WHERE user_id = $1 AND route = $2 AND key = $3 AND status = 'running'
+            """, user_id, route, key, float(IDEMPOTENCY_LEASE_SEC))
+        except Exception as e:
+            print("⚠️ Idempotency-Key のリース延長失敗:", e)
+
+
+async def idempotency_sweeper(db: Pool):
+    """lifespan から起動する常駐タスク。期限切れのキーを少しずつ消す"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_SWEEP_SEC)
+        try:
+            while True:
+                status = await db.execute("""
+                    DELETE FROM idempotency_keys WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM idempotency_keys WHERE expires_at < now() LIMIT 1000
+                    ))
+                """)
+                if int(status.split()[-1]) < 1000:
+                    break
+                await asyncio.sleep(0.05)
+        except Exception as e:
+            print("❌ Idempotency-Key の掃除失敗:", e)
@@ -6,15 +6,35 @@ import random
 import string
 
 import os
+import threading
+from zoneinfo import ZoneInfo
 from asyncpg import Pool
 from fastapi import Depends, Request
-from supabase import create_client    # ← クライアントを生成
 from dotenv import load_dotenv
 
 load_dotenv()
 SUPABASE_URL  = os.getenv("SUPABASE_URL")
 SUPABASE_KEY  = os.getenv("SUPABASE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)  # ← これが本物の client
+# 「1 日」の境界。日次リセット・usage_daily・夜間リセット（main.py）で共通。サーバーのローカル時刻には依存しない
+SERVICE_TZ    = ZoneInfo(os.getenv("SERVICE_TZ", "Asia/Tokyo"))
+
+
+def service_today() -> date:
+    return datetime.now(SERVICE_TZ).date()
+
+# Supabase クライアントはプロセスで 1 つだけ。初回アクセス時に生成する
+# （import 時に作ると起動が遅くなるので、lifespan から裏で温める）
+_supabase = None
+_supabase_lock = threading.Lock()
+
+def get_supabase():
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                from supabase import create_client
+                _supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase
 
 async def get_db(request: Request):
     return request.app.state.db_pool
@@ -39,6 +59,7 @@ def save_chat_pair_to_storage(chat_id: str, user_message: str, assistant_message
     file_name = f"chat_{chat_id}.json"
     now = datetime.utcnow().isoformat()
 
+    supabase = get_supabase()
     try:
         res = supabase.storage.from_(bucket_name).download(file_name)
         existing_data = json.loads(res.decode("utf-8"))
@@ -69,7 +90,7 @@ def save_message_pair_to_storage(chat_id: str, user_message: str, assistant_mess
 
 # 毎日初めてアクセスされた時にリセットする
 async def reset_daily_if_needed(db, user_id: str):
-    today = date.today()
+    today = service_today()
     row = await db.fetchrow("""
         SELECT last_reset_date FROM user_tokens WHERE user_id = $1
     """, user_id)
@@ -123,16 +144,53 @@ async def check_token_limit_and_log(user_id: str, tokens_used: int, db_pool: Poo
         return True
 
 
-# 報酬付与（広告視聴）
-async def reward_tokens_for_ad(user_id: str, reward_amount: int, db):
-    async with db.acquire() as db:
-        await reset_daily_if_needed(db, user_id)
-
-        await db.execute("""
-            UPDATE user_tokens
+# 予約しすぎた分の返却（check_token_limit_and_log で引いた分を戻す）
+async def refund_tokens(user_id: str, tokens: int, db_pool: Pool) -> None:
+    await db_pool.execute("""
+        UPDATE user_tokens
+        SET
+          tokens_remaining = tokens_remaining + $2,
+          total_used = GREATEST(total_used - $2, 0),
+          daily_used = GREATEST(daily_used - $2, 0)
+        WHERE user_id = $1
+    """, user_id, tokens)
+
+
+_CREDIT_AD_REWARD_SQL = """
+        WITH ledger AS (
+            INSERT INTO admob_reward_ledger (transaction_id, user_id, reward_amount, tokens)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (transaction_id) DO NOTHING
+            RETURNING user_id, tokens
+        ), credited AS (
+            UPDATE user_tokens t
             SET
-              tokens_remaining = tokens_remaining + $2,
-              total_rewarded = total_rewarded + $2,
-              daily_rewarded = daily_rewarded + $2
-            WHERE user_id = $1
-        """, user_id, reward_amount)
+              tokens_remaining = t.tokens_remaining + l.tokens,
+              total_rewarded   = t.total_rewarded + l.tokens,
+              daily_used       = CASE WHEN t.last_reset_date = $5 THEN t.daily_used ELSE 0 END,
+              daily_rewarded   = CASE WHEN t.last_reset_date = $5 THEN t.daily_rewarded ELSE 0 END + l.tokens,
+              last_reset_date  = $5
+            FROM ledger l
+            WHERE t.user_id = l.user_id
+            RETURNING t.user_id
+        )
+        SELECT (SELECT count(*) FROM ledger) AS recorded,
+               (SELECT count(*) FROM credited) AS credited
+"""
+
+
+# 広告報酬（AdMob SSV）: 台帳への記録と付与を 1 トランザクションで行う
+#   transaction_id が台帳にあれば何もしない（再送）。日付が変わっていれば日次カウンタも同時にリセット。
+#   user_tokens 行がまだ無いユーザーは先に既定値で作る（台帳だけ記録されて付与が漏れることがないように）。
+#   戻り値: "credited" / "duplicate"
+async def credit_ad_reward(db, transaction_id: str, user_id: str, reward_amount: int, tokens: int) -> str:
+    today = service_today()
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO user_tokens (user_id, last_reset_date) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO NOTHING
+            """, user_id, today)
+            row = await conn.fetchrow(_CREDIT_AD_REWARD_SQL, transaction_id, user_id, reward_amount, tokens, today)
+    return "credited" if row["recorded"] else "duplicate"
+
@@ -0,0 +1,259 @@
+# utils/loop_monitor.py
+# ─────────────────────────────
+# イベントループの遅延（lag）監視
+#   - サンプラ（ループ上のタスク）: LOOP_LAG_INTERVAL_MS ごとに眠り、予定より何 ms 遅れて起きたかをヒストグラムに積む
+#   - 見張り（別スレッド）: サンプラの心拍が LOOP_LAG_THRESHOLD_MS 以上止まったら、その時点のループスレッドの
+#     スタックを sys._current_frames() で取り、どのルート・どのコード位置で止まっているかを記録する
+#     （ルートは LoopMonitorMiddleware のフレームに残っている scope から引く。無ければバックグラウンド処理）
+#   - /diagnostics/loop_lag で全体とルートごとのヒストグラム、直近の停止を見られる
+#   - fail_on_blocking(): テスト・デバッグ用。ブロック内で予算を超えて止まったら BlockingCallError
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+LOOP_MONITOR_ENABLED  = os.getenv("LOOP_MONITOR_ENABLED", "1") == "1"
+LOOP_LAG_INTERVAL_MS  = float(os.getenv("LOOP_LAG_INTERVAL_MS", "50"))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))   # これ以上止まったら停止として記録
+LOOP_BLOCK_BUDGET_MS  = float(os.getenv("LOOP_BLOCK_BUDGET_MS", "50"))     # fail_on_blocking の既定予算
+LOOP_LAG_EVENTS       = 50       # 直近の停止をいくつ持つか
+LOOP_LAG_MAX_ROUTES   = 200      # ルート別集計の上限（超えた分は "other"）
+STACK_DEPTH           = 25
+
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_ROOT = Path(__file__).resolve().parent.parent
+
+
+class BlockingCallError(AssertionError):
+    pass
+
+
+# 設定（fail_on_blocking が一時的に書き換える）
+_interval = LOOP_LAG_INTERVAL_MS / 1000
+_threshold = LOOP_LAG_THRESHOLD_MS / 1000
+
+# ループ側の状態
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread_id: Optional[int] = None
+_task: Optional[asyncio.Task] = None
+_heartbeat = 0.0        # サンプラが最後に眠りに入った時刻（monotonic）
+_watchdog: Optional[threading.Thread] = None
+
+# 集計
+_lock = threading.Lock()
+_hist = [0] * (len(LAG_BUCKETS_MS) + 1)
+_samples = 0
+_max_lag = 0.0
+_routes: Dict[str, Dict] = {}
+_events: deque = deque(maxlen=LOOP_LAG_EVENTS)
+_seq = 0
+_pending: Optional[Dict] = None     # 見張りが捕まえた、まだ終わっていない停止
+
+
+def _bucket(lag_ms: float) -> int:
+    for i, upper in enumerate(LAG_BUCKETS_MS):
+        if lag_ms <= upper:
+            return i
+    return len(LAG_BUCKETS_MS)
+
+
+def _hist_dict(hist: List[int]) -> Dict[str, int]:
+    labels = [f"<={b}" for b in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}"]
+    return dict(zip(labels, hist))
+
+
+# ──────────────────────────────
+# スタックの解析（見張りスレッドから）
+# ──────────────────────────────
+def _route_name(scope) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path is None:
+        endpoint = scope.get("endpoint")
+        path = getattr(endpoint, "__name__", None) or scope.get("path", "?")
+    return f"{scope.get('method', '')} {path}".strip()
+
+
+def _route_of(frame) -> Optional[str]:
+    while frame is not None:
+        if frame.f_code is LoopMonitorMiddleware.__call__.__code__:
+            scope = frame.f_locals.get("scope")
+            return _route_name(scope) if scope else None
+        frame = frame.f_back
+    return None
+
+
+def _is_app_file(filename: str) -> bool:
+    path = Path(filename)
+    return (path.is_absolute() and _ROOT in path.parents and "site-packages" not in path.parts
+            and path.name != "loop_monitor.py")
+
+
+def _capture(heartbeat: float, stalled: float) -> None:
+    global _pending, _seq
+    frame = sys._current_frames().get(_loop_thread_id)
+    if frame is None:
+        return
+    stack = traceback.extract_stack(frame)
+    location = next((f"{Path(fs.filename).relative_to(_ROOT)}:{fs.lineno} in {fs.name}"
+                     for fs in reversed(stack) if _is_app_file(fs.filename)), None)
+    with _lock:
+        _seq += 1
+        event = {
+            "seq": _seq, "at": time.time(), "lag_ms": round(stalled * 1000, 1), "finished": False,
+            "route": _route_of(frame) or "(background)", "location": location,
+            "stack": [f"{fs.filename}:{fs.lineno} in {fs.name}" for fs in stack[-STACK_DEPTH:]],
+            "heartbeat": heartbeat,
+        }
+        _events.append(event)
+        _pending = event
+
+
+def _watch() -> None:
+    captured = None
+    while True:
+        time.sleep(max(0.005, min(_interval, _threshold) / 4))
+        loop, heartbeat = _loop, _heartbeat
+        if loop is None or loop.is_closed() or not loop.is_running():
+            continue
+        stalled = time.monotonic() - heartbeat - _interval
+        pending = _pending
+        if pending is not None and pending["heartbeat"] == heartbeat and not pending["finished"]:
+            pending["lag_ms"] = round(stalled * 1000, 1)    # 止まっている間は伸ばしていく
+        if stalled >= _threshold and captured != heartbeat:
+            captured = heartbeat
+            try:
+                _capture(heartbeat, stalled)
+            except Exception as e:
+                print("❌ ループ監視のスタック取得失敗:", e)
+
+
+# ──────────────────────────────
+# サンプラ（ループ上）
+# ──────────────────────────────
+def _record(lag: float, heartbeat: float) -> None:
+    global _samples, _max_lag, _pending, _seq
+    lag_ms = lag * 1000
+    with _lock:
+        _samples += 1
+        _hist[_bucket(lag_ms)] += 1
+        _max_lag = max(_max_lag, lag_ms)
+        if lag < _threshold:
+            return
+
+        event = _pending if _pending is not None and _pending["heartbeat"] == heartbeat else None
+        _pending = None
+        if event is None:
+            # 見張りが間に合わなかった（閾値ぎりぎりの短い停止）。スタック無しで残す
+            _seq += 1
+            event = {"seq": _seq, "at": time.time(), "route": "(unknown)", "location": None,
+                     "stack": [], "heartbeat": heartbeat}
+            _events.append(event)
+        event["lag_ms"], event["finished"] = round(lag_ms, 1), True
+
+        route = event["route"] if event["route"] in _routes or len(_routes) < LOOP_LAG_MAX_ROUTES else "other"
+        stats = _routes.setdefault(route, {"stalls": 0, "max_ms": 0.0, "total_ms": 0.0,
+                                           "hist": [0] * (len(LAG_BUCKETS_MS) + 1), "locations": {}})
+        stats["stalls"] += 1
+        stats["max_ms"] = max(stats["max_ms"], lag_ms)
+        stats["total_ms"] += lag_ms
+        stats["hist"][_bucket(lag_ms)] += 1
+        if event["location"]:
+            stats["locations"][event["location"]] = stats["locations"].get(event["location"], 0) + 1
+
+    print(f"⚠️ イベントループが {lag_ms:.0f}ms 止まりました: {event['route']} {event['location'] or ''}")
+
+
+async def loop_lag_sampler():
+    """ensure_started() から起動する。最初の 1 回は起動を頼まれた時刻から測る（起動直後の停止も拾う）"""
+    global _loop, _heartbeat
+    loop = asyncio.get_running_loop()
+    started = _heartbeat
+    try:
+        while True:
+            interval = _interval
+            await asyncio.sleep(interval)
+            _record(max(0.0, time.monotonic() - started - interval), started)
+            _heartbeat = started = time.monotonic()
+    finally:
+        if _loop is loop:
+            _loop = None
+
+
+def ensure_started() -> Optional[asyncio.Task]:
+    """実行中のループでサンプラと見張りスレッドを動かす（lifespan とミドルウェアから呼ぶ）"""
+    global _task, _watchdog, _loop, _loop_thread_id, _heartbeat
+    if not LOOP_MONITOR_ENABLED:
+        return None
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _loop, _loop_thread_id, _heartbeat = loop, threading.get_ident(), time.monotonic()
+        _task = loop.create_task(loop_lag_sampler())
+    if _watchdog is None:
+        _watchdog = threading.Thread(target=_watch, name="loop-monitor", daemon=True)
+        _watchdog.start()
+    return _task
+
+
+class LoopMonitorMiddleware:
+    """リクエストの処理中はこのフレームがループのスタックに残るので、見張りはここから scope を読む"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and LOOP_MONITOR_ENABLED:
+            ensure_started()
+        return await self.app(scope, receive, send)
+
+
+# ──────────────────────────────
+# 参照・テスト用
+# ──────────────────────────────
+def stats() -> Dict:
+    with _lock:
+        return {
+            "enabled": LOOP_MONITOR_ENABLED,
+            "interval_ms": _interval * 1000,
+            "threshold_ms": _threshold * 1000,
+            "samples": _samples,
+            "max_lag_ms": round(_max_lag, 1),
+            "histogram_ms": _hist_dict(_hist),
+            "routes": {
+                route: {"stalls": s["stalls"], "max_ms": round(s["max_ms"], 1),
+                        "total_ms": round(s["total_ms"], 1), "histogram_ms": _hist_dict(s["hist"]),
+                        "locations": dict(sorted(s["locations"].items(), key=lambda kv: -kv[1]))}
+                for route, s in sorted(_routes.items(), key=lambda kv: -kv[1]["total_ms"])
+            },
+            "recent": [{k: v for k, v in e.items() if k != "heartbeat"} for e in reversed(_events)],
+        }
+
+
+@contextmanager
+def fail_on_blocking(budget_ms: float = LOOP_BLOCK_BUDGET_MS):
+    """ブロック内でイベントループが budget_ms 以上止まったら BlockingCallError を投げる。
+    例: with fail_on_blocking(50): client.post("/chat", json=...)
+    （TestClient でもミドルウェア経由でサンプラが動く。LOOP_MONITOR_ENABLED=0 だと何も検出しない）"""
+    global _interval, _threshold
+    saved = (_interval, _threshold)
+    _threshold = budget_ms / 1000
+    _interval = min(saved[0], _threshold / 4)
+    start = _seq
+    try:
+        yield
+    finally:
+        _interval, _threshold = saved
+    with _lock:
+        blocked = [e for e in _events if e["seq"] > start]
+    if blocked:
+        lines = [f"  {e['lag_ms']}ms {e['route']} {e['location'] or ''}" for e in blocked]
+        stack = "\n".join("    " + s for s in blocked[0]["stack"])
+        raise BlockingCallError(f"イベントループが {budget_ms}ms 以上止まりました:\n" + "\n".join(lines)
+                                + f"\n  最初の停止のスタック:\n{stack}")
@@ -0,0 +1,310 @@
+# utils/purge.py
+# ─────────────────────────────
+# ユーザー削除のバックグラウンドパイプライン
+#   /api/delete_user はジョブを積むだけで即返し、ここのワーカーが
+#   Auth ユーザー → chat-logs ストレージ + conversations → 退避済みチャット → favorites → shared_words →
+#   user_tokens / user_streaks / daily_draws / admob_reward_ledger / idempotency_keys / usage_daily の順に、小さなバッチで削除していく。
+#   進捗は user_purge_jobs に残るので、再起動しても途中のステップから再開できる。
+import asyncio
+import json
+import os
+import uuid
+from typing import Dict, Optional
+
+from asyncpg import Pool
+
+from utils import history_cache, trending
+from utils.archive import ARCHIVE_BUCKET
+from utils.conversation_writer import discard_user
+from utils.init import get_supabase
+from utils.shared_word_cache import invalidate_shared_word
+from utils.usage_rollup import forget_user
+
+PURGE_BATCH_SIZE      = int(os.getenv("PURGE_BATCH_SIZE", "500"))   # 1 DELETE あたりの最大行数
+PURGE_CHAT_BATCH      = int(os.getenv("PURGE_CHAT_BATCH", "50"))    # 1 回で消すチャット数（ストレージ込み）
+PURGE_BATCH_PAUSE_SEC = 0.05     # バッチ間で他のリクエストに譲る
+PURGE_POLL_SEC        = 30       # 起こされなくても定期的にキューを見る
+PURGE_STALE_MIN       = 5        # running のまま更新が止まったジョブを再取得するまでの分数
+PURGE_HEARTBEAT_SEC   = 60       # 実行中は updated_at をこの間隔で更新する（PURGE_STALE_MIN より十分短く）
+PURGE_MAX_ATTEMPTS    = 5
+
+CHAT_LOG_BUCKET       = "chat-logs"
+
+# user_id 列で消すだけのテーブル（ステップ名 = テーブル名）
+_SIMPLE_TABLES = ("user_tokens", "user_streaks", "daily_draws", "admob_reward_ledger",
+                  "idempotency_keys")
+
+_wakeup = asyncio.Event()
+
+
+# ──────────────────────────────
+# 受付 & 状態取得
+# ──────────────────────────────
+async def enqueue_purge(db: Pool, user_id: str) -> str:
+    """削除ジョブを登録して job_id を返す（未完了ジョブがあればそれを返す）"""
+    job_id = await db.fetchval("""
+        INSERT INTO user_purge_jobs (id, user_id)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) WHERE status IN ('pending', 'running')
+        DO UPDATE SET updated_at = user_purge_jobs.updated_at
+        RETURNING id
+    """, uuid.uuid4(), user_id)
+    _wakeup.set()
+    return str(job_id)
+
+
+async def get_purge_job(db: Pool, job_id: str) -> Optional[Dict]:
+    row = await db.fetchrow("""
+        SELECT id, user_id, status, step, deleted, attempts, last_error,
+               created_at, updated_at, finished_at
+        FROM user_purge_jobs WHERE id = $1
+    """, job_id)
+    if not row:
+        return None
+    job = dict(row)
+    job["deleted"] = json.loads(job["deleted"]) if isinstance(job["deleted"], str) else job["deleted"]
+    return job
+
+
+# ──────────────────────────────
+# ステップ
+# ──────────────────────────────
+async def _delete_batched(db: Pool, sql: str, *args) -> int:
+    """sql は LIMIT $n 付きで「今回消す分」を選ぶ DELETE。0 件になるまで繰り返す"""
+    total = 0
+    while True:
+        status = await db.execute(sql, *args)
+        n = int(status.split()[-1])
+        total += n
+        if n == 0:
+            return total
+        await asyncio.sleep(PURGE_BATCH_PAUSE_SEC)
+
+
+async def _step_auth(db: Pool, user_id: str) -> int:
+    try:
+        await asyncio.to_thread(get_supabase().auth.admin.delete_user, user_id)
+    except Exception as e:
+        # 再開時はすでに消えている
+        if "not found" not in str(e).lower():
+            raise
+    return 1
+
+
+async def _step_chats(db: Pool, user_id: str) -> int:
+    """chat-logs のファイルと conversations の行を、チャット単位でまとめて消す"""
+    total = 0
+    discard_user(user_id)   # write-behind の未 flush 分が削除後に書かれないように
+    storage = get_supabase().storage.from_(CHAT_LOG_BUCKET)
+    while True:
+        rows = await db.fetch("""
+            SELECT DISTINCT chat_id FROM conversations WHERE user_id = $1 LIMIT $2
+        """, user_id, PURGE_CHAT_BATCH)
+        if not rows:
+            return total
+        chat_ids = [r["chat_id"] for r in rows]
+        for cid in chat_ids:
+            history_cache.forget_chat(cid)
+        await asyncio.to_thread(storage.remove, [f"chat_{cid}.json" for cid in chat_ids])
+        status = await db.execute("""
+            DELETE FROM conversations WHERE user_id = $1 AND chat_id = ANY($2::uuid[])
+        """, user_id, chat_ids)
+        total += int(status.split()[-1])
+        await asyncio.sleep(PURGE_BATCH_PAUSE_SEC)
+
+
+async def _step_archives(db: Pool, user_id: str) -> int:
+    """退避済みチャット（chat-archives のオブジェクト、chat-logs のログ、conversation_archives の行）"""
+    total = 0
+    storage = get_supabase().storage.from_(ARCHIVE_BUCKET)
+    chat_logs = get_supabase().storage.from_(CHAT_LOG_BUCKET)
+    while True:
+        rows = await db.fetch("""
+            SELECT chat_id, object_path FROM conversation_archives WHERE user_id = $1 LIMIT $2
+        """, user_id, PURGE_CHAT_BATCH)
+        if not rows:
+            return total
+        await asyncio.to_thread(storage.remove, [r["object_path"] for r in rows])
+        # conversations に行が無いので _step_chats からは見えない
+        await asyncio.to_thread(chat_logs.remove, [f"chat_{r['chat_id']}.json" for r in rows])
+        status = await db.execute("""
+            DELETE FROM conversation_archives WHERE chat_id = ANY($1::uuid[])
+        """, [r["chat_id"] for r in rows])
+        total += int(status.split()[-1])
+        await asyncio.sleep(PURGE_BATCH_PAUSE_SEC)
+
+
+async def _step_liked_by_others(db: Pool, user_id: str) -> int:
+    """このユーザーの共有に付いた他人のいいね"""
+    return await _delete_batched(db, """
+        DELETE FROM favorites WHERE id IN (
+            SELECT f.id FROM favorites f
+            JOIN shared_words s ON f.shared_id = s.id
+            WHERE s.user_id = $1 LIMIT $2
+        )
+    """, user_id, PURGE_BATCH_SIZE)
+
+
+async def _step_shared_words(db: Pool, user_id: str) -> int:
+    total = 0
+    while True:
+        rows = await db.fetch("""
+            DELETE FROM shared_words WHERE id IN (
+                SELECT id FROM shared_words WHERE user_id = $1 LIMIT $2
+            )
+            RETURNING id, share_slug
+        """, user_id, PURGE_BATCH_SIZE)
+        if not rows:
+            return total
+        for r in rows:
+            invalidate_shared_word(r["share_slug"])
+        trending.forget(r["id"] for r in rows)
+        total += len(rows)
+        await asyncio.sleep(PURGE_BATCH_PAUSE_SEC)
+
+
+async def _step_favorites(db: Pool, user_id: str) -> int:
+    """このユーザーが付けたいいね。付いていた共有の急上昇スコアは数え直す"""
+    total = 0
+    while True:
+        # 消すのと数え直すのを同じトランザクションで（間で落ちてもスコアだけ古いまま残らない）
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch("""
+                    DELETE FROM favorites WHERE id IN (
+                        SELECT id FROM favorites WHERE user_id = $1 LIMIT $2
+                    )
+                    RETURNING shared_id
+                """, user_id, PURGE_BATCH_SIZE)
+                await trending.recompute_scores(conn, list({r["shared_id"] for r in rows}))
+        if not rows:
+            return total
+        trending.mark_stale()
+        total += len(rows)
+        await asyncio.sleep(PURGE_BATCH_PAUSE_SEC)
+
+
+def _simple_step(table: str):
+    async def step(db: Pool, user_id: str) -> int:
+        return await _delete_batched(db, f"""
+            DELETE FROM {table} WHERE ctid = ANY(ARRAY(
+                SELECT ctid FROM {table} WHERE user_id = $1 LIMIT $2
+            ))
+        """, user_id, PURGE_BATCH_SIZE)
+    return step
+
+
+async def _step_usage(db: Pool, user_id: str) -> int:
+    forget_user(user_id)    # 未 flush の分が消した後に書き戻されないように
+    return await _simple_step("usage_daily")(db, user_id)
+
+
+PURGE_STEPS = [
+    ("auth",           _step_auth),
+    ("chats",          _step_chats),
+    ("archives",       _step_archives),
+    ("liked_by_others", _step_liked_by_others),
+    ("shared_words",   _step_shared_words),
+    ("favorites",      _step_favorites),
+    *[(t, _simple_step(t)) for t in _SIMPLE_TABLES],
+    ("usage_daily",    _step_usage),
+]
+
+
+# ──────────────────────────────
+# ワーカー
+# ──────────────────────────────
+async def _claim_job(db: Pool):
+    return await db.fetchrow(f"""
+        UPDATE user_purge_jobs
+        SET status = 'running', attempts = attempts + 1, updated_at = now()
+        WHERE id = (
+            SELECT id FROM user_purge_jobs
+            WHERE status = 'pending'
+               OR (status = 'running' AND updated_at < now() - interval '{PURGE_STALE_MIN} minutes')
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, step, deleted, attempts
+    """)
+
+
+async def _heartbeat(db: Pool, job_id) -> None:
+    """長いステップの途中で別のワーカーに取り直されないよう、updated_at を更新し続ける"""
+    while True:
+        await asyncio.sleep(PURGE_HEARTBEAT_SEC)
+        try:
+            await db.execute("""
+                UPDATE user_purge_jobs SET updated_at = now() WHERE id = $1 AND status = 'running'
+            """, job_id)
+        except Exception as e:
+            print("❌ 削除ジョブの updated_at 更新失敗:", e)
+
+
+async def _run_job(db: Pool, job) -> None:
+    heartbeat = asyncio.create_task(_heartbeat(db, job["id"]))
+    try:
+        await _run_steps(db, job)
+    finally:
+        heartbeat.cancel()
+
+
+async def _run_steps(db: Pool, job) -> None:
+    job_id, user_id = job["id"], str(job["user_id"])
+    deleted = job["deleted"]
+    deleted = json.loads(deleted) if isinstance(deleted, str) else dict(deleted or {})
+    names = [name for name, _ in PURGE_STEPS]
+    start = names.index(job["step"]) if job["step"] in names else 0
+
+    for name, step in PURGE_STEPS[start:]:
+        await db.execute("""
+            UPDATE user_purge_jobs SET step = $2, updated_at = now() WHERE id = $1
+        """, job_id, name)
+        deleted[name] = deleted.get(name, 0) + await step(db, user_id)
+        await db.execute("""
+            UPDATE user_purge_jobs SET deleted = $2::jsonb, updated_at = now() WHERE id = $1
+        """, job_id, json.dumps(deleted))
+
+    await db.execute("""
+        UPDATE user_purge_jobs
+        SET status = 'done', step = NULL, last_error = NULL, finished_at = now(), updated_at = now()
+        WHERE id = $1
+    """, job_id)
+    print(f"🧹 ユーザー削除完了 {user_id}: {deleted}")
+
+
+async def purge_worker(db: Pool):
+    """lifespan から起動する常駐タスク。ジョブを 1 件ずつ処理する"""
+    while True:
+        _wakeup.clear()
+        try:
+            job = await _claim_job(db)
+        except Exception as e:
+            print("❌ 削除ジョブ取得失敗:", e)
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=PURGE_POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            await _run_job(db, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ ユーザー削除失敗 {job['user_id']}: {e}")
+            failed = job["attempts"] >= PURGE_MAX_ATTEMPTS
+            try:
+                await db.execute("""
+                    UPDATE user_purge_jobs
+                    SET status = $2, last_error = $3, updated_at = now()
+                    WHERE id = $1
+                """, job["id"], "failed" if failed else "pending", str(e)[:1000])
+            except Exception as e2:
+                # DB ごと落ちているときは running のまま残り、PURGE_STALE_MIN 後に取り直される
+                print(f"❌ 削除ジョブの失敗記録に失敗 {job['id']}: {e2}")
+            await asyncio.sleep(PURGE_POLL_SEC)
@@ -0,0 +1,236 @@
+# utils/rate_limit.py
+# ─────────────────────────────
+# チャット系エンドポイントの手前に置くトークンバケット式レートリミッタ（ASGI ミドルウェア）
+#   - キーはクライアント IP と user_id（クエリ or JSON ボディ）の 2 本立て。両方のバケットから 1 つずつ引く
+#     - IP: X-Forwarded-For は信頼するプロキシが付けた右端 TRUSTED_PROXY_HOPS 個目を使う
+#       （左側はクライアントが自由に書けるので使わない）。NAT 共有を考えて RATE_LIMIT_IP_FACTOR 倍まで許す
+#     - user_id: 認証されていないので付け替えれば逃げられるが、そのときも IP のバケットは逃げられない。
+#       NAT の内側の 1 ユーザーが IP 分の枠を使い切らないためのもの
+#   - ボディは先頭 MAX_BODY_PEEK バイトまでしか溜めない（それを超えるボディからは user_id を読まず、
+#     溜めた分を流したあとは後段に直接つなぐ）
+#   - ルートごとに rate（1 秒あたり補充数）と burst（バケット容量）を持つ
+#   - DB に触る前に 429 + Retry-After を返す
+#   - メモリ版は件数上限つき LRU。満タンまで回復したバケットは新規と同じなので捨ててよい
+#   - RATE_LIMIT_REDIS_URL を設定すると複数レプリカで共有（Redis 障害時はメモリ版で継続）
+import json
+import math
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import parse_qs
+
+RATE_LIMIT_ENABLED   = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_MAX_KEYS  = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_IP_FACTOR = 4          # NAT 共有を考えて、下の 1 ユーザー想定の値の何倍まで 1 IP に許すか
+MAX_BODY_PEEK        = 64 * 1024  # これより大きいボディからは user_id を読まない
+# 前段のプロキシ（Railway のエッジなど）の段数。0 なら X-Forwarded-For を見ず、接続元アドレスを使う
+TRUSTED_PROXY_HOPS   = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+# (method, パス正規表現) → (rate/秒, burst)。user_id 単位の値（IP 単位では RATE_LIMIT_IP_FACTOR 倍）
+ROUTE_LIMITS = [
+    ("POST", re.compile(r"^/chat$"),                        (1 / 5,  5)),   # 平均 12 回/分
+    ("POST", re.compile(r"^/new_chat$"),                    (1 / 10, 3)),   # 平均 6 回/分
+    ("POST", re.compile(r"^/share_word$"),                  (1 / 10, 5)),
+    ("POST", re.compile(r"^/shared_words/[^/]+/like$"),     (1 / 2,  10)),
+]
+
+
+def _limit_for(method: str, path: str) -> Optional[Tuple[str, float, int]]:
+    for m, pattern, (rate, burst) in ROUTE_LIMITS:
+        if m == method and pattern.match(path):
+            return pattern.pattern, rate, burst
+    return None
+
+
+# ──────────────────────────────
+# バックエンド
+# ──────────────────────────────
+class MemoryBuckets:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()  # key → (tokens, ts, full_after)
+
+    def _evict(self, now: float) -> None:
+        # 先頭（最も長く触られていない）から、満タンに戻ったものと上限超過分を捨てる
+        while self._buckets:
+            key, (_, _, full_after) = next(iter(self._buckets.items()))
+            if full_after <= now or len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            else:
+                break
+
+    async def take(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, ts, _ = self._buckets.pop(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - ts) * rate)
+        if tokens >= 1:
+            tokens -= 1
+            allowed, retry_after = True, 0.0
+        else:
+            allowed, retry_after = False, (1 - tokens) / rate
+        self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        self._evict(now)
+        return allowed, retry_after
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+_REDIS_SCRIPT = """
+local rate  = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t     = redis.call('TIME')
+local now   = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b     = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts     = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed, retry = 0, 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+else
+  retry = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(retry)}
+"""
+
+
+class RedisBuckets:
+    """複数レプリカで共有するバケット。Redis に届かないときはメモリ版で判定する"""
+
+    def __init__(self, url: str, fallback: MemoryBuckets):
+        import redis.asyncio as redis   # 任意依存（RATE_LIMIT_REDIS_URL を使うときだけ必要）
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(_REDIS_SCRIPT)
+        self._fallback = fallback
+
+    async def take(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        try:
+            allowed, retry = await self._script(keys=[f"rl:{key}"], args=[rate, burst])
+            return bool(int(allowed)), float(retry)
+        except Exception as e:
+            print("⚠️ rate limit: Redis 失敗、メモリで判定:", e)
+            return await self._fallback.take(key, rate, burst)
+
+
+def _make_backend():
+    memory = MemoryBuckets()
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            return RedisBuckets(RATE_LIMIT_REDIS_URL, memory)
+        except Exception as e:
+            print("⚠️ rate limit: Redis を使えないのでメモリのみ:", e)
+    return memory
+
+
+# ──────────────────────────────
+# ミドルウェア
+# ──────────────────────────────
+def _client_ip(scope) -> str:
+    """信頼するプロキシが見た接続元。各プロキシは右端に追記するので、右から TRUSTED_PROXY_HOPS 個目"""
+    if TRUSTED_PROXY_HOPS > 0:
+        forwarded = [v for k, v in scope.get("headers") or [] if k == b"x-forwarded-for"]
+        hops = [h.strip() for h in b",".join(forwarded).decode("latin-1").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _normalize_user_id(value) -> Optional[str]:
+    # /chat と同じく UUID の正規形にそろえる（大文字・波かっこ違いで別バケットにならないように）
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None     # 後段で 400 / 422 になる。IP のバケットだけで足りる
+
+
+def _query_user_id(scope) -> Optional[str]:
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("user_id")
+    return values[0] if values else None
+
+
+async def _peek_body(receive):
+    """ボディを MAX_BODY_PEEK バイトまで読む。(読んだメッセージ, 全部読めたときのボディ or None)"""
+    messages, body = [], b""
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            return messages, None
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return messages, body
+        if len(body) > MAX_BODY_PEEK:
+            return messages, None
+
+
+def _body_user_id(body: Optional[bytes]) -> Optional[str]:
+    if not body or len(body) > MAX_BODY_PEEK:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    return payload.get("user_id") if isinstance(payload, dict) else None
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, backend=None):
+        self.app = app
+        self.backend = backend or _make_backend()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            return await self.app(scope, receive, send)
+        limit = _limit_for(scope["method"], scope["path"])
+        if limit is None:
+            return await self.app(scope, receive, send)
+        route, rate, burst = limit
+
+        key = f"ip:{route}:{_client_ip(scope)}"
+        allowed, retry_after = await self.backend.take(key, rate * RATE_LIMIT_IP_FACTOR,
+                                                       burst * RATE_LIMIT_IP_FACTOR)
+        if not allowed:
+            return await _too_many_requests(send, retry_after)
+
+        messages = []
+        user_id = _query_user_id(scope)
+        if user_id is None:
+            messages, body = await _peek_body(receive)
+            user_id = _body_user_id(body)
+        user_id = _normalize_user_id(user_id) if user_id else None
+        if user_id:
+            allowed, retry_after = await self.backend.take(f"user:{route}:{user_id}", rate, burst)
+            if not allowed:
+                return await _too_many_requests(send, retry_after)
+
+        async def replay():
+            # 先読みした分を流したら、残りは後段が直接読む
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        await self.app(scope, replay, send)
+
+
+async def _too_many_requests(send, retry_after: float):
+    body = json.dumps({"detail": "リクエストが多すぎます。少し時間をおいてからお試しください。"},
+                      ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,43 @@
+# utils/shared_word_cache.py
+# ─────────────────────────────
+# 公開ページ /words/{slug} の読み取りキャッシュ
+#   共有された言葉は作成後に変わらないので、エンコード済みの本文と ETag をそのまま持つ。
+#   見つからなかった slug も短時間だけ覚えておく（ネガティブキャッシュ）。
+#   共有の作成・削除時は invalidate_shared_word() で消す。
+import hashlib
+import os
+from typing import Optional, Tuple
+
+from utils.cache import LRUCache
+
+SHARED_WORD_CACHE_SIZE    = int(os.getenv("SHARED_WORD_CACHE_SIZE", "10000"))
+SHARED_WORD_NEGATIVE_TTL  = 30      # 秒。未知の slug を覚えておく時間
+SHARED_WORD_MAX_AGE       = 300     # 秒。CDN / ブラウザ向け Cache-Control
+
+NOT_FOUND = "not_found"
+
+_cache = LRUCache(SHARED_WORD_CACHE_SIZE)
+
+
+def get_cached(slug: str):
+    """(body, etag) / NOT_FOUND / None（未キャッシュ）"""
+    return _cache.get(slug)
+
+
+def store(slug: str, body: bytes) -> Tuple[bytes, str]:
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    _cache.set(slug, (body, etag))
+    return body, etag
+
+
+def store_not_found(slug: str) -> None:
+    _cache.set(slug, NOT_FOUND, ttl=SHARED_WORD_NEGATIVE_TTL)
+
+
+def invalidate_shared_word(slug: Optional[str]) -> None:
+    if slug:
+        _cache.delete(slug)
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
@@ -0,0 +1,129 @@
+# utils/token_estimator.py
+# ─────────────────────────────
+# /chat・/new_chat の事前予約トークン数の見積もり
+#   実際に課金したトークン数（billable）から、リクエストの種類ごとに学習する。
+#     バケット = (new / chat, BLESS かどうか, 履歴ターン数の帯)
+#     予約 = 質問文の概算 + そのバケットの「質問以外の分」の平均 + TOKEN_ESTIMATE_Z × 標準偏差
+#   平均・分散は指数移動平均（最初のうちは単純平均）。サンプルが少ないうちは従来式
+#   （len/2.2 + 300）を使う。
+#   見積もり誤差・追加課金率・返金率はバケットごとに数えて /diagnostics/token_estimator で見られる。
+import math
+import os
+from typing import Dict, Optional, Tuple
+
+from utils.ai_response import detect_bless
+from utils.cache import LRUCache
+
+TOKEN_ESTIMATE_Z          = float(os.getenv("TOKEN_ESTIMATE_Z", "1.0"))   # 大きいほど追加課金が減り、予約が膨らむ
+TOKEN_ESTIMATE_ALPHA      = 0.05     # 指数移動平均の重み
+TOKEN_ESTIMATE_MIN_SAMPLES = 20      # これ未満のバケットは従来式
+# これを超える余りは返す。返金は user_tokens への 2 本目の UPDATE（同じ行のロックをもう一度取る）なので、
+# 予約の揺れ（TOKEN_ESTIMATE_Z × 標準偏差）程度の余りでは返さず、明らかな見積もり過多だけを返す。
+# 下げるほどユーザーへの過剰請求は減るが、返金の UPDATE が増える（返金率は /diagnostics/token_estimator）
+TOKEN_REFUND_MIN          = int(os.getenv("TOKEN_REFUND_MIN", "300"))
+PRIOR_BUFFER              = 300      # 従来式の回答バッファ
+
+# 履歴ターン数の帯（None = このプロセスではまだ見ていないチャット）
+_HISTORY_BANDS = ((0, "0"), (1, "1"), (2, "2"), (4, "3-4"), (None, "5+"))
+
+_chat_turns = LRUCache(int(os.getenv("TOKEN_ESTIMATE_CHATS", "50000")), ttl=6 * 3600)
+
+
+def _question_tokens(text: str) -> int:
+    # 日本語ざっくり想定：2.2文字 ≒ 1token
+    return max(1, int(len(text) / 2.2))
+
+
+def _history_band(turns: Optional[int]) -> str:
+    if turns is None:
+        return "?"
+    for upper, label in _HISTORY_BANDS:
+        if upper is None or turns <= upper:
+            return label
+    return "5+"
+
+
+class _Bucket:
+    __slots__ = ("n", "mean", "var", "abs_err", "extra", "refund")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0        # 質問以外の分（履歴・プレフィックス・回答）の平均
+        self.var = 0.0
+        self.abs_err = 0.0     # |予約 - 実際| の移動平均
+        self.extra = 0         # 予約が足りず追加課金した回数
+        self.refund = 0        # 予約が余って返金した回数
+
+    def update(self, overhead: float, reserved: int, actual: int) -> None:
+        self.n += 1
+        alpha = max(1 / self.n, TOKEN_ESTIMATE_ALPHA)
+        delta = overhead - self.mean
+        self.mean += alpha * delta
+        self.var = (1 - alpha) * (self.var + alpha * delta * delta)
+        self.abs_err += alpha * (abs(reserved - actual) - self.abs_err)
+        if actual > reserved:
+            self.extra += 1
+        elif reserved - actual > TOKEN_REFUND_MIN:
+            self.refund += 1
+
+    def reserve(self, question_tokens: int) -> Optional[int]:
+        if self.n < TOKEN_ESTIMATE_MIN_SAMPLES:
+            return None
+        return max(1, math.ceil(question_tokens + self.mean + TOKEN_ESTIMATE_Z * math.sqrt(self.var)))
+
+    def stats(self) -> Dict:
+        return {"samples": self.n, "overhead_mean": round(self.mean, 1),
+                "overhead_std": round(math.sqrt(self.var), 1), "abs_error": round(self.abs_err, 1),
+                "extra_charge_rate": round(self.extra / self.n, 3) if self.n else None,
+                "refund_rate": round(self.refund / self.n, 3) if self.n else None}
+
+
+_buckets: Dict[Tuple[str, bool, str], _Bucket] = {}
+
+
+class Estimate:
+    __slots__ = ("key", "question_tokens", "tokens", "chat_id")
+
+    def __init__(self, key, question_tokens: int, tokens: int, chat_id: Optional[str]):
+        self.key = key
+        self.question_tokens = question_tokens
+        self.tokens = tokens
+        self.chat_id = chat_id
+
+
+def estimate(kind: str, question: str, chat_id: Optional[str] = None) -> Estimate:
+    """kind は "new"（/new_chat）か "chat"（/chat）"""
+    turns = 0 if kind == "new" else _chat_turns.get(str(chat_id).lower())
+    key = (kind, detect_bless(question), _history_band(turns))
+    q = _question_tokens(question)
+    bucket = _buckets.get(key)
+    reserved = bucket.reserve(q) if bucket else None
+    return Estimate(key, q, reserved if reserved is not None else q + PRIOR_BUFFER, chat_id)
+
+
+def observe(est: Estimate, actual: int, chat_id: Optional[str] = None,
+            history_turns: Optional[int] = None) -> None:
+    """実際の課金トークン数で学習する。
+    history_turns は今回プロンプトに入った履歴ターン数（次のターンはそれ + 1 として見積もる）"""
+    bucket = _buckets.get(est.key)
+    if bucket is None:
+        bucket = _buckets[est.key] = _Bucket()
+    bucket.update(actual - est.question_tokens, est.tokens, actual)
+
+    chat_id = chat_id or est.chat_id
+    if chat_id:
+        _chat_turns.set(str(chat_id).lower(), (history_turns or 0) + 1)
+
+
+def stats() -> Dict:
+    total = sum(b.n for b in _buckets.values())
+    return {
+        "z": TOKEN_ESTIMATE_Z,
+        "refund_min": TOKEN_REFUND_MIN,
+        "min_samples": TOKEN_ESTIMATE_MIN_SAMPLES,
+        "samples": total,
+        "extra_charge_rate": round(sum(b.extra for b in _buckets.values()) / total, 3) if total else None,
+        "refund_rate": round(sum(b.refund for b in _buckets.values()) / total, 3) if total else None,
+        "buckets": {f"{kind}|{'bless' if bless else 'normal'}|history={band}": b.stats()
+                    for (kind, bless, band), b in sorted(_buckets.items())},
+    }
@@ -0,0 +1,209 @@
+# utils/trending.py
+# ─────────────────────────────
+# 共有された言葉の「急上昇」フィード（/shared_words/trending）
+#   スコア = Σ exp((いいねした時刻 - trend_epoch) / τ)、τ = 半減期 / ln2
+#   （sql/009_shared_words_trending.sql、行ごとの基準時刻は sql/010_shared_words_trend_epoch.sql）
+#   - いいね・取り消しのたびに 1 項だけ足し引きする（O(1)、favorites を数え直さない）。
+#     そのとき行を trending_state.epoch 基準に換算し直すので、ほとんどの行は同じ基準にそろっている
+#   - 値は時間とともに大きくなるので、TRENDING_REBASE_SEC ごとに epoch を進め、古い基準の行を
+#     小さなバッチで exp(-Δ/τ) 倍していく。epoch はロックせずに読むので、rebase 中もいいねは待たされない
+#   - 上位 TRENDING_TOP_K 件はメモリに並べて持ち、ページはそこから切り出す。
+#     このプロセスのいいねは即座に反映し、他のレプリカの分は TRENDING_REFRESH_SEC ごとの読み直しで追いつく
+import asyncio
+import math
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from asyncpg import Pool
+
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+TRENDING_TAU_SEC         = TRENDING_HALF_LIFE_HOURS * 3600 / math.log(2)
+TRENDING_TOP_K           = int(os.getenv("TRENDING_TOP_K", "500"))
+TRENDING_PAGE_MAX        = 50
+TRENDING_REFRESH_SEC     = int(os.getenv("TRENDING_REFRESH_SEC", "60"))
+TRENDING_REBASE_SEC      = 6 * 3600
+TRENDING_MIN_SCORE       = 1e-6     # rebase 時にこれ未満（ほぼ減衰しきった行）は 0 に落とす
+TRENDING_REBASE_BATCH    = 1000     # rebase で 1 UPDATE あたりに換算する行数
+TRENDING_REBASE_PAUSE_SEC = 0.05    # バッチ間でいいねに譲る
+
+# exp は桁あふれ・アンダーフローでエラーになるので指数を ±700 に収める
+_WEIGHT = "exp(GREATEST(LEAST(extract(epoch FROM {t} - $2::timestamptz) / $3, 700), -700))"
+# 行のスコアを自分の trend_epoch 基準から $2 基準に直したもの
+_SCALED = "s.trend_score * " + _WEIGHT.format(t="s.trend_epoch")
+
+_ITEM_COLUMNS = """
+    s.id, s.content, s.share_slug, s.created_at, s.comment, s.trend_score, s.trend_epoch,
+    (SELECT count(*) FROM favorites f WHERE f.shared_id = s.id) AS like_count
+"""
+
+_items: Dict[str, Dict] = {}        # id → 項目（score は _epoch 基準）
+_epoch: Optional[datetime] = None
+_page: List[Dict] = []              # スコア順に並べた上位 K 件（返す形のまま）
+_dirty = True
+_stale = True                       # 次の読み出しで DB から読み直す
+_refresh_lock = asyncio.Lock()
+
+
+def _scaled(row, epoch: datetime) -> float:
+    return row["trend_score"] * math.exp((row["trend_epoch"] - epoch).total_seconds() / TRENDING_TAU_SEC)
+
+
+def _item(row, score: float) -> Dict:
+    return {"id": row["id"], "content": row["content"], "share_slug": row["share_slug"],
+            "created_at": row["created_at"], "comment": row["comment"],
+            "like_count": row["like_count"], "score": score}
+
+
+# ──────────────────────────────
+# いいね（routers/share.py の toggle_like と同じトランザクションで呼ぶ）
+# ──────────────────────────────
+async def record_like(conn, shared_id, liked_at: datetime, delta: int):
+    """delta = +1（いいね）/ -1（取り消し）。liked_at はそのいいねの favorites.created_at。
+    更新後の行を返すので、コミット後に apply() に渡す"""
+    # epoch はロックしない（全いいねが 1 行を共有ロックすると MultiXact が膨らみ、rebase 中は全員待たされる）。
+    # rebase と入れ違って古い epoch を読んでも、行を自分の trend_epoch から換算するので値は正しい
+    epoch = await conn.fetchval("SELECT epoch FROM trending_state")
+    sign = "+" if delta > 0 else "-"
+    return await conn.fetchrow(f"""
+        UPDATE shared_words s
+        SET trend_score = GREATEST({_SCALED} {sign} {_WEIGHT.format(t="$4::timestamptz")}, 0),
+            trend_epoch = $2
+        WHERE s.id = $1
+        RETURNING {_ITEM_COLUMNS}
+    """, shared_id, epoch, TRENDING_TAU_SEC, liked_at)
+
+
+def apply(updated) -> None:
+    """record_like の結果をメモリの上位 K 件に反映する"""
+    global _dirty
+    if updated is None or _epoch is None:
+        return
+    row = updated
+    key = str(row["id"])
+    # 別のレプリカが rebase した直後なら、手元の epoch 基準に直す
+    score = _scaled(row, _epoch)
+    if score <= 0:
+        _dirty = _items.pop(key, None) is not None or _dirty
+        return
+    if key in _items or len(_page) < TRENDING_TOP_K or score > _page[-1]["score"]:
+        _items[key] = _item(row, score)
+        _dirty = True
+
+
+def forget(shared_ids: Iterable) -> None:
+    """削除された共有をフィードから外す"""
+    global _dirty
+    for shared_id in shared_ids:
+        if _items.pop(str(shared_id), None) is not None:
+            _dirty = True
+
+
+def mark_stale() -> None:
+    global _stale
+    _stale = True
+
+
+# ──────────────────────────────
+# 読み出し
+# ──────────────────────────────
+def _rebuild() -> None:
+    global _page, _dirty
+    ranked = sorted(_items.values(), key=lambda i: i["score"], reverse=True)[:TRENDING_TOP_K]
+    for key in set(_items) - {str(i["id"]) for i in ranked}:
+        del _items[key]
+    _page = ranked
+    _dirty = False
+
+
+async def refresh(db: Pool) -> None:
+    """上位 K 件を DB から読み直す"""
+    global _items, _epoch, _stale, _dirty
+    async with _refresh_lock:
+        async with db.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                epoch = await conn.fetchval("SELECT epoch FROM trending_state")
+                # ほとんどの行は epoch 基準なので索引の順に読める
+                rows = await conn.fetch(f"""
+                    SELECT {_ITEM_COLUMNS} FROM shared_words s
+                    WHERE s.trend_score > 0 AND s.trend_epoch = $2
+                    ORDER BY s.trend_score DESC
+                    LIMIT $1
+                """, TRENDING_TOP_K, epoch)
+                # rebase がまだ換算していない行（epoch は行より先に進むので、取り残しは必ず古い側）
+                rows += await conn.fetch(f"""
+                    SELECT {_ITEM_COLUMNS} FROM shared_words s
+                    WHERE s.trend_score > 0 AND s.trend_epoch < $2
+                    ORDER BY {_SCALED} DESC
+                    LIMIT $1
+                """, TRENDING_TOP_K, epoch, TRENDING_TAU_SEC)
+        _items = {str(r["id"]): _item(r, _scaled(r, epoch)) for r in rows}
+        _epoch, _stale, _dirty = epoch, False, True
+
+
+async def trending_page(db: Pool, offset: int, limit: int) -> List[Dict]:
+    if _stale or _epoch is None:
+        await refresh(db)
+    if _dirty:
+        _rebuild()
+    return [{k: v for k, v in item.items() if k != "score"}
+            for item in _page[offset:offset + min(limit, TRENDING_PAGE_MAX)]]
+
+
+# ──────────────────────────────
+# rebase / 再計算
+# ──────────────────────────────
+async def rebase(db: Pool) -> bool:
+    """epoch が TRENDING_REBASE_SEC より古ければ進め（どれか 1 レプリカだけが進める）、
+    古い基準の行を小さなバッチで新しい epoch 基準に換算する。epoch を進めたかを返す"""
+    advanced = await db.fetchval("""
+        UPDATE trending_state SET epoch = now()
+        WHERE epoch < now() - make_interval(secs => $1)
+        RETURNING epoch
+    """, float(TRENDING_REBASE_SEC))
+    epoch = advanced or await db.fetchval("SELECT epoch FROM trending_state")
+    # 進めなかったときも回す（前回の途中で止まった分と、古い epoch を読んだいいねの分を拾う）
+    while True:
+        status = await db.execute(f"""
+            UPDATE shared_words s
+            SET trend_score = CASE WHEN {_SCALED} < $4 THEN 0 ELSE {_SCALED} END,
+                trend_epoch = $2
+            WHERE s.id IN (
+                SELECT id FROM shared_words WHERE trend_score > 0 AND trend_epoch < $2 LIMIT $1
+            )
+        """, TRENDING_REBASE_BATCH, epoch, TRENDING_TAU_SEC, TRENDING_MIN_SCORE)
+        if int(status.split()[-1]) < TRENDING_REBASE_BATCH:
+            return advanced is not None
+        await asyncio.sleep(TRENDING_REBASE_PAUSE_SEC)
+
+
+async def recompute_scores(conn, shared_ids: List) -> None:
+    """favorites からスコアを数え直す（ユーザー削除でいいねがまとめて消えたとき）。
+    いいねを消したのと同じトランザクションで呼び、コミット後に mark_stale() する"""
+    if not shared_ids:
+        return
+    epoch = await conn.fetchval("SELECT epoch FROM trending_state")
+    await conn.execute(f"""
+        UPDATE shared_words s
+        SET trend_score = COALESCE((
+                SELECT SUM({_WEIGHT.format(t="f.created_at")})
+                FROM favorites f WHERE f.shared_id = s.id
+            ), 0),
+            trend_epoch = $2
+        WHERE s.id = ANY($1)
+    """, shared_ids, epoch, TRENDING_TAU_SEC)
+
+
+async def trending_worker(db: Pool):
+    """lifespan から起動する常駐タスク：定期的に rebase と上位 K 件の読み直し"""
+    last_rebase_check = 0.0
+    while True:
+        await asyncio.sleep(TRENDING_REFRESH_SEC)
+        try:
+            if time.monotonic() - last_rebase_check >= TRENDING_REBASE_SEC / 6:
+                last_rebase_check = time.monotonic()
+                await rebase(db)
+            await refresh(db)
+        except Exception as e:
+            print("❌ 急上昇フィードの更新失敗:", e)
@@ -0,0 +1,107 @@
+# utils/usage_rollup.py
+# ─────────────────────────────
+# 利用量の日次ロールアップ（usage_daily）
+#   リクエスト経路ではプロセス内の辞書に足すだけ。USAGE_FLUSH_SEC ごとに
+#   (user_id, day, model) 単位の差分を executemany で加算 UPSERT する。
+#   レプリカごとに自分の差分だけを足すので、複数台でも二重計上にならない。
+#   シャットダウン時と全ユーザー日次リセットの直前にも flush する。
+#   日付は utils.init.service_today()（SERVICE_TZ、既定 Asia/Tokyo）で切る。日次リセットと同じ境界。
+#   履歴の要約に使った要約モデルの消費も、要約モデル名の行に積む（message_count などは数えない）。
+import asyncio
+import os
+from datetime import date
+from typing import Dict, Optional, Tuple
+
+from asyncpg import Pool
+
+from utils.init import service_today
+
+USAGE_FLUSH_SEC = int(os.getenv("USAGE_FLUSH_SEC", "60"))
+
+_FIELDS = ("tokens_used", "tokens_rewarded", "chat_count", "message_count",
+           "prompt_tokens", "cached_tokens", "completion_tokens")
+
+_pending: Dict[Tuple[str, date, str], Dict[str, int]] = {}
+_flush_lock = asyncio.Lock()
+
+
+def usage_today() -> date:
+    """usage_daily.day の「今日」（user_tokens.last_reset_date と同じ日付）"""
+    return service_today()
+
+
+def _add(user_id: str, model: str, day: Optional[date] = None, **counts: int) -> None:
+    key = (str(user_id), day or usage_today(), model or "")
+    row = _pending.get(key)
+    if row is None:
+        row = _pending[key] = dict.fromkeys(_FIELDS, 0)
+    for name, n in counts.items():
+        row[name] += n or 0
+
+
+def record_chat(user_id: str, usage: Dict, tokens_charged: int, new_chat: bool = False) -> None:
+    """回答 1 ターン分。tokens_charged は user_tokens から実際に差し引いた数"""
+    _add(user_id, usage.get("model", ""),
+         tokens_used=tokens_charged,
+         chat_count=1 if new_chat else 0,
+         message_count=1,
+         prompt_tokens=usage.get("prompt_tokens", 0),
+         cached_tokens=usage.get("cached_tokens", 0),
+         completion_tokens=usage.get("completion_tokens", 0))
+    summary = usage.get("summary_usage")
+    if summary:
+        _add(user_id, summary.get("model", ""),
+             prompt_tokens=summary.get("prompt_tokens", 0),
+             cached_tokens=summary.get("cached_tokens", 0),
+             completion_tokens=summary.get("completion_tokens", 0))
+
+
+def record_reward(user_id: str, tokens: int) -> None:
+    _add(user_id, "", tokens_rewarded=tokens)
+
+
+async def flush_usage(db: Pool) -> int:
+    """溜まった差分を usage_daily に加算する。失敗したら差分を戻して次回に回す"""
+    global _pending
+    async with _flush_lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending, {}
+        rows = [(uid, day, model, *(c[f] for f in _FIELDS)) for (uid, day, model), c in batch.items()]
+        try:
+            await db.executemany("""
+                INSERT INTO usage_daily
+                (user_id, day, model, tokens_used, tokens_rewarded, chat_count, message_count,
+                 prompt_tokens, cached_tokens, completion_tokens)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                ON CONFLICT (user_id, day, model) DO UPDATE SET
+                  tokens_used       = usage_daily.tokens_used       + EXCLUDED.tokens_used,
+                  tokens_rewarded   = usage_daily.tokens_rewarded   + EXCLUDED.tokens_rewarded,
+                  chat_count        = usage_daily.chat_count        + EXCLUDED.chat_count,
+                  message_count     = usage_daily.message_count     + EXCLUDED.message_count,
+                  prompt_tokens     = usage_daily.prompt_tokens     + EXCLUDED.prompt_tokens,
+                  cached_tokens     = usage_daily.cached_tokens     + EXCLUDED.cached_tokens,
+                  completion_tokens = usage_daily.completion_tokens + EXCLUDED.completion_tokens,
+                  updated_at        = now()
+            """, rows)
+        except Exception:
+            for (uid, day, model), counts in batch.items():
+                _add(uid, model, day, **counts)
+            raise
+        return len(rows)
+
+
+async def usage_rollup_worker(db: Pool):
+    """lifespan から起動する常駐タスク"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SEC)
+        try:
+            await flush_usage(db)
+        except Exception as e:
+            print("❌ 利用量ロールアップ失敗（次回に持ち越し）:", e)
+
+
+def forget_user(user_id: str) -> None:
+    """削除されるユーザーの未 flush 分を捨てる"""
+    for key in [k for k in _pending if k[0] == str(user_id)]:
+        del _pending[key]